@@ -1,15 +1,48 @@
-import aiosqlite
+import json
+import time
 import logging
-from config import DB_NAME
+from config import (
+    DB_NAME, DB_READER_CONNECTIONS, USER_CACHE_SIZE, USER_CACHE_TTL,
+    MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_TTL
+)
 from datetime import datetime
+from Database.pool import ConnectionPool
+from Database.cache import TTLCache, HitCounter
+from metrics import register_cache
 
 logger = logging.getLogger(__name__)
 
 DATABASE_FILE = DB_NAME
 
+# Created by init_db() and shared by every helper below
+pool: ConnectionPool | None = None
+
+def get_pool() -> ConnectionPool:
+    """Returns the open connection pool."""
+    if pool is None or not pool.is_open:
+        raise RuntimeError("Database pool is not open. Call init_db() first.")
+    return pool
+
+# --- User Cache ---
+# get_user() is called for every incoming link, so user rows are cached in
+# memory. Every helper that writes to `users` must call _invalidate_user().
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+register_cache("user", user_cache)
+# Bumped on every invalidation so a read that raced with a write isn't cached
+_user_cache_version = 0
+
+def _invalidate_user(user_id: int):
+    global _user_cache_version
+    _user_cache_version += 1
+    user_cache.invalidate(user_id)
+
 async def init_db():
-    """Initializes the database and creates tables if they don't exist."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Opens the connection pool and creates tables if they don't exist."""
+    global pool
+    if pool is None or not pool.is_open:
+        pool = ConnectionPool(DATABASE_FILE, readers=DB_READER_CONNECTIONS)
+        await pool.open()
+    async with pool.writer() as db:
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -27,105 +60,230 @@ async def init_db():
                 value INTEGER DEFAULT 0
             )
         ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                media_key TEXT PRIMARY KEY,
+                caption TEXT,
+                items TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache (last_used)")
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS ig_profiles (
+                username TEXT PRIMARY KEY,
+                userid INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # Users who blocked the bot or deleted their account (skipped by broadcasts)
+        async with db.execute("PRAGMA table_info(users)") as cursor:
+            columns = [row["name"] for row in await cursor.fetchall()]
+        if "is_blocked" not in columns:
+            await db.execute("ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE")
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                from_chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER DEFAULT 0,
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        ''')
         # Initialize total downloads stat if not present
         await db.execute("INSERT OR IGNORE INTO stats (stat_key, value) VALUES ('total_downloads', 0)")
-        await db.commit()
+        await _init_user_counters(db)
+        # Download outcomes per hour/day bucket (unix time of the bucket start)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS download_stats (
+                period TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                media_type TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (period, bucket, media_type, outcome)
+            ) WITHOUT ROWID
+        ''')
+        # Journal of every accepted link: queued -> downloading -> uploading ->
+        # done/failed. Also the job queue between ingress and worker nodes.
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                priority INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                attempts INTEGER DEFAULT 0,
+                lease_until REAL,
+                error TEXT,
+                notified BOOLEAN DEFAULT FALSE,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, priority, job_id)")
     logger.info("Database initialized successfully.")
 
+# --- User Counters ---
+# Total/premium/banned user counts live in `stats` and are kept up to date by
+# triggers, so /stats never has to scan the users table.
+
+USER_COUNTERS = {
+    "total_users": "1",
+    "premium_users": "is_premium",
+    "banned_users": "is_banned",
+}
+
+async def _init_user_counters(db):
+    """Creates the counter triggers, counting existing users once if needed."""
+    async with db.execute(
+        "SELECT COUNT(*) FROM stats WHERE stat_key IN ('total_users', 'premium_users', 'banned_users')"
+    ) as cursor:
+        seeded = (await cursor.fetchone())[0] == len(USER_COUNTERS)
+    if not seeded:
+        for key, condition in USER_COUNTERS.items():
+            await db.execute(
+                f"INSERT OR REPLACE INTO stats (stat_key, value) "
+                f"SELECT ?, COUNT(*) FROM users WHERE {condition}",
+                (key,)
+            )
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_counters_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + 1 WHERE stat_key = 'total_users';
+            UPDATE stats SET value = value + 1 WHERE stat_key = 'premium_users' AND NEW.is_premium;
+            UPDATE stats SET value = value + 1 WHERE stat_key = 'banned_users' AND NEW.is_banned;
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_counters_update AFTER UPDATE OF is_premium, is_banned ON users BEGIN
+            UPDATE stats SET value = value + (COALESCE(NEW.is_premium, 0) != 0) - (COALESCE(OLD.is_premium, 0) != 0)
+                WHERE stat_key = 'premium_users';
+            UPDATE stats SET value = value + (COALESCE(NEW.is_banned, 0) != 0) - (COALESCE(OLD.is_banned, 0) != 0)
+                WHERE stat_key = 'banned_users';
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_counters_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - 1 WHERE stat_key = 'total_users';
+            UPDATE stats SET value = value - 1 WHERE stat_key = 'premium_users' AND OLD.is_premium;
+            UPDATE stats SET value = value - 1 WHERE stat_key = 'banned_users' AND OLD.is_banned;
+        END
+    ''')
+
+async def close_db():
+    """Closes the connection pool. Called once on shutdown."""
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+
 async def add_user(user_id: int):
-    """Adds a new user to the database or ignores if already exists."""
+    """Adds a new user to the database, or marks an existing one as reachable again."""
     join_date = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        try:
+    try:
+        async with get_pool().writer() as db:
             await db.execute(
                 "INSERT OR IGNORE INTO users (user_id, join_date) VALUES (?, ?)",
                 (user_id, join_date)
             )
-            await db.commit()
-        except Exception as e:
-            logger.error(f"Error adding user {user_id}: {e}")
+            # A user writing to the bot has unblocked it
+            await db.execute(
+                "UPDATE users SET is_blocked = FALSE WHERE user_id = ? AND is_blocked", (user_id,)
+            )
+        _invalidate_user(user_id)
+    except Exception as e:
+        logger.error(f"Error adding user {user_id}: {e}")
 
 async def get_user(user_id: int):
-    """Retrieves a user's data from the database."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    """Retrieves a user's data, from the cache when possible."""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return dict(user)
+    version = _user_cache_version
+    async with get_pool().reader() as db:
         async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
-            if row:
-                # Return as a dictionary
-                keys = [desc[0] for desc in cursor.description]
-                return dict(zip(keys, row))
-            return None
+    if not row:
+        return None
+    # Return as a dictionary
+    user = dict(row)
+    if version == _user_cache_version:
+        user_cache.set(user_id, user)
+    return dict(user)
+
+async def get_or_create_user(user_id: int):
+    """Returns the user's data, adding the user first if needed."""
+    user = await get_user(user_id)
+    if user is None or user.get('is_blocked'):
+        # New, or flagged by a broadcast but writing to the bot again
+        await add_user(user_id)
+        user = await get_user(user_id)
+    return user
 
 async def update_user_premium(user_id: int, is_premium: bool):
     """Updates a user's premium status."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with get_pool().writer() as db:
         await db.execute("UPDATE users SET is_premium = ? WHERE user_id = ?", (is_premium, user_id))
-        await db.commit()
+    _invalidate_user(user_id)
 
 async def update_user_ban(user_id: int, is_banned: bool):
     """Updates a user's banned status."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with get_pool().writer() as db:
         await db.execute("UPDATE users SET is_banned = ? WHERE user_id = ?", (is_banned, user_id))
-        await db.commit()
+    _invalidate_user(user_id)
 
 async def update_user_admin(user_id: int, is_admin: bool):
     """Updates a user's admin status."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with get_pool().writer() as db:
         await db.execute("UPDATE users SET is_admin = ? WHERE user_id = ?", (is_admin, user_id))
-        await db.commit()
-
-async def get_all_user_ids():
-    """Gets all user IDs for broadcasting."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        async with db.execute("SELECT user_id FROM users WHERE is_banned = FALSE") as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows]
+    _invalidate_user(user_id)
 
 async def get_bot_stats():
-    """Retrieves statistics for the admin panel."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-            total_users = (await cursor.fetchone())[0]
-        
-        async with db.execute("SELECT COUNT(*) FROM users WHERE is_premium = TRUE") as cursor:
-            premium_users = (await cursor.fetchone())[0]
-        
-        async with db.execute("SELECT COUNT(*) FROM users WHERE is_banned = TRUE") as cursor:
-            banned_users = (await cursor.fetchone())[0]
-
-        async with db.execute("SELECT value FROM stats WHERE stat_key = 'total_downloads'") as cursor:
-            total_downloads_row = await cursor.fetchone()
-            total_downloads = total_downloads_row[0] if total_downloads_row else 0
-            
-        return {
-            "total_users": total_users,
-            "premium_users": premium_users,
-            "banned_users": banned_users,
-            "total_downloads": total_downloads
-        }
+    """Retrieves statistics for the admin panel from the maintained counters."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT stat_key, value FROM stats WHERE stat_key IN "
+            "('total_users', 'premium_users', 'banned_users', 'total_downloads')"
+        ) as cursor:
+            values = {row[0]: row[1] for row in await cursor.fetchall()}
+    return {
+        "total_users": values.get("total_users", 0),
+        "premium_users": values.get("premium_users", 0),
+        "banned_users": values.get("banned_users", 0),
+        "total_downloads": values.get("total_downloads", 0)
+    }
 
 async def increment_download_count(user_id: int):
     """Increments a user's daily download count and total downloads."""
     today = datetime.utcnow().date().isoformat()
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        user = await get_user(user_id)
-        current_count = user.get('download_count', 0)
-        last_date = user.get('last_download_date')
-        
-        if last_date != today:
-            current_count = 1
-        else:
-            current_count += 1
-        
+    async with get_pool().writer() as db:
+        # Done in a single statement on the writer connection, so no
+        # separate read is needed and concurrent callers can't lose counts.
         await db.execute(
-            "UPDATE users SET download_count = ?, last_download_date = ? WHERE user_id = ?",
-            (current_count, today, user_id)
+            """UPDATE users SET
+                   download_count = CASE WHEN last_download_date = ? THEN download_count + 1 ELSE 1 END,
+                   last_download_date = ?
+               WHERE user_id = ?""",
+            (today, today, user_id)
         )
+        async with db.execute("SELECT download_count FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
         
         # Increment total bot downloads
         await db.execute("UPDATE stats SET value = value + 1 WHERE stat_key = 'total_downloads'")
-        await db.commit()
-        return current_count
+    # After the commit, so a concurrent reader can't cache the old row again
+    _invalidate_user(user_id)
+    return row[0] if row else 0
 
 async def get_daily_download_count(user_id: int):
     """Gets the user's download count for today."""
@@ -139,3 +297,381 @@ async def get_daily_download_count(user_id: int):
         return 0 # Reset count for the new day
     
     return user.get('download_count', 0)
+
+async def apply_download_counts(rows, total_delta: int):
+    """
+    Writes a batch of daily counters and adds to the total downloads stat.
+    `rows` is a list of (download_count, last_download_date, user_id).
+    """
+    async with get_pool().writer() as db:
+        if rows:
+            await db.executemany(
+                "UPDATE users SET download_count = ?, last_download_date = ? WHERE user_id = ?",
+                rows
+            )
+        if total_delta:
+            await db.execute(
+                "UPDATE stats SET value = value + ? WHERE stat_key = 'total_downloads'",
+                (total_delta,)
+            )
+    # After the commit, so a concurrent reader can't cache the old rows again
+    for row in rows:
+        _invalidate_user(row[2])
+
+# --- Download Statistics ---
+
+async def apply_download_stats(rows):
+    """
+    Adds a batch of counts to the download statistics.
+    `rows` is a list of (period, bucket, media_type, outcome, count).
+    """
+    if not rows:
+        return
+    async with get_pool().writer() as db:
+        await db.executemany(
+            """INSERT INTO download_stats (period, bucket, media_type, outcome, count)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (period, bucket, media_type, outcome)
+               DO UPDATE SET count = count + excluded.count""",
+            rows
+        )
+
+async def get_download_stats(period: str, since_bucket: int):
+    """Sums counts per (media_type, outcome) over buckets starting at or after since_bucket."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT media_type, outcome, SUM(count) FROM download_stats "
+            "WHERE period = ? AND bucket >= ? GROUP BY media_type, outcome",
+            (period, since_bucket)
+        ) as cursor:
+            return {(row[0], row[1]): row[2] for row in await cursor.fetchall()}
+
+async def prune_download_stats(period: str, before_bucket: int) -> int:
+    """Deletes buckets older than before_bucket. Returns the number of rows removed."""
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "DELETE FROM download_stats WHERE period = ? AND bucket < ?", (period, before_bucket)
+        )
+        return cursor.rowcount
+
+# --- Telegram file_id Cache ---
+
+media_cache_lookups = HitCounter()
+register_cache("media_file_id", media_cache_lookups)
+
+async def get_cached_media(media_key: str):
+    """
+    Returns the cached Telegram file_ids for a media key, or None.
+    Result: {"caption": str, "items": [{"type": "photo"|"video", "file_id": str}, ...]}
+    """
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT caption, items FROM media_cache WHERE media_key = ? AND created_at > ?",
+            (media_key, time.time() - MEDIA_CACHE_TTL)
+        ) as cursor:
+            row = await cursor.fetchone()
+    media_cache_lookups.record(row is not None)
+    if not row:
+        return None
+    return {"caption": row["caption"] or "", "items": json.loads(row["items"])}
+
+async def touch_cached_media(media_key: str):
+    """Marks a cache entry as recently used so it is evicted last."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "UPDATE media_cache SET last_used = ?, hits = hits + 1 WHERE media_key = ?",
+            (time.time(), media_key)
+        )
+
+async def save_cached_media(media_key: str, caption: str, items: list):
+    """Stores the file_ids of a sent post/story and evicts the least recently used entries."""
+    now = time.time()
+    async with get_pool().writer() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO media_cache (media_key, caption, items, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (media_key, caption, json.dumps(items), now, now)
+        )
+        await db.execute(
+            "DELETE FROM media_cache WHERE created_at <= ? OR media_key IN ("
+            "SELECT media_key FROM media_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (now - MEDIA_CACHE_TTL, MEDIA_CACHE_MAX_ENTRIES)
+        )
+
+async def purge_media_cache(media_key: str | None = None, expired_only: bool = False) -> int:
+    """Deletes one entry, all expired entries, or the whole cache. Returns the number removed."""
+    async with get_pool().writer() as db:
+        if media_key:
+            cursor = await db.execute("DELETE FROM media_cache WHERE media_key = ?", (media_key,))
+        elif expired_only:
+            cursor = await db.execute(
+                "DELETE FROM media_cache WHERE created_at <= ?", (time.time() - MEDIA_CACHE_TTL,)
+            )
+        else:
+            cursor = await db.execute("DELETE FROM media_cache")
+        return cursor.rowcount
+
+async def get_media_cache_size() -> int:
+    """Number of entries in the file_id cache."""
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT COUNT(*) FROM media_cache") as cursor:
+            return (await cursor.fetchone())[0]
+
+# --- Instagram Profile Ids ---
+
+async def get_profile_id(username: str, max_age: float):
+    """Returns the stored Instagram userid for a username if it is newer than max_age seconds."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT userid FROM ig_profiles WHERE username = ? AND updated_at > ?",
+            (username.lower(), time.time() - max_age)
+        ) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+async def save_profile_id(username: str, userid: int):
+    """Stores the Instagram userid for a username."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO ig_profiles (username, userid, updated_at) VALUES (?, ?, ?)",
+            (username.lower(), userid, time.time())
+        )
+
+# --- Broadcasts ---
+
+async def count_broadcast_users() -> int:
+    """Number of users a broadcast will be sent to."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT COUNT(*) FROM users WHERE is_banned = FALSE AND is_blocked = FALSE"
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+async def get_broadcast_user_ids(after_user_id: int, limit: int):
+    """Next page of broadcast recipients, in user_id order (keyset pagination)."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND is_banned = FALSE AND is_blocked = FALSE "
+            "ORDER BY user_id LIMIT ?",
+            (after_user_id, limit)
+        ) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def mark_users_blocked(user_ids: list):
+    """Flags users who blocked the bot or were deactivated, in one statement batch."""
+    if not user_ids:
+        return
+    async with get_pool().writer() as db:
+        await db.executemany(
+            "UPDATE users SET is_blocked = TRUE WHERE user_id = ?", [(uid,) for uid in user_ids]
+        )
+    for user_id in user_ids:
+        _invalidate_user(user_id)
+
+async def create_broadcast(from_chat_id: int, message_id: int, status_chat_id: int,
+                           status_message_id: int, total: int) -> int:
+    """Records a new broadcast and returns its id."""
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "INSERT INTO broadcasts (from_chat_id, message_id, status_chat_id, status_message_id, "
+            "total, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (from_chat_id, message_id, status_chat_id, status_message_id, total,
+             datetime.utcnow().isoformat())
+        )
+        return cursor.lastrowid
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int,
+                                  failed: int, blocked: int):
+    """Stores how far a broadcast has got, so it can resume after a restart."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ? "
+            "WHERE broadcast_id = ?",
+            (last_user_id, sent, failed, blocked, broadcast_id)
+        )
+
+async def finish_broadcast(broadcast_id: int, status: str = "done"):
+    """Marks a broadcast as done, cancelled or aborted."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = ? WHERE broadcast_id = ?",
+            (status, datetime.utcnow().isoformat(), broadcast_id)
+        )
+
+async def get_running_broadcasts():
+    """Broadcasts that were interrupted and should be resumed."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id"
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+# --- Job Journal & Queue ---
+# Claims, renewals and expiry are single UPDATE statements, so several
+# processes sharing the database never hand one job to two workers.
+# Jobs in downloading/uploading hold a lease when a worker node runs them;
+# the all-in-one node's own entries have none.
+
+def _job_row(row) -> dict:
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+async def enqueue_job(payload: dict, priority: int, state: str = "queued") -> int:
+    """Records a job (queued for a worker, or already downloading here) and returns its id."""
+    now = time.time()
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "INSERT INTO jobs (priority, payload, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (priority, json.dumps(payload), state, now, now)
+        )
+        return cursor.lastrowid
+
+async def claim_jobs(worker: str, limit: int, lease_until: float) -> list:
+    """
+    Moves up to `limit` queued jobs to downloading on `worker`, highest
+    priority (lowest value) and oldest first. Returns the job rows.
+    """
+    async with get_pool().writer() as db:
+        async with db.execute(
+            """UPDATE jobs SET state = 'downloading', worker = ?, attempts = attempts + 1,
+                   lease_until = ?, updated_at = ?
+               WHERE job_id IN (
+                   SELECT job_id FROM jobs WHERE state = 'queued' ORDER BY priority, job_id LIMIT ?
+               )
+               RETURNING *""",
+            (worker, lease_until, time.time(), limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    return sorted((_job_row(row) for row in rows), key=lambda job: (job["priority"], job["job_id"]))
+
+async def renew_jobs(worker: str, job_ids: list, lease_until: float):
+    """Extends the lease of jobs a worker is still running."""
+    if not job_ids:
+        return
+    async with get_pool().writer() as db:
+        await db.executemany(
+            "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND worker = ? "
+            "AND state IN ('downloading', 'uploading')",
+            [(lease_until, job_id, worker) for job_id in job_ids]
+        )
+
+async def set_job_state(job_id: int, state: str):
+    """Moves a job to its next stage (e.g. uploading)."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE job_id = ?", (state, time.time(), job_id)
+        )
+
+async def finish_job(job_id: int, state: str, error: str | None = None, notified: bool = True):
+    """Records how a job ended ("done" or "failed") and whether the user was told."""
+    async with get_pool().writer() as db:
+        await db.execute(
+            "UPDATE jobs SET state = ?, error = ?, notified = ?, lease_until = NULL, updated_at = ? "
+            "WHERE job_id = ?",
+            (state, error, notified, time.time(), job_id)
+        )
+
+async def mark_jobs_notified(job_ids: list):
+    """Flags failed jobs the user has now been told about."""
+    if not job_ids:
+        return
+    async with get_pool().writer() as db:
+        await db.executemany("UPDATE jobs SET notified = TRUE WHERE job_id = ?", [(j,) for j in job_ids])
+
+async def release_jobs(worker: str) -> int:
+    """
+    Puts a stopping worker's unfinished jobs back in the queue, without
+    counting the attempt. Returns how many.
+    """
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, lease_until = NULL, "
+            "attempts = attempts - 1, updated_at = ? "
+            "WHERE worker = ? AND state IN ('downloading', 'uploading')",
+            (time.time(), worker)
+        )
+        return cursor.rowcount
+
+async def requeue_unleased_jobs() -> int:
+    """Queues for the workers what an all-in-one node left unfinished. Returns how many."""
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "UPDATE jobs SET state = 'queued', updated_at = ? "
+            "WHERE state IN ('downloading', 'uploading') AND lease_until IS NULL",
+            (time.time(),)
+        )
+        return cursor.rowcount
+
+async def expire_jobs(max_attempts: int) -> tuple:
+    """
+    Handles leased jobs whose lease ran out (their worker died): requeues
+    them, or fails those already tried max_attempts times (the user hasn't
+    been told yet). Returns: (requeued, failed)
+    """
+    now = time.time()
+    async with get_pool().writer() as db:
+        failed = await db.execute(
+            "UPDATE jobs SET state = 'failed', error = 'The download worker stopped responding.', "
+            "notified = FALSE, lease_until = NULL, updated_at = ? "
+            "WHERE state IN ('downloading', 'uploading') AND lease_until < ? AND attempts >= ?",
+            (now, now, max_attempts)
+        )
+        requeued = await db.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE state IN ('downloading', 'uploading') AND lease_until < ?",
+            (now, now)
+        )
+        return requeued.rowcount, failed.rowcount
+
+async def get_job_outcomes(job_ids: list) -> dict:
+    """{job_id: {"state", "error", "notified"}} for those of the given jobs that have finished."""
+    if not job_ids:
+        return {}
+    placeholders = ",".join("?" * len(job_ids))
+    async with get_pool().reader() as db:
+        async with db.execute(
+            f"SELECT job_id, state, error, notified FROM jobs WHERE job_id IN ({placeholders}) "
+            f"AND state IN ('done', 'failed')",
+            list(job_ids)
+        ) as cursor:
+            return {row["job_id"]: {"state": row["state"], "error": row["error"],
+                                    "notified": bool(row["notified"])}
+                    for row in await cursor.fetchall()}
+
+async def get_unfinished_jobs() -> list:
+    """Every job not done or failed yet, oldest first (for replay after a restart)."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT * FROM jobs WHERE state NOT IN ('done', 'failed') ORDER BY job_id"
+        ) as cursor:
+            return [_job_row(row) for row in await cursor.fetchall()]
+
+async def get_unnotified_failures() -> list:
+    """Failed jobs whose user was never told."""
+    async with get_pool().reader() as db:
+        async with db.execute(
+            "SELECT * FROM jobs WHERE state = 'failed' AND NOT notified ORDER BY job_id"
+        ) as cursor:
+            return [_job_row(row) for row in await cursor.fetchall()]
+
+async def count_jobs() -> dict:
+    """Number of jobs in each state, and active jobs per worker under "workers"."""
+    async with get_pool().reader() as db:
+        async with db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state") as cursor:
+            counts = {row[0]: row[1] for row in await cursor.fetchall()}
+        async with db.execute(
+            "SELECT worker, COUNT(*) FROM jobs WHERE state IN ('downloading', 'uploading') "
+            "AND worker IS NOT NULL GROUP BY worker"
+        ) as cursor:
+            counts["workers"] = {row[0]: row[1] for row in await cursor.fetchall()}
+    return counts
+
+async def prune_jobs(before: float) -> int:
+    """Deletes finished jobs last updated before `before`. Returns the number removed."""
+    async with get_pool().writer() as db:
+        cursor = await db.execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND notified AND updated_at < ?",
+            (before,)
+        )
+        return cursor.rowcount
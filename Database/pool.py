@@ -0,0 +1,119 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import aiosqlite
+from metrics import db_query_seconds
+
+logger = logging.getLogger(__name__)
+
+# --- Connection Tuning ---
+# WAL lets the readers run while the writer commits. synchronous=NORMAL is
+# safe in WAL mode (only the last transaction can be lost on power failure).
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",   # ~16 MB page cache per connection
+    "PRAGMA mmap_size = 67108864",  # 64 MB
+    "PRAGMA foreign_keys = ON",
+)
+
+# sqlite3 keeps this many compiled statements per connection, so the fixed
+# queries in db.py are only prepared once per connection.
+STATEMENT_CACHE_SIZE = 256
+
+
+class ConnectionPool:
+    """
+    A small pool of long-lived aiosqlite connections.
+    One writer connection (serialized with a lock) and several readers.
+    """
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self._closed = True
+
+    async def _connect(self, read_only: bool = False):
+        db = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        db.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        if read_only:
+            await db.execute("PRAGMA query_only = ON")
+        return db
+
+    async def open(self):
+        """Opens the writer first (so WAL is enabled) and then the readers."""
+        if not self._closed:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            db = await self._connect(read_only=True)
+            self._all_readers.append(db)
+            self._readers.put_nowait(db)
+        self._closed = False
+        logger.info(f"SQLite pool opened on {self.path} (1 writer, {self.reader_count} readers).")
+
+    async def close(self):
+        """Closes every connection. Waits for the writer to finish its transaction."""
+        if self._closed:
+            return
+        self._closed = True
+        async with self._writer_lock:
+            try:
+                # Fold the WAL back into the main file so restarts start clean
+                await self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except Exception as e:
+                logger.warning(f"WAL checkpoint on shutdown failed: {e}")
+            await self._writer.close()
+        for db in self._all_readers:
+            try:
+                await db.close()
+            except Exception as e:
+                logger.warning(f"Failed to close reader connection: {e}")
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        logger.info("SQLite pool closed.")
+
+    @property
+    def is_open(self) -> bool:
+        return not self._closed
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrows a read-only connection from the pool."""
+        if self._closed:
+            raise RuntimeError("Database pool is not open. Call init_db() first.")
+        db = await self._readers.get()
+        started = time.perf_counter()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+            db_query_seconds.labels("reader").observe(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Holds the single writer connection for one transaction.
+        Commits on success and rolls back if the block raises.
+        """
+        if self._closed:
+            raise RuntimeError("Database pool is not open. Call init_db() first.")
+        async with self._writer_lock:
+            started = time.perf_counter()
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                db_query_seconds.labels("writer").observe(time.perf_counter() - started)
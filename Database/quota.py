@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from datetime import datetime
+from config import FREE_USER_DOWNLOAD_LIMIT, QUOTA_FLUSH_INTERVAL
+from Database.db import get_user, apply_download_counts
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaEngine:
+    """
+    Keeps free-tier daily download counters in memory.
+
+    A slot is reserved *before* a download starts, so parallel links from the
+    same user can never overshoot the limit. Counter changes and the global
+    download total are written to SQLite in batches by flush().
+    """
+
+    def __init__(self, limit: int, flush_interval: float):
+        self.limit = limit
+        self.flush_interval = flush_interval
+        self._counts = {}        # user_id -> [date, count]
+        self._dirty = set()      # user_ids whose counters must be written
+        self._pending_total = 0  # successful downloads not yet added to stats
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.utcnow().date().isoformat()
+
+    async def _state(self, user_id: int) -> list:
+        """Returns the [date, count] entry for today, loading it from the DB once."""
+        today = self._today()
+        state = self._counts.get(user_id)
+        if state is None:
+            user = await get_user(user_id)
+            # Another coroutine may have loaded it while we were waiting
+            state = self._counts.get(user_id)
+            if state is None:
+                count = 0
+                if user and user.get('last_download_date') == today:
+                    count = user.get('download_count') or 0
+                state = self._counts[user_id] = [today, count]
+        if state[0] != today:
+            # New day, reset the counter
+            state[0], state[1] = today, 0
+        return state
+
+    async def get_daily_count(self, user_id: int) -> int:
+        """Gets the user's download count for today."""
+        return (await self._state(user_id))[1]
+
+    async def remaining(self, user_id: int, is_premium: bool = False) -> int | None:
+        """Downloads left today, or None for unlimited users."""
+        if is_premium:
+            return None
+        return max(0, self.limit - await self.get_daily_count(user_id))
+
+    async def reserve(self, user_id: int, is_premium: bool = False) -> bool:
+        """
+        Atomically checks the limit and takes one download slot.
+        Returns False if the user has no downloads left today.
+        """
+        if is_premium:
+            return True
+        state = await self._state(user_id)
+        # No await between the check and the increment, so this is atomic
+        if state[1] >= self.limit:
+            return False
+        state[1] += 1
+        self._dirty.add(user_id)
+        return True
+
+    def release(self, user_id: int, is_premium: bool = False):
+        """Gives back a slot taken by reserve() when the download failed."""
+        if is_premium:
+            return
+        state = self._counts.get(user_id)
+        if state and state[0] == self._today() and state[1] > 0:
+            state[1] -= 1
+            self._dirty.add(user_id)
+
+    def record_download(self, count: int = 1):
+        """Counts successful downloads towards the bot-wide total."""
+        self._pending_total += count
+
+    async def flush(self):
+        """Writes all changed counters and the pending total in one transaction."""
+        async with self._flush_lock:
+            if not self._dirty and not self._pending_total:
+                return
+            dirty, self._dirty = self._dirty, set()
+            total, self._pending_total = self._pending_total, 0
+            rows = [
+                (self._counts[uid][1], self._counts[uid][0], uid)
+                for uid in dirty if uid in self._counts
+            ]
+            try:
+                await apply_download_counts(rows, total)
+            except Exception as e:
+                logger.error(f"Quota flush failed, will retry: {e}")
+                self._dirty |= dirty
+                self._pending_total += total
+                return
+            # Drop entries from previous days that have already been written
+            today = self._today()
+            for uid in [u for u, s in self._counts.items() if s[0] != today and u not in self._dirty]:
+                del self._counts[uid]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Starts the periodic background flush."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stops the background flush and writes whatever is left."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+quota = QuotaEngine(FREE_USER_DOWNLOAD_LIMIT, QUOTA_FLUSH_INTERVAL)
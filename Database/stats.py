@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from config import STATS_FLUSH_INTERVAL, STATS_HOURLY_RETENTION
+from Database.db import apply_download_stats, get_download_stats, prune_download_stats
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class DownloadStats:
+    """
+    Counts download outcomes per hour and per day bucket.
+
+    record() only touches an in-memory Counter; flush() adds everything to
+    the download_stats table in one batch. Queries add the counts that
+    haven't been written yet, so reports are always current.
+    """
+
+    def __init__(self, flush_interval: float, hourly_retention: float):
+        self.flush_interval = flush_interval
+        self.hourly_retention = hourly_retention
+        self._pending = Counter()  # (period, bucket, media_type, outcome) -> count
+        self._writing = Counter()  # Batch currently being flushed
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def record(self, media_type: str, success: bool, count: int = 1):
+        now = int(time.time())
+        outcome = "success" if success else "failure"
+        self._pending[("hour", now - now % HOUR, media_type, outcome)] += count
+        self._pending[("day", now - now % DAY, media_type, outcome)] += count
+
+    async def summary(self, period: str, since: float) -> dict:
+        """Returns {(media_type, outcome): count} for buckets starting at or after `since`."""
+        size = HOUR if period == "hour" else DAY
+        since_bucket = int(since) - int(since) % size
+        totals = Counter(await get_download_stats(period, since_bucket))
+        unwritten = self._pending + self._writing
+        for (p, bucket, media_type, outcome), count in unwritten.items():
+            if p == period and bucket >= since_bucket:
+                totals[(media_type, outcome)] += count
+        return dict(totals)
+
+    async def last_hours(self, hours: int = 24) -> dict:
+        """Counts for the last `hours` hourly buckets, including the current one."""
+        return await self.summary("hour", time.time() - (hours - 1) * HOUR)
+
+    async def flush(self):
+        """Writes the pending counts in one transaction and drops old hourly buckets."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending = self._writing = self._pending
+            self._pending = Counter()
+            try:
+                await apply_download_stats([key + (count,) for key, count in pending.items()])
+            except Exception as e:
+                logger.error(f"Download stats flush failed, will retry: {e}")
+                self._pending.update(pending)
+                return
+            finally:
+                self._writing = Counter()
+            # Separate, so a failed prune never re-applies counts already written
+            try:
+                await prune_download_stats("hour", int(time.time() - self.hourly_retention))
+            except Exception as e:
+                logger.error(f"Pruning hourly download stats failed: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Starts the periodic background flush."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Stops the background flush and writes whatever is left."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+download_stats = DownloadStats(STATS_FLUSH_INTERVAL, STATS_HOURLY_RETENTION)
@@ -1,14 +1,28 @@
-import asyncio
+import re
+import time
 import logging
 import os  # Import os
+import tempfile
+from datetime import datetime, timedelta
 from pyrogram import Client, filters
 from pyrogram.types import Message
-from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated
-from config import ADMIN_ID
+from config import ADMIN_ID, PERF_WINDOW, LOG_EXPORT_MAX_BYTES, NODE_ROLE
 from Database.db import (
-    get_bot_stats, get_all_user_ids, update_user_premium, 
-    update_user_ban, get_user, update_user_admin
+    get_bot_stats, update_user_premium, 
+    update_user_ban, get_user, update_user_admin, user_cache,
+    purge_media_cache, get_media_cache_size
 )
+from links import parse_link
+from scheduler import scheduler
+from executors import instagram_executor, fs_executor
+from spool import spool
+from engine import engine
+from jobqueue import job_queue
+from Database.stats import download_stats
+from broadcast import broadcaster
+from tracing import tracer
+from profiler import profiler
+from logs import tail as tail_log, export_range as export_log_range
 
 logger = logging.getLogger(__name__)
 
@@ -36,63 +50,88 @@ async def get_user_id_from_message(message: Message) -> int | None:
             user_id = int(args[1])
     return user_id
 
+def _format_totals(counts: dict) -> str:
+    ok = sum(n for (_, outcome), n in counts.items() if outcome == "success")
+    failed = sum(n for (_, outcome), n in counts.items() if outcome == "failure")
+    return f"`{ok}` ok, `{failed}` failed"
+
+def _format_download_stats(counts: dict) -> str:
+    """One line per link type plus a total, from {(media_type, outcome): count}."""
+    lines = [
+        f"{media_type}: " + _format_totals(
+            {key: n for key, n in counts.items() if key[0] == media_type}
+        )
+        for media_type in sorted({media_type for media_type, _ in counts})
+    ]
+    lines.append(f"Total: {_format_totals(counts)}")
+    return "\n".join(lines)
+
 # --- Admin Commands ---
 
 @Client.on_message(filters.command("stats") & admin_filter & filters.private)
 async def stats_command(client: Client, message: Message):
     """Sends bot usage statistics."""
-    # ... (existing code, no changes)
     stats = await get_bot_stats()
+    last_day = await download_stats.last_hours(24)
+    last_week = await download_stats.summary("day", time.time() - 6 * 24 * 3600)
+    cache = user_cache.stats()
+    queue = scheduler.stats()
+    by_class = ", ".join(f"{name}: {n}" for name, n in queue['depth_by_class'].items())
     await message.reply_text(
         f"**Bot Statistics**\n\n"
         f"Total Users: `{stats['total_users']}`\n"
         f"Premium Users: `{stats['premium_users']}`\n"
         f"Banned Users: `{stats['banned_users']}`\n"
-        f"Total Downloads: `{stats['total_downloads']}`"
+        f"Total Downloads: `{stats['total_downloads']}`\n\n"
+        f"**Downloads (last 24h)**\n"
+        f"{_format_download_stats(last_day)}\n"
+        f"Last 7 days: {_format_totals(last_week)}\n\n"
+        f"**User Cache**\n"
+        f"Size: `{cache['size']}/{cache['maxsize']}`\n"
+        f"Hit Rate: `{cache['hit_rate']:.1%}` ({cache['hits']} hits, {cache['misses']} misses)\n\n"
+        f"**Download Queue**\n"
+        f"Workers Busy: `{queue['running']}/{queue['workers']}`\n"
+        f"Queued: `{queue['depth']}` ({by_class})\n"
+        f"Wait: avg `{queue['avg_wait']:.1f}s`, p95 `{queue['p95_wait']:.1f}s`, max `{queue['max_wait']:.1f}s`\n"
+        f"Completed: `{queue['completed']}` | Failed: `{queue['failed']}`\n\n"
+        f"**Thread Pools**\n"
+        + "\n".join(
+            f"{p['name']}: `{p['active']}/{p['workers']}` busy, `{p['queued']}` queued, "
+            f"avg `{p['avg_duration']:.2f}s`, p95 `{p['p95_duration']:.2f}s`, "
+            f"`{p['timeouts']}` timeouts, `{p['errors']}` errors"
+            for p in (instagram_executor.stats(), fs_executor.stats())
+        )
     )
 
 @Client.on_message(filters.command("broadcast") & admin_filter & filters.private)
 async def broadcast_command(client: Client, message: Message):
-    """Broadcasts a message to all non-banned users."""
-    # ... (existing code, no changes)
+    """Broadcasts a message to all non-banned users in the background."""
     if not message.reply_to_message:
         await message.reply_text("Please reply to a message to broadcast it.")
         return
 
     broadcast_msg = message.reply_to_message
-    user_ids = await get_all_user_ids()
-    
-    sent_msg = await message.reply_text(f"Broadcasting to {len(user_ids)} users...")
-    
-    success_count = 0
-    fail_count = 0
-    
-    for user_id in user_ids:
-        try:
-            await broadcast_msg.copy(chat_id=user_id)
-            success_count += 1
-        except FloodWait as e:
-            logger.warning(f"FloodWait for {e.x} seconds. Pausing broadcast.")
-            await asyncio.sleep(e.x)
-            await broadcast_msg.copy(chat_id=user_id) # Retry
-            success_count += 1
-        except (UserIsBlocked, InputUserDeactivated):
-            logger.info(f"User {user_id} blocked the bot. Skipping.")
-            fail_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {e}")
-            fail_count += 1
-        
-        # Avoid hitting API limits
-        if success_count % 100 == 0:
-            await asyncio.sleep(1)
-            
+    sent_msg = await message.reply_text("Starting broadcast...")
+    job = await broadcaster.start(
+        client, broadcast_msg.chat.id, broadcast_msg.id, sent_msg.chat.id, sent_msg.id
+    )
     await sent_msg.edit_text(
-        f"**Broadcast Complete**\n\n"
-        f"Sent to: `{success_count}` users\n"
-        f"Failed for: `{fail_count}` users"
+        job.render() + f"\n\nSend `/broadcast_cancel {job.id}` to stop it."
     )
 
+@Client.on_message(filters.command("broadcast_cancel") & admin_filter & filters.private)
+async def broadcast_cancel_command(client: Client, message: Message):
+    """Stops a running broadcast."""
+    args = message.text.split()
+    if len(args) < 2 or not args[1].isdigit():
+        running = ", ".join(f"`{bid}`" for bid in broadcaster.active) or "none"
+        await message.reply_text(f"Usage: `/broadcast_cancel <id>`\n\nRunning broadcasts: {running}")
+        return
+    if broadcaster.cancel(int(args[1])):
+        await message.reply_text(f"Broadcast `{args[1]}` will stop after the messages in flight.")
+    else:
+        await message.reply_text(f"Broadcast `{args[1]}` is not running.")
+
 # ... (other admin commands like grant_premium, ban, etc. - no changes)
 @Client.on_message(filters.command("grant_premium") & admin_filter & filters.private)
 async def grant_premium_command(client: Client, message: Message):
@@ -171,12 +210,225 @@ async def add_admin_command(client: Client, message: Message):
     await update_user_admin(user_id, True)
     await message.reply_text(f"User `{user_id}` is now an admin.")
     
-# --- NEW COMMAND ---
+@Client.on_message(filters.command("purge_cache") & admin_filter & filters.private)
+async def purge_cache_command(client: Client, message: Message):
+    """Purges the Telegram file_id cache: one link, expired entries, or everything."""
+    args = message.text.split()
+    if len(args) < 2:
+        size = await get_media_cache_size()
+        await message.reply_text(
+            f"Media cache holds `{size}` entries.\n\n"
+            "Usage: `/purge_cache <instagram link | key | expired | all>`"
+        )
+        return
+
+    target = args[1]
+    if target == "all":
+        removed = await purge_media_cache()
+    elif target == "expired":
+        removed = await purge_media_cache(expired_only=True)
+    else:
+        link = parse_link(target)
+        media_key = link.key if link else target
+        removed = await purge_media_cache(media_key)
+    await message.reply_text(f"Removed `{removed}` cache entries.")
+
+@Client.on_message(filters.command("spool") & admin_filter & filters.private)
+async def spool_command(client: Client, message: Message):
+    """Shows download spool usage. `/spool sweep` or `/spool clear` frees space."""
+    args = message.text.split()
+    action = args[1] if len(args) > 1 else ""
+    if action == "sweep":
+        removed = await spool.sweep()
+        await message.reply_text(f"Sweep removed `{removed}` directories.")
+        return
+    if action == "clear":
+        removed = await spool.clear_idle()
+        await message.reply_text(f"Removed `{removed}` idle downloads.")
+        return
+
+    stats = spool.stats()
+    await message.reply_text(
+        f"**Download Spool**\n\n"
+        f"Disk: `{stats['usage'] / 1024 ** 2:.1f} MB` of `{stats['quota'] / 1024 ** 2:.0f} MB`\n"
+        f"Memory: `{stats['memory'] / 1024 ** 2:.1f} MB` of `{stats['memory_quota'] / 1024 ** 2:.0f} MB`\n"
+        f"Active Jobs: `{stats['active']}` | Idle (reusable): `{stats['idle']}`\n"
+        f"Reuse Hits: `{stats['reuse_hits']}`\n"
+        f"Evictions: `{stats['evictions']}` | Orphans Removed: `{stats['orphans_removed']}`\n\n"
+        "Usage: `/spool [sweep | clear]`"
+    )
+
+@Client.on_message(filters.command("sessions") & admin_filter & filters.private)
+async def sessions_command(client: Client, message: Message):
+    """Shows the Instagram sessions. `/sessions check` re-checks the account logins now."""
+    args = message.text.split()
+    await engine.ready()
+    session_pool = engine.session_pool
+    if len(args) > 1 and args[1] == "check":
+        await message.reply_text("Checking Instagram logins...")
+        await session_pool.check_all()
+
+    lines = ["**Instagram Sessions**", ""]
+    for s in session_pool.stats():
+        checked = f"{(time.time() - s['last_checked']) / 60:.0f} min ago" if s['last_checked'] else "never"
+        line = (
+            f"`{s['name']}`: {s['state']}, checked {checked}\n"
+            f"    budget `{s['budget_left']}`, cooldown `{s['cooldown']:.0f}s`, "
+            f"`{s['rate_limited']}` rate limits, `{s['jobs']}` jobs"
+        )
+        if s['last_error']:
+            line += f"\n    last error: `{s['last_error'][:200]}`"
+        lines.append(line)
+    lines += ["", "Usage: `/sessions [check]`"]
+    await message.reply_text("\n".join(lines))
+
+@Client.on_message(filters.command("jobs") & admin_filter & filters.private)
+async def jobs_command(client: Client, message: Message):
+    """Shows the job journal: links by state and the worker nodes running them."""
+    stats = await job_queue.stats()
+    workers = stats.get("workers") or {}
+    lines = [
+        f"**Job Queue** (this node: `{NODE_ROLE}`)",
+        "",
+        f"Queued: `{stats.get('queued', 0)}` | Downloading: `{stats.get('downloading', 0)}` | "
+        f"Uploading: `{stats.get('uploading', 0)}`",
+        f"Done: `{stats.get('done', 0)}` | Failed: `{stats.get('failed', 0)}`",
+        f"Waited on by this node: `{stats['waiting_here']}`",
+        "",
+        f"**Busy Workers:** `{len(workers)}`",
+    ]
+    lines += [f"`{name}`: {count} running" for name, count in sorted(workers.items())]
+    await message.reply_text("\n".join(lines))
+
+# Stages in pipeline order; anything else is listed after them
+PERF_STAGES = ("db", "cache_lookup", "queue", "worker", "inflight_wait", "resolve", "download",
+               "upload_cached", "upload", "cleanup", "total")
+
+@Client.on_message(filters.command("perf") & admin_filter & filters.private)
+async def perf_command(client: Client, message: Message):
+    """
+    Per-stage latency of recent links: `/perf [minutes]`.
+    `/perf profile on|off` switches the sampling profiler.
+    """
+    args = message.text.split()
+    if len(args) > 1 and args[1] == "profile":
+        await _profile_command(message, args[2] if len(args) > 2 else "")
+        return
+
+    window = float(args[1]) * 60 if len(args) > 1 and args[1].isdigit() else PERF_WINDOW
+    percentiles = tracer.stage_percentiles(window)
+    if not percentiles:
+        await message.reply_text(f"No links were processed in the last {window / 60:.0f} minutes.")
+        return
+
+    stages = [s for s in PERF_STAGES if s in percentiles]
+    stages += sorted(s for s in percentiles if s not in PERF_STAGES)
+    lines = [f"**Performance (last {window / 60:.0f} min, {percentiles['total'][3]} links)**", "",
+             "`stage: p50 / p95 / p99 (n)`"]
+    for stage in stages:
+        p50, p95, p99, n = percentiles[stage]
+        lines.append(f"`{stage}: {p50:.2f}s / {p95:.2f}s / {p99:.2f}s ({n})`")
+
+    lines += ["", "**Slowest Links**"]
+    for trace in tracer.slowest(window):
+        breakdown = ", ".join(
+            f"{stage} {seconds:.1f}s" for stage, seconds in trace.stage_totals().items()
+        )
+        lines.append(
+            f"`{trace.trace_id}` {trace.total:.1f}s {trace.outcome} - {trace.url}\n    {breakdown}"
+        )
+    if profiler.running:
+        lines += ["", f"Profiler running ({profiler.samples} samples)."]
+    await message.reply_text("\n".join(lines), disable_web_page_preview=True)
+
+async def _profile_command(message: Message, action: str):
+    if action == "on":
+        # Handlers run on the event loop thread, so this samples the loop
+        profiler.start()
+        await message.reply_text("Sampling profiler started. Send `/perf profile off` to see the results.")
+        return
+    if action != "off":
+        state = "running" if profiler.running else "stopped"
+        await message.reply_text(f"Profiler is {state}.\n\nUsage: `/perf profile on|off`")
+        return
+
+    profiler.stop()
+    if not profiler.samples:
+        await message.reply_text("The profiler has no samples.")
+        return
+    lines = [f"**Profile ({profiler.samples} samples)**", "", "`self% total% function`"]
+    for name, own, total in profiler.top():
+        lines.append(f"`{own / profiler.samples:5.1%} {total / profiler.samples:5.1%} {name}`")
+    await message.reply_text("\n".join(lines))
+
+    fd, path = tempfile.mkstemp(prefix=f"profile_{int(profiler.started_at)}_", suffix=".folded")
+    os.close(fd)
+    try:
+        await fs_executor.run(_write_text, path, profiler.collapsed())
+        await message.reply_document(path, caption="Collapsed stacks (flamegraph.pl / speedscope).")
+    finally:
+        os.remove(path)
+
+def _write_text(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+LOG_TAIL_LINES = 200
+LOG_DURATION_RE = re.compile(r"^(\d+)([mhd])$")
+LOG_DURATION_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+
+def _parse_log_range(args: list) -> tuple | None:
+    """(start, end) for `/log 30m` or `/log <start> [end]` with ISO times; None if not a range."""
+    now = datetime.now()
+    match = LOG_DURATION_RE.match(args[0])
+    if match:
+        amount, unit = match.groups()
+        return now - timedelta(**{LOG_DURATION_UNITS[unit]: int(amount)}), now
+    try:
+        start = datetime.fromisoformat(args[0])
+        end = datetime.fromisoformat(args[1]) if len(args) > 1 else now
+    except ValueError:
+        return None
+    return start, end
+
+def _write_tail(count: int, path: str) -> int:
+    lines = tail_log(count)
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    return len(lines)
+
 @Client.on_message(filters.command("log") & admin_filter & filters.private)
 async def send_log_command(client: Client, message: Message):
-    """Sends the bot's log file to the admin."""
-    LOG_FILE = "bot_logs.log"
-    if os.path.exists(LOG_FILE):
-        await message.reply_document(LOG_FILE, caption="Here is the bot's log file.")
-    else:
-        await message.reply_text("Log file not found.")
+    """
+    Sends part of the bot's log: `/log [lines]` for the tail, `/log 30m` (m/h/d)
+    or `/log <start> [end]` (e.g. 2025-01-31T14:00) for a time range.
+    """
+    args = message.text.split()[1:]
+    fd, path = tempfile.mkstemp(prefix="bot_logs_", suffix=".log")
+    os.close(fd)
+    try:
+        if not args or args[0].isdigit():
+            count = int(args[0]) if args else LOG_TAIL_LINES
+            written = await fs_executor.run(_write_tail, count, path)
+            caption = f"Last {written} log lines."
+        else:
+            time_range = _parse_log_range(args)
+            if time_range is None:
+                await message.reply_text(
+                    "Usage: `/log [lines]`, `/log 30m` (m/h/d) or `/log <start> [end]` "
+                    "with times like `2025-01-31T14:00`."
+                )
+                return
+            start, end = time_range
+            written, truncated = await fs_executor.run(
+                export_log_range, start, end, path, LOG_EXPORT_MAX_BYTES
+            )
+            caption = f"{written} log lines from {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}."
+            if truncated:
+                caption += f" Truncated at {LOG_EXPORT_MAX_BYTES // 1024 ** 2} MB; narrow the range for more."
+        if not written:
+            await message.reply_text("No log lines found.")
+            return
+        await message.reply_document(path, caption=caption)
+    finally:
+        os.remove(path)
@@ -1,31 +1,481 @@
-import re
+import time
+import asyncio
 import logging
+import weakref
+from collections import deque
 from pyrogram import Client, filters
-from pyrogram.types import Message, InputMediaPhoto, InputMediaVideo
-from config import FREE_USER_DOWNLOAD_LIMIT
-from Database.db import (
-    get_user, add_user, increment_download_count, get_daily_download_count
+from pyrogram.types import Message, Chat, InputMediaPhoto, InputMediaVideo
+from pyrogram.enums import ChatType
+from config import (
+    FREE_USER_DOWNLOAD_LIMIT, MAX_PARALLEL_LINKS_PER_MESSAGE, MAX_PARALLEL_DOWNLOADS_PER_USER,
+    NODE_ROLE, JOB_RESUME_WINDOW
 )
-from downloader import (
-    INSTA_REGEX, download_media, cleanup_directory
+from Database.db import (
+    get_user, get_or_create_user, get_cached_media, save_cached_media,
+    touch_cached_media, purge_media_cache
 )
+from Database.quota import quota
+from Database.stats import download_stats
+from engine import engine
+from jobqueue import job_queue
+from links import InstagramLink, message_links, parse_link
+from scheduler import scheduler, priority_for
+from media_fetcher import MediaBuffer
+from metrics import messages_received, links_received, link_outcomes, telegram_upload_seconds
+from tracing import Trace, tracer, activate
 
 logger = logging.getLogger(__name__)
 
-# This regex finds all URLs in a message
-URL_REGEX = r"https?:\/\/(www\.)?instagram\.com\/(?:p|reel|tv|stories|s)\/[a-zA-Z0-9_.-]+\/?"
+LIMIT_REACHED_TEXT = (
+    f"You have reached your daily limit of {FREE_USER_DOWNLOAD_LIMIT} downloads.\n"
+    "Please /upgrade for unlimited downloads."
+)
+RESTARTING_TEXT = (
+    "The bot is restarting. Your link(s) are saved and will be sent as soon as it is back."
+)
+RESTART_FAILED_TEXT = "The bot was restarted before this link was finished. Please send it again."
+CAPTION_FOOTER = "\n\nDownloaded via @YourBotUsername"
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Ingress nodes hand every link to the worker nodes instead of downloading it
+DISPATCH_TO_WORKERS = NODE_ROLE == "ingress"
+
+
+# --- Sending Helpers ---
+
+def _sent_file_ids(sent) -> list:
+    """Collects [{"type", "file_id"}] from the message(s) returned by a reply_* call."""
+    messages = sent if isinstance(sent, list) else [sent]
+    items = []
+    for msg in messages:
+        if msg.video:
+            items.append({"type": "video", "file_id": msg.video.file_id})
+        elif msg.photo:
+            items.append({"type": "photo", "file_id": msg.photo.file_id})
+    return items
+
+async def send_media_items(message: Message, items: list, caption: str, source: str = "upload"):
+    """
+    Sends media given as (type, file) pairs, where file is a path or a file_id.
+    Returns the Telegram file_ids of what was sent, in album order.
+    """
+    with telegram_upload_seconds.labels(source).time():
+        return await _send_media_items(message, items, caption)
+
+async def _send_media_items(message: Message, items: list, caption: str):
+    final_caption = (caption or "") + CAPTION_FOOTER
+    if len(items) == 1:
+        media_type, media = items[0]
+        if media_type == "video":
+            sent = await message.reply_video(media, caption=final_caption)
+        else:
+            sent = await message.reply_photo(media, caption=final_caption)
+    else:
+        media_group = []
+        for j, (media_type, media) in enumerate(items):
+            # Add caption only to the first item in the group
+            item_caption = final_caption if j == 0 else None
+            if media_type == "video":
+                media_group.append(InputMediaVideo(media, caption=item_caption))
+            else:
+                media_group.append(InputMediaPhoto(media, caption=item_caption))
+        sent = await message.reply_media_group(media_group)
+    return _sent_file_ids(sent)
+
+async def send_from_cache(message: Message, media_key: str, cached: dict) -> bool:
+    """Re-sends a previously uploaded post by file_id. Returns True on success."""
+    try:
+        items = [(item["type"], item["file_id"]) for item in cached["items"]]
+        await send_media_items(message, items, cached["caption"], source="cached")
+    except Exception as e:
+        # The file_ids are no longer valid; drop them and download again
+        logger.warning(f"Cached file_ids for {media_key} failed, purging: {e}")
+        await purge_media_cache(media_key)
+        return False
+    await touch_cached_media(media_key)
+    return True
+
+def _media_items(media_files: list) -> list:
+    """
+    Turns downloaded media (file paths or streamed MediaBuffers) into
+    (type, file) pairs for sending, skipping unknown files.
+    """
+    items = []
+    for media in media_files:
+        if isinstance(media, MediaBuffer):
+            items.append((media.media_type, media.open()))
+        elif media.endswith(VIDEO_EXTENSIONS):
+            items.append(("video", media))
+        elif media.endswith(PHOTO_EXTENSIONS):
+            items.append(("photo", media))
+    return items
+
+
+# --- Link Pipeline ---
+# Up to MAX_PARALLEL_LINKS_PER_MESSAGE links of a message are fetched ahead
+# while earlier ones are uploaded; results are still sent in link order.
+# A per-user semaphore caps downloads across all messages of one user.
+
+_user_slots = weakref.WeakValueDictionary()
+
+def _user_semaphore(user_id: int) -> asyncio.Semaphore:
+    sem = _user_slots.get(user_id)
+    if sem is None:
+        sem = asyncio.Semaphore(MAX_PARALLEL_DOWNLOADS_PER_USER)
+        _user_slots[user_id] = sem
+    return sem
+
+
+class LinkProgress:
+    """One aggregated, rate-limited progress message for all links of a message."""
+
+    EDIT_INTERVAL = 2  # Seconds between edits, to stay clear of FloodWait
+
+    def __init__(self, sent_msg: Message, total: int):
+        self.sent_msg = sent_msg
+        self.total = total
+        self.queued_jobs = []  # Scheduler jobs of this message that haven't started
+        self.downloading = 0
+        self.sent = 0
+        self.failed = 0
+        self._last_edit = 0.0
+
+    def render(self) -> str:
+        done = self.sent + self.failed
+        text = (
+            f"Processing {self.total} link(s)... ({done}/{self.total} done)\n"
+            f"Downloading: {self.downloading} | Sent: {self.sent} | Failed: {self.failed}"
+        )
+        self.queued_jobs = [job for job in self.queued_jobs if not job.started]
+        if self.queued_jobs:
+            position = min(scheduler.position(job) for job in self.queued_jobs)
+            text += f"\nQueued: {len(self.queued_jobs)} (position {position + 1} in queue)"
+        return text
+
+    async def update(self, force: bool = False):
+        now = time.monotonic()
+        if self.sent_msg is None:
+            return  # Worker nodes; the ingress node owns the progress message
+        if not force and now - self._last_edit < self.EDIT_INTERVAL:
+            return
+        self._last_edit = now
+        try:
+            await self.sent_msg.edit_text(self.render())
+        except Exception:
+            pass # Edits are best effort (e.g. MessageNotModified)
+
+
+async def prepare_link(link: InstagramLink, user: dict, progress: LinkProgress, trace: Trace) -> dict:
+    """
+    Fetch stage of the pipeline: looks up the file_id cache and otherwise
+    downloads the media. Does not send anything.
+    """
+    result = {"link": link, "url": link.url, "media_key": link.key, "cached": None, "trace": trace}
+    with trace.span("cache_lookup"):
+        result["cached"] = await get_cached_media(link.key)
+    if result["cached"]:
+        return result
+    await download_link(result, user, progress)
+    return result
+
+async def _tracked_download(link: InstagramLink, user_id: int, progress: LinkProgress, trace: Trace):
+    """Runs on a scheduler worker; keeps the progress counters in sync."""
+    progress.downloading += 1
+    # Don't hold the worker while Telegram edits the message
+    asyncio.create_task(progress.update())
+    try:
+        # The downloader records its stages on this link's trace
+        with activate(trace):
+            return await engine.downloader.download_media(link, user_id)
+    finally:
+        progress.downloading -= 1
+
+async def download_link(result: dict, user: dict, progress: LinkProgress):
+    """Downloads the media for a pipeline entry through the global scheduler."""
+    user_id, trace = user['user_id'], result["trace"]
+    if engine.downloader.is_inflight(result["link"]):
+        # Someone is already fetching this media; wait for it without a worker
+        with trace.span("inflight_wait"):
+            media_files, caption, target_dir, error = await engine.downloader.download_media(result["link"], user_id)
+        result.update(media_files=media_files, caption=caption, target_dir=target_dir, error=error)
+        return
+
+    async with _user_semaphore(user_id):
+        job = scheduler.submit(
+            user_id, priority_for(user), _tracked_download, result["link"], user_id, progress, trace
+        )
+        if not job.started:
+            progress.queued_jobs.append(job)
+            await progress.update()
+        try:
+            media_files, caption, target_dir, error = await job.future
+        finally:
+            if job.started:
+                trace.add("queue", job.started_at - job.enqueued_at)
+    result.update(media_files=media_files, caption=caption, target_dir=target_dir, error=error)
+
+def _failed_result(link: InstagramLink, trace: Trace, error: Exception) -> dict:
+    """Pipeline entry for a link whose fetch stage raised."""
+    logger.error(f"[{trace.trace_id}] Failed to process {link.url}: {error}")
+    return {"link": link, "url": link.url, "media_key": link.key, "cached": None,
+            "trace": trace, "target_dir": None,
+            "error": f"An unexpected error occurred: {error}"}
+
+async def deliver_link(message: Message, result: dict, user: dict, progress: LinkProgress) -> bool:
+    """Upload stage of the pipeline. Returns True if the media was sent."""
+    url, media_key, trace = result["url"], result["media_key"], result["trace"]
+
+    if result.get("remote"):
+        # A worker node sent it, or told the user why not, unless none finished it
+        if result["error"]:
+            await message.reply_text(f"Failed to download {url}:\n`{result['error']}`")
+            await job_queue.mark_notified([result["job_id"]])
+        return result["sent"]
+
+    # Serve repeat links from Telegram's servers without downloading again
+    if result["cached"]:
+        with trace.span("upload_cached"):
+            sent = await send_from_cache(message, media_key, result["cached"])
+        if sent:
+            return True
+        await download_link(result, user, progress)
+
+    if result["error"]:
+        await message.reply_text(f"Failed to download {url}:\n`{result['error']}`")
+        if result["target_dir"]:
+            with trace.span("cleanup"):
+                await engine.downloader.cleanup_directory(result["target_dir"])
+        return False
+
+    # Send the media
+    try:
+        items = _media_items(result["media_files"])
+        if not items:
+            await message.reply_text(f"Download complete for {url}, but no media was found to send.")
+            return False
+
+        caption = result["caption"]
+        with trace.span("upload"):
+            file_ids = await send_media_items(message, items, caption)
+        if len(file_ids) == len(items):
+            try:
+                await save_cached_media(media_key, caption or "", file_ids)
+            except Exception as e:
+                logger.error(f"Failed to cache file_ids for {media_key}: {e}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to send media for {url}: {e}")
+        await message.reply_text(f"Failed to send media for {url}.\n`{e}`")
+        return False
+    finally:
+        # Clean up files
+        with trace.span("cleanup"):
+            await engine.downloader.cleanup_directory(result["target_dir"])
+
+
+# --- Job Journal ---
+# Every accepted link is a row in the jobs table (see jobqueue.py) until it
+# is done or failed, so the next start can resume what a restart or crash
+# interrupted. Links are journaled as queued when their message is accepted,
+# so those still waiting behind MAX_PARALLEL_LINKS_PER_MESSAGE survive too.
+# On SIGTERM drain() stops new work, gives the links in progress
+# SHUTDOWN_DRAIN_TIMEOUT to finish and leaves links arriving meanwhile to the
+# next start.
+
+# Resolves once links in progress are done -> task to cancel if the drain times out
+_active = {}
+_draining = False
+
+def _job_payload(link: InstagramLink, chat_id: int, message_id: int, user: dict, trace: Trace) -> dict:
+    return {
+        "url": link.url, "user_id": user['user_id'], "is_premium": user.get('is_premium', False),
+        "chat_id": chat_id, "message_id": message_id, "trace_id": trace.trace_id,
+    }
+
+def _track(task: asyncio.Task) -> asyncio.Task:
+    """Lets drain() wait for the task."""
+    _active[task] = task
+    task.add_done_callback(lambda done: _active.pop(done, None))
+    return task
+
+def _record_outcome(kind: str, sent: bool, user_id: int, is_premium: bool):
+    """Books a finished link on the quota, the statistics and the metrics."""
+    if sent:
+        quota.record_download()
+    else:
+        quota.release(user_id, is_premium)
+    download_stats.record(kind, sent)
+    link_outcomes.labels(kind, "success" if sent else "failure").inc()
 
+async def fetch_link(link: InstagramLink, job_id: int | None, user: dict,
+                     progress: LinkProgress, trace: Trace) -> dict:
+    """prepare_link() for a link accept_links() journaled, moving it to downloading first."""
+    await job_queue.mark(job_id, "downloading")
+    try:
+        result = await prepare_link(link, user, progress, trace)
+    except Exception as e:
+        result = _failed_result(link, trace, e)
+    result["job_id"] = job_id
+    return result
+
+async def accept_links(message: Message, user: dict, links: list) -> tuple:
+    """
+    Reserves a quota slot for each link and journals it as queued; the slot
+    is kept until the link is done or failed, also across a restart.
+    Returns: ([(link, trace, job_id)], limit_reached). job_id is None if the
+    journal refused the link.
+    """
+    accepted = []
+    for link in links:
+        # Take a quota slot before downloading so parallel links can't overshoot
+        if not await quota.reserve(user['user_id'], user.get('is_premium', False)):
+            return accepted, True
+        trace = tracer.start(link.url, user['user_id'])
+        payload = _job_payload(link, message.chat.id, message.id, user, trace)
+        accepted.append((link, trace, await job_queue.record(payload, priority_for(user))))
+    return accepted, False
+
+async def drain(timeout: float):
+    """Stops taking new links and waits up to `timeout` seconds for those in progress."""
+    global _draining
+    _draining = True
+    if not _active:
+        return
+    logger.info(f"Draining: waiting up to {timeout:.0f}s for {len(_active)} tasks with links in progress.")
+    _, unfinished = await asyncio.wait(list(_active), timeout=timeout)
+    if unfinished:
+        # Their links stay in the journal and are resumed on the next start
+        logger.warning(f"{len(unfinished)} tasks still had links in progress; they resume on the next start.")
+        for done in unfinished:
+            task = _active.get(done)
+            if task is not None:
+                task.cancel()
+        await asyncio.wait(unfinished)
+
+async def _report_failure(client: Client, job: dict, error: str):
+    """Tells the user a journaled link failed, then books it."""
+    payload = job["payload"]
+    try:
+        await client.send_message(payload["chat_id"], f"Failed to download {payload['url']}:\n`{error}`")
+    except Exception as e:
+        logger.warning(f"Could not tell user {payload['user_id']} about job {job['job_id']}: {e}")
+    await job_queue.finish(job["job_id"], "failed", error)
+    await _book_replayed(job, False)
+
+async def _book_replayed(job: dict, sent: bool):
+    payload = job["payload"]
+    if not sent:
+        # release() only adjusts counters that are loaded
+        await quota.get_daily_count(payload["user_id"])
+    _record_outcome(parse_link(payload["url"]).kind, sent, payload["user_id"], payload.get("is_premium", False))
+
+async def resume_link_job(client: Client, job: dict):
+    """Downloads and sends a link the last run left unfinished."""
+    try:
+        sent = await run_link_job(client, job)
+    except Exception as e:
+        logger.error(f"Resuming job {job['job_id']} failed: {e}")
+        await _report_failure(client, job, f"An unexpected error occurred: {e}")
+        return
+    await job_queue.finish(job["job_id"], "done" if sent else "failed")
+    await _book_replayed(job, sent)
+
+async def follow_remote_job(client: Client, job: dict):
+    """Ingress side: waits for a job queued before a restart and books its outcome."""
+    outcome = await job_queue.wait(job["job_id"])
+    if outcome["state"] == "failed" and not outcome["notified"]:
+        await _report_failure(client, job, outcome["error"])
+    else:
+        await _book_replayed(job, outcome["state"] == "done")
+
+async def replay_journal(client: Client):
+    """
+    Picks up the links the last run left unfinished: resumes them (or hands
+    them to the workers on an ingress node), tells users about failures they
+    never heard of, and gives up on links older than JOB_RESUME_WINDOW.
+    """
+    for job in await job_queue.unreported():
+        await _report_failure(client, job, job["error"])
+
+    resumed = stale = 0
+    for job in await job_queue.unfinished():
+        if job["lease_until"] is None and time.time() - job["created_at"] > JOB_RESUME_WINDOW:
+            await _report_failure(client, job, RESTART_FAILED_TEXT)
+            stale += 1
+            continue
+        if DISPATCH_TO_WORKERS:
+            _track(asyncio.create_task(follow_remote_job(client, job)))
+        elif job["lease_until"] is None:
+            # Leased jobs belong to a worker node
+            _track(asyncio.create_task(resume_link_job(client, job)))
+        else:
+            continue
+        resumed += 1
+    if DISPATCH_TO_WORKERS:
+        await job_queue.requeue_unleased()
+    if resumed or stale:
+        logger.info(f"Journal replay: resuming {resumed} unfinished links, {stale} too old to resume.")
+
+
+# --- Worker Nodes ---
+# With NODE_ROLE=ingress each link becomes a job in the job queue. A worker
+# node runs the same fetch and upload stages for it and replies in the
+# user's chat itself; the ingress only keeps the quota, stats and progress.
+
+async def dispatch_link(link: InstagramLink, job_id: int | None, trace: Trace) -> dict:
+    """Ingress side: waits until a worker has handled a link accept_links() queued."""
+    if job_id is None:
+        raise RuntimeError("Could not queue the link for the workers.")
+    with trace.span("worker"):
+        outcome = await job_queue.wait(job_id)
+    unreported = outcome["state"] == "failed" and not outcome["notified"]
+    return {"link": link, "url": link.url, "media_key": link.key, "cached": None, "trace": trace,
+            "target_dir": None, "remote": True, "job_id": outcome["job_id"],
+            "sent": outcome["state"] == "done", "error": outcome["error"] if unreported else None}
+
+def _reply_target(client: Client, chat_id: int, message_id: int) -> Message:
+    """A stand-in for the user's message, so the pipeline's reply_* calls work on a worker."""
+    return Message(client=client, id=message_id, chat=Chat(id=chat_id, type=ChatType.PRIVATE))
+
+async def run_link_job(client: Client, job: dict) -> bool:
+    """
+    Worker side (and resumed links): fetches and sends one journaled link.
+    Returns True if it was sent.
+    """
+    payload = job["payload"]
+    link = parse_link(payload["url"])
+    user = await get_user(payload["user_id"]) or {"user_id": payload["user_id"]}
+    message = _reply_target(client, payload["chat_id"], payload["message_id"])
+    trace = tracer.start(link.url, user['user_id'], payload["trace_id"])
+    progress = LinkProgress(None, 1)
+    await engine.ready()
+    try:
+        result = await prepare_link(link, user, progress, trace)
+    except Exception as e:
+        result = _failed_result(link, trace, e)
+    await job_queue.mark(job["job_id"], "uploading")
+    sent = await deliver_link(message, result, user, progress)
+    tracer.finish(trace, "success" if sent else "failure")
+    return sent
+
+
+def _has_instagram_links(_, __, message: Message) -> bool:
+    """Parses the message once; the handler reads the result from message.instagram_links."""
+    message.instagram_links = message_links(message)
+    return bool(message.instagram_links)
+
+instagram_links = filters.create(_has_instagram_links)
 
-@Client.on_message(filters.regex(INSTA_REGEX) & filters.private)
+
+@Client.on_message(instagram_links & filters.private)
 async def handle_insta_link(client: Client, message: Message):
     """Main handler for processing Instagram links."""
     user_id = message.from_user.id
+    checks_started = time.perf_counter()
     
     # 1. Check user in DB
-    user = await get_user(user_id)
-    if not user:
-        await add_user(user_id)
-        user = await get_user(user_id)
+    user = await get_or_create_user(user_id)
     
     # 2. Check if banned
     if user.get('is_banned', False):
@@ -33,85 +483,110 @@ async def handle_insta_link(client: Client, message: Message):
         return
         
     # 3. Check download limit for free users
+    # Slots are reserved per link below; this only avoids replying "Processing..."
     is_premium = user.get('is_premium', False)
-    if not is_premium:
-        daily_count = await get_daily_download_count(user_id)
-        if daily_count >= FREE_USER_DOWNLOAD_LIMIT:
-            await message.reply_text(
-                f"You have reached your daily limit of {FREE_USER_DOWNLOAD_LIMIT} downloads.\n"
-                "Please /upgrade for unlimited downloads."
-            )
-            return
+    if await quota.remaining(user_id, is_premium) == 0:
+        await message.reply_text(LIMIT_REACHED_TEXT)
+        return
+    # Shared by every link of the message; recorded on each link's trace
+    db_check_time = time.perf_counter() - checks_started
 
-    # Find all Instagram links in the message
-    urls = re.findall(URL_REGEX, message.text)
-    if not urls:
-        # This should not happen if INSTA_REGEX matched, but as a safeguard.
+    # Instagram links in the message, normalised and without duplicates
+    links = getattr(message, "instagram_links", None) or message_links(message)
+    messages_received.inc()
+    for link in links:
+        links_received.labels(link.kind).inc()
+    if not links:
+        # This should not happen if the filter matched, but as a safeguard.
         await message.reply_text("No valid Instagram links found.")
         return
-        
-    sent_msg = await message.reply_text(f"Found {len(urls)} link(s). Processing...")
-    
-    download_success_count = 0
-    
-    for i, url in enumerate(urls):
-        url = url[0] if isinstance(url, tuple) else url # Ensure url is a string
-        if not url.startswith("http"):
-            url = "https://" + url
 
-        await sent_msg.edit_text(f"Downloading link {i+1}/{len(urls)}...\n{url}")
-        
-        media_files, caption, target_dir, error = await download_media(url, user_id)
-        
-        if error:
-            await message.reply_text(f"Failed to download {url}:\n`{error}`")
-            await cleanup_directory(target_dir)
-            continue
-            
-        # Send the media
+    accepted, limit_reached = await accept_links(message, user, links)
+    if _draining:
+        # Journaled; the next start sends them
+        if limit_reached:
+            await message.reply_text(LIMIT_REACHED_TEXT)
+        if any(job_id is not None for _, _, job_id in accepted):
+            await message.reply_text(RESTARTING_TEXT)
+        return
+
+    sent_msg = await message.reply_text(f"Found {len(links)} link(s). Processing...")
+    progress = LinkProgress(sent_msg, len(links))
+
+    # Only waits right after a restart, while the engine is still loading
+    if not DISPATCH_TO_WORKERS:
         try:
-            media_group = []
-            final_caption = (caption or "") + "\n\nDownloaded via @YourBotUsername"
-
-            for j, file_path in enumerate(media_files):
-                # Add caption only to the first item in the group
-                item_caption = final_caption if j == 0 else None
-                
-                if file_path.endswith(('.mp4', '.mov', '.avi')):
-                    media_group.append(InputMediaVideo(file_path, caption=item_caption))
-                elif file_path.endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                    media_group.append(InputMediaPhoto(file_path, caption=item_caption))
-
-            if media_group:
-                if len(media_group) > 1:
-                    await message.reply_media_group(media_group)
-                else:
-                    # Send as single file if not a group
-                    if media_files[0].endswith(('.mp4', '.mov', '.avi')):
-                         await message.reply_video(media_files[0], caption=final_caption)
-                    else:
-                         await message.reply_photo(media_files[0], caption=final_caption)
-                
+            await engine.ready()
+        except Exception as e:
+            logger.error(f"Download engine unavailable: {e}")
+            await sent_msg.edit_text("The downloader is starting up. Please try again in a moment.")
+            return
+
+    pending = deque()  # (link, trace, task) in link order
+    remaining_links = iter(accepted)
+
+    def start_next() -> bool:
+        """Starts fetching the next accepted link."""
+        link, trace, job_id = next(remaining_links, (None, None, None))
+        if link is None:
+            return False
+        trace.add("db", db_check_time)
+        if DISPATCH_TO_WORKERS:
+            stage = dispatch_link(link, job_id, trace)
+        else:
+            stage = fetch_link(link, job_id, user, progress, trace)
+        pending.append((link, trace, asyncio.create_task(stage)))
+        return True
+
+    # drain() waits for the links, not for the final status message. Handlers
+    # run on Pyrogram's long-lived worker tasks, so it waits on a future
+    links_done = asyncio.get_running_loop().create_future()
+    _active[links_done] = asyncio.current_task()
+    download_success_count = 0
+    try:
+        for _ in range(MAX_PARALLEL_LINKS_PER_MESSAGE):
+            if not start_next():
+                break
+
+        while pending:
+            link, trace, task = pending.popleft()
+            try:
+                result = await task
+            except Exception as e:
+                result = _failed_result(link, trace, e)
+            # Start fetching the next link before uploading this one
+            start_next()
+
+            # Worker nodes keep the journal of dispatched links themselves
+            journaled = not result.get("remote")
+            if journaled:
+                await job_queue.mark(result.get("job_id"), "uploading")
+            sent = await deliver_link(message, result, user, progress)
+            if journaled:
+                await job_queue.finish(result.get("job_id"), "done" if sent else "failed")
+            if sent:
                 download_success_count += 1
-                
-                # Increment download count if user is not premium
-                if not is_premium:
-                    await increment_download_count(user_id)
-                    
+                progress.sent += 1
             else:
-                await message.reply_text(f"Download complete for {url}, but no media was found to send.")
+                progress.failed += 1
+            _record_outcome(link.kind, sent, user_id, is_premium)
+            tracer.finish(trace, "success" if sent else "failure")
+            await progress.update()
+    finally:
+        # Only reached with pending tasks if the handler itself was cancelled.
+        # Their links stay journaled and keep their quota slots until resumed
+        for link, trace, task in pending:
+            task.cancel()
+        _active.pop(links_done, None)
+        links_done.set_result(None)
 
-        except Exception as e:
-            logger.error(f"Failed to send media for {url}: {e}")
-            await message.reply_text(f"Failed to send media for {url}.\n`{e}`")
-        finally:
-            # Clean up files
-            await cleanup_directory(target_dir)
+    if limit_reached:
+        await message.reply_text(LIMIT_REACHED_TEXT)
 
     # Final message
     try:
         if download_success_count > 0:
-            await sent_msg.edit_text(f"Successfully downloaded and sent media for {download_success_count}/{len(urls)} link(s).")
+            await sent_msg.edit_text(f"Successfully downloaded and sent media for {download_success_count}/{len(links)} link(s).")
             await asyncio.sleep(5)
             await sent_msg.delete()
         else:
@@ -0,0 +1 @@
+"""Offline benchmarks. See the Benchmarks section of README.md."""
@@ -0,0 +1,55 @@
+"""
+Compares two reports written by benchmarks.e2e or benchmarks.db_stress.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(value, prefix: str = "") -> dict:
+    """{"a.b.c": number} for every numeric leaf of a report."""
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}{key}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        flat[prefix.rstrip(".")] = value
+    return flat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--all", action="store_true", help="Also list unchanged metrics")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get("benchmark") != candidate.get("benchmark"):
+        sys.exit("The reports come from different benchmarks.")
+
+    config_changes = {
+        k: (baseline["config"].get(k), v) for k, v in candidate.get("config", {}).items()
+        if baseline.get("config", {}).get(k) != v
+    }
+    print(f"{baseline.get('revision')} -> {candidate.get('revision')}")
+    for key, (old, new) in config_changes.items():
+        print(f"  config {key}: {old} -> {new}  (runs are not like for like)")
+
+    old, new = flatten(baseline["results"]), flatten(candidate["results"])
+    width = max(map(len, new), default=0)
+    for key in sorted(new.keys() & old.keys()):
+        before, after = old[key], new[key]
+        if before == after and not args.all:
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{key:<{width}}  {before:>12g}  {after:>12g}  {change:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""
+Concurrency stress test of the database layer behind the link handler.
+
+Thousands of simulated users send messages with several links each and go
+through the same calls as handle_insta_link (user lookup or insert, limit
+check, one quota reservation per link, count on success), while an admin
+task reads stats and user pages and writes user rows. Everything runs
+against a temporary SQLite file. The report has ops/s, per-call latency,
+"database is locked" errors and a check that the final download counts
+match the simulated successes.
+
+Each design is one way of implementing those calls, so the current code can
+be compared with the per-call-connection code the bot started with, or
+with a new design added to DESIGNS:
+
+    python -m benchmarks.db_stress --design baseline --output before.json
+    python -m benchmarks.db_stress --design quota --output after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+import aiosqlite
+
+from benchmarks.e2e import percentiles, _git_revision
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--design", default="quota", help="One of: " + ", ".join(DESIGNS))
+    parser.add_argument("--users", type=int, default=2000, help="Concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=3, help="Messages per user")
+    parser.add_argument("--links", type=int, default=3, help="Links per message")
+    parser.add_argument("--parallel-links", type=int, default=4,
+                        help="Links of one message in flight at once")
+    parser.add_argument("--premium-ratio", type=float, default=0.2)
+    parser.add_argument("--existing-ratio", type=float, default=0.5,
+                        help="Fraction of users already in the database")
+    parser.add_argument("--failure-ratio", type=float, default=0.1,
+                        help="Fraction of downloads that fail and give their slot back")
+    parser.add_argument("--work-time", type=float, default=0.02,
+                        help="Mean simulated download time per link (seconds)")
+    parser.add_argument("--think-time", type=float, default=0.2,
+                        help="Mean pause between a user's messages (seconds)")
+    parser.add_argument("--admin-interval", type=float, default=0.05,
+                        help="Mean pause between admin operations (seconds)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra bot settings, e.g. --env DB_READER_CONNECTIONS=8")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def _is_lock_error(e: BaseException) -> bool:
+    return isinstance(e, sqlite3.OperationalError) and "locked" in str(e)
+
+
+class LockErrorLog(logging.Handler):
+    """Counts "database is locked" errors that db.py logs instead of raising."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        if "database is locked" in record.getMessage():
+            self.count += 1
+
+
+# --- Designs ---
+# A design runs the handler's database calls. check() runs once per message
+# and returns (is_banned, is_premium, has_quota_left); reserve() and finish()
+# run once per link. counts_premium says whether premium downloads show up in
+# users.download_count, totals_premium whether they add to total_downloads.
+
+class BaselineDesign:
+    """
+    The original Database/db.py: a new aiosqlite connection per call, default
+    journal mode, and a read-modify-write increment. The limit is checked
+    once per message and counted after each successful non-premium link,
+    as the original handler did (premium downloads weren't counted at all).
+    """
+
+    counts_premium = False
+    totals_premium = False
+
+    def __init__(self, path: str, limit: int):
+        self.path = path
+        self.limit = limit
+
+    async def setup(self):
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    is_premium BOOLEAN DEFAULT FALSE,
+                    is_admin BOOLEAN DEFAULT FALSE,
+                    is_banned BOOLEAN DEFAULT FALSE,
+                    join_date TEXT NOT NULL,
+                    download_count INTEGER DEFAULT 0,
+                    last_download_date TEXT
+                )
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS stats (
+                    stat_key TEXT PRIMARY KEY,
+                    value INTEGER DEFAULT 0
+                )
+            ''')
+            await db.execute("INSERT OR IGNORE INTO stats (stat_key, value) VALUES ('total_downloads', 0)")
+            await db.commit()
+
+    async def teardown(self):
+        pass
+
+    async def seed(self, users: list):
+        async with aiosqlite.connect(self.path) as db:
+            await db.executemany(
+                "INSERT INTO users (user_id, is_premium, join_date) VALUES (?, ?, ?)",
+                [(uid, premium, datetime.utcnow().isoformat()) for uid, premium in users]
+            )
+            await db.commit()
+
+    async def _get_user(self, user_id: int):
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    return dict(zip([d[0] for d in cursor.description], row))
+                return None
+
+    async def _add_user(self, user_id: int):
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute("INSERT OR IGNORE INTO users (user_id, join_date) VALUES (?, ?)",
+                             (user_id, datetime.utcnow().isoformat()))
+            await db.commit()
+
+    async def check(self, user_id: int, timer):
+        async with timer("get_user"):
+            user = await self._get_user(user_id)
+        if not user:
+            async with timer("add_user"):
+                await self._add_user(user_id)
+            async with timer("get_user"):
+                user = await self._get_user(user_id)
+        if user["is_premium"]:
+            return bool(user["is_banned"]), True, True
+        async with timer("daily_count"):
+            current = await self._get_user(user_id)
+        today = datetime.utcnow().date().isoformat()
+        count = current["download_count"] if current["last_download_date"] == today else 0
+        return bool(user["is_banned"]), False, count < self.limit
+
+    async def reserve(self, user_id: int, is_premium: bool, timer) -> bool:
+        return True
+
+    async def finish(self, user_id: int, is_premium: bool, success: bool, timer):
+        if not success or is_premium:
+            return
+        async with timer("increment"):
+            today = datetime.utcnow().date().isoformat()
+            async with aiosqlite.connect(self.path) as db:
+                user = await self._get_user(user_id)
+                count = user["download_count"] + 1 if user["last_download_date"] == today else 1
+                await db.execute(
+                    "UPDATE users SET download_count = ?, last_download_date = ? WHERE user_id = ?",
+                    (count, today, user_id)
+                )
+                await db.execute("UPDATE stats SET value = value + 1 WHERE stat_key = 'total_downloads'")
+                await db.commit()
+
+    async def admin_stats(self):
+        async with aiosqlite.connect(self.path) as db:
+            for query in ("SELECT COUNT(*) FROM users", "SELECT COUNT(*) FROM users WHERE is_premium = TRUE",
+                          "SELECT COUNT(*) FROM users WHERE is_banned = TRUE",
+                          "SELECT value FROM stats WHERE stat_key = 'total_downloads'"):
+                async with db.execute(query) as cursor:
+                    await cursor.fetchone()
+
+    async def admin_user_page(self):
+        async with aiosqlite.connect(self.path) as db:
+            async with db.execute("SELECT user_id FROM users WHERE is_banned = FALSE") as cursor:
+                await cursor.fetchall()
+
+    async def admin_write(self, user_id: int):
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute("UPDATE users SET is_admin = ? WHERE user_id = ?", (False, user_id))
+            await db.commit()
+
+
+class DirectDesign:
+    """
+    The current Database/db.py (connection pool, user cache) used without
+    the quota engine: every successful non-premium link writes its count
+    immediately, as the handler did before the quota engine.
+    """
+
+    counts_premium = False
+    totals_premium = False
+
+    def __init__(self, path: str, limit: int):
+        self.limit = limit
+
+    async def setup(self):
+        from Database.db import init_db
+        await init_db()
+
+    async def teardown(self):
+        from Database.db import close_db
+        await close_db()
+
+    async def seed(self, users: list):
+        from Database.db import get_pool
+        async with get_pool().writer() as db:
+            await db.executemany(
+                "INSERT INTO users (user_id, is_premium, join_date) VALUES (?, ?, ?)",
+                [(uid, premium, datetime.utcnow().isoformat()) for uid, premium in users]
+            )
+
+    async def check(self, user_id: int, timer):
+        from Database.db import get_or_create_user, get_daily_download_count
+        async with timer("get_or_create_user"):
+            user = await get_or_create_user(user_id)
+        if user["is_premium"]:
+            return bool(user["is_banned"]), True, True
+        async with timer("daily_count"):
+            count = await get_daily_download_count(user_id)
+        return bool(user["is_banned"]), False, count < self.limit
+
+    async def reserve(self, user_id: int, is_premium: bool, timer) -> bool:
+        return True
+
+    async def finish(self, user_id: int, is_premium: bool, success: bool, timer):
+        from Database.db import increment_download_count
+        if success and not is_premium:
+            async with timer("increment"):
+                await increment_download_count(user_id)
+
+    async def admin_stats(self):
+        from Database.db import get_bot_stats
+        await get_bot_stats()
+
+    async def admin_user_page(self):
+        from Database.db import get_broadcast_user_ids
+        await get_broadcast_user_ids(random.randrange(1000), 500)
+
+    async def admin_write(self, user_id: int):
+        from Database.db import update_user_admin
+        await update_user_admin(user_id, False)
+
+
+class QuotaDesign(DirectDesign):
+    """
+    What handle_insta_link does now: the connection pool and user cache plus
+    the in-memory quota engine, which reserves a slot per link and writes
+    counters in batches.
+    """
+
+    counts_premium = False
+    totals_premium = True
+
+    async def setup(self):
+        from Database.quota import quota
+        await super().setup()
+        quota.start()
+
+    async def teardown(self):
+        from Database.quota import quota
+        await quota.stop()
+        await super().teardown()
+
+    async def check(self, user_id: int, timer):
+        from Database.db import get_or_create_user
+        from Database.quota import quota
+        async with timer("get_or_create_user"):
+            user = await get_or_create_user(user_id)
+        async with timer("quota_remaining"):
+            remaining = await quota.remaining(user_id, user["is_premium"])
+        return bool(user["is_banned"]), bool(user["is_premium"]), remaining != 0
+
+    async def reserve(self, user_id: int, is_premium: bool, timer) -> bool:
+        from Database.quota import quota
+        async with timer("quota_reserve"):
+            return await quota.reserve(user_id, is_premium)
+
+    async def finish(self, user_id: int, is_premium: bool, success: bool, timer):
+        from Database.quota import quota
+        if success:
+            quota.record_download()
+        else:
+            quota.release(user_id, is_premium)
+
+
+DESIGNS = {
+    "baseline": BaselineDesign,
+    "direct": DirectDesign,
+    "quota": QuotaDesign,
+}
+
+
+# --- Run ---
+
+class Recorder:
+    """Times named calls and counts their errors."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.ops = 0
+        self.errors = {}
+        self.lock_errors = 0
+
+    def __call__(self, name: str):
+        return _Timed(self, name)
+
+
+class _Timed:
+
+    def __init__(self, recorder: Recorder, name: str):
+        self.recorder = recorder
+        self.name = name
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        recorder = self.recorder
+        recorder.ops += 1
+        recorder.latencies.setdefault(self.name, []).append(time.perf_counter() - self.started)
+        if isinstance(exc, Exception):
+            if _is_lock_error(exc):
+                recorder.lock_errors += 1
+            key = f"{self.name}: {type(exc).__name__}"
+            recorder.errors[key] = recorder.errors.get(key, 0) + 1
+        return False
+
+
+async def run_stress(args, path: str) -> dict:
+    from config import FREE_USER_DOWNLOAD_LIMIT
+    rng = random.Random(args.seed)
+    design = DESIGNS[args.design](path, FREE_USER_DOWNLOAD_LIMIT)
+    timer = Recorder()
+    lock_log = LockErrorLog()
+    logging.getLogger().addHandler(lock_log)
+
+    await design.setup()
+    premium = {uid: rng.random() < args.premium_ratio for uid in range(1, args.users + 1)}
+    await design.seed([(uid, p) for uid, p in premium.items() if rng.random() < args.existing_ratio])
+    # Users that are new to the database start as free users
+    is_free = {}
+
+    expected = {}  # user_id -> successes that count towards users.download_count
+    successes = 0
+    expected_total = 0  # Successes that count towards total_downloads
+    failed_messages = 0
+    finish_errors = 0  # finish() calls that raised, e.g. on "database is locked"
+    over_limit = set()
+
+    async def link(user_id: int, is_premium: bool) -> bool:
+        nonlocal successes, expected_total, finish_errors
+        if not await design.reserve(user_id, is_premium, timer):
+            return False
+        await asyncio.sleep(rng.expovariate(1 / args.work_time) if args.work_time else 0)
+        success = rng.random() >= args.failure_ratio
+        # The media was sent either way; if finish() fails the increment is lost
+        if success:
+            successes += 1
+            if design.totals_premium or not is_premium:
+                expected_total += 1
+            if design.counts_premium or not is_premium:
+                expected[user_id] = expected.get(user_id, 0) + 1
+        try:
+            await design.finish(user_id, is_premium, success, timer)
+        except Exception:
+            finish_errors += 1
+        return True
+
+    async def user(user_id: int):
+        nonlocal failed_messages
+        is_premium = premium[user_id]
+        for _ in range(args.messages):
+            await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+            try:
+                is_banned, is_premium, has_quota = await design.check(user_id, timer)
+                is_free[user_id] = not is_premium
+                if is_banned or not has_quota:
+                    continue
+                slots = asyncio.Semaphore(args.parallel_links)
+
+                async def limited():
+                    async with slots:
+                        return await link(user_id, is_premium)
+                await asyncio.gather(*(limited() for _ in range(args.links)))
+            except Exception:
+                failed_messages += 1
+            if not is_premium and expected.get(user_id, 0) > FREE_USER_DOWNLOAD_LIMIT:
+                over_limit.add(user_id)
+
+    async def admin():
+        operations = (design.admin_stats, design.admin_user_page,
+                      lambda: design.admin_write(rng.randrange(1, args.users + 1)))
+        names = ("admin_stats", "admin_user_page", "admin_write")
+        while True:
+            await asyncio.sleep(rng.expovariate(1 / args.admin_interval))
+            index = rng.randrange(len(operations))
+            try:
+                async with timer(names[index]):
+                    await operations[index]()
+            except Exception:
+                pass
+
+    admin_task = asyncio.create_task(admin())
+    started = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in premium))
+    duration = time.perf_counter() - started
+    admin_task.cancel()
+    await design.teardown()
+    logging.getLogger().removeHandler(lock_log)
+
+    # Correctness, read straight from the file after the design has shut down
+    with sqlite3.connect(path) as db:
+        counts = dict(db.execute("SELECT user_id, download_count FROM users").fetchall())
+        total = db.execute("SELECT value FROM stats WHERE stat_key = 'total_downloads'").fetchone()[0]
+    mismatched = [
+        uid for uid in premium
+        if (design.counts_premium or is_free.get(uid)) and counts.get(uid, 0) != expected.get(uid, 0)
+    ]
+    lost = sum(max(0, expected.get(uid, 0) - counts.get(uid, 0)) for uid in mismatched)
+
+    all_latencies = [v for values in timer.latencies.values() for v in values]
+    return {
+        "design": args.design,
+        "duration_s": round(duration, 3),
+        "ops": timer.ops,
+        "ops_per_s": round(timer.ops / duration, 1) if duration else 0.0,
+        "latency_s": percentiles(all_latencies),
+        "calls_s": {name: percentiles(values) for name, values in sorted(timer.latencies.items())},
+        "lock_errors": timer.lock_errors + lock_log.count,
+        "errors": timer.errors,
+        "failed_messages": failed_messages,
+        "finish_errors": finish_errors,
+        "correctness": {
+            "downloads": successes,
+            "total_downloads_stat": total,
+            "total_downloads_lost": expected_total - total,
+            "users_checked": sum(1 for uid in premium if design.counts_premium or is_free.get(uid)),
+            "users_mismatched": len(mismatched),
+            "user_counts_lost": lost,
+            "users_over_limit": len(over_limit),
+            "ok": not mismatched and expected_total == total and not over_limit,
+        },
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.design not in DESIGNS:
+        sys.exit(f"Unknown design {args.design!r}, expected one of: {', '.join(DESIGNS)}")
+    logging.basicConfig(level=logging.CRITICAL)
+    with tempfile.TemporaryDirectory(prefix="db_stress_") as workdir:
+        path = os.path.join(workdir, "stress.db")
+        os.environ["DB_NAME"] = path
+        for item in args.env:
+            name, _, value = item.partition("=")
+            os.environ[name] = value
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        results = asyncio.run(run_stress(args, path))
+
+    report = {
+        "benchmark": "db_stress",
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        r = results
+        print(f"{args.design}: {r['ops']} ops in {r['duration_s']}s ({r['ops_per_s']} ops/s), "
+              f"p99 {r['latency_s'].get('p99')}s, {r['lock_errors']} lock errors, "
+              f"counts {'ok' if r['correctness']['ok'] else 'WRONG'}. Report written to {args.output}.",
+              file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
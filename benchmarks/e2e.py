@@ -0,0 +1,478 @@
+"""
+End-to-end benchmark of the link pipeline, fully offline.
+
+Runs the real handle_insta_link (scheduler, session pool, Instaloader,
+CDN fetcher, spool, SQLite) against benchmarks.fake_instagram in a
+subprocess and a fake Telegram, drives synthetic users and prints a JSON
+report. Compare two reports with `python -m benchmarks.compare`.
+
+    python -m benchmarks.e2e --users 50 --messages 2 --links 3 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+IG_HOSTS = {"www.instagram.com", "i.instagram.com"}
+LINK_KINDS = ("post", "reel", "carousel", "story")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    load = parser.add_argument_group("load")
+    load.add_argument("--users", type=int, default=20, help="Concurrent synthetic users")
+    load.add_argument("--messages", type=int, default=2, help="Messages per user")
+    load.add_argument("--links", type=int, default=3, help="Links per message")
+    load.add_argument("--mix", default="post=0.4,reel=0.25,carousel=0.25,story=0.1",
+                      help="Link type weights")
+    load.add_argument("--catalog", type=int, default=200,
+                      help="Distinct posts per type; smaller means more repeat links")
+    load.add_argument("--story-accounts", type=int, default=10)
+    load.add_argument("--think-time", type=float, default=0.5,
+                      help="Mean seconds between a user's messages")
+    load.add_argument("--premium-ratio", type=float, default=1.0,
+                      help="Fraction of users without the free daily limit")
+    load.add_argument("--handler-workers", type=int, default=None,
+                      help="Concurrent handlers, like Pyrogram's workers (default: Pyrogram's)")
+    load.add_argument("--seed", type=int, default=1)
+
+    instagram = parser.add_argument_group("fake instagram")
+    instagram.add_argument("--api-latency", type=float, default=0.05)
+    instagram.add_argument("--cdn-latency", type=float, default=0.02)
+    instagram.add_argument("--rate-limit", type=float, default=0.0,
+                           help="Fraction of API calls answered with HTTP 429")
+    instagram.add_argument("--photo-size", type=int, default=150_000)
+    instagram.add_argument("--video-size", type=int, default=2_000_000)
+    instagram.add_argument("--carousel-items", type=int, default=4)
+    instagram.add_argument("--ig-sessions", type=int, default=4, help="Anonymous Instagram sessions")
+    instagram.add_argument("--ig-cooldown", type=float, default=5.0,
+                           help="Session cooldown after a 429 (seconds)")
+    instagram.add_argument("--instaloader-throttle", action="store_true",
+                           help="Keep Instaloader's own sleeps and rate controller")
+
+    telegram = parser.add_argument_group("fake telegram")
+    telegram.add_argument("--tg-latency", type=float, default=0.05)
+    telegram.add_argument("--tg-bandwidth", type=float, default=20 * 1024 * 1024,
+                          help="Upload bytes per second")
+
+    nodes = parser.add_argument_group("nodes")
+    nodes.add_argument("--workers", type=int, default=0,
+                       help="Worker node processes behind an ingress node (0: one process does everything)")
+    # Used when this script starts itself as a worker node
+    nodes.add_argument("--worker-node", help=argparse.SUPPRESS)
+    nodes.add_argument("--workdir", help=argparse.SUPPRESS)
+    nodes.add_argument("--base-url", help=argparse.SUPPRESS)
+
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra bot settings, e.g. --env DOWNLOAD_WORKERS=16")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+# --- Environment ---
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure_environment(args, workdir: str):
+    """Points the bot's settings at temporary state. Must run before importing bot modules."""
+    os.environ.update({
+        "DB_NAME": os.path.join(workdir, "bench.db"),
+        "SPOOL_DIR": os.path.join(workdir, "downloads"),
+        "IG_USER": "", "IG_PASS": "", "IG_ACCOUNTS": "",
+        "IG_ANONYMOUS_SESSIONS": str(args.ig_sessions),
+        "IG_SESSION_BUDGET": "1000000",
+        "IG_SESSION_COOLDOWN": str(args.ig_cooldown),
+        "TRACE_BUFFER_SIZE": str(max(2000, args.users * args.messages * args.links)),
+    })
+    if args.worker_node:
+        # Workers on one machine need their own spool (each sweeps its directory)
+        os.environ.update({"NODE_ROLE": "worker", "NODE_NAME": args.worker_node,
+                           "SPOOL_DIR": os.path.join(workdir, f"downloads-{args.worker_node}")})
+    elif args.workers:
+        os.environ["NODE_ROLE"] = "ingress"
+    for item in args.env:
+        name, _, value = item.partition("=")
+        os.environ[name] = value
+
+
+def route_instagram_to(base_url: str):
+    """Sends every requests call for Instagram's hosts to the fake server instead."""
+    import requests
+    original_send = requests.Session.send
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname in IG_HOSTS:
+            request.url = f"{base_url}/ig/{parts.hostname}{parts.path}"
+            if parts.query:
+                request.url += f"?{parts.query}"
+        return original_send(self, request, **kwargs)
+
+    requests.Session.send = send
+
+
+def prepare_sessions(throttle: bool):
+    """Marks the pool's sessions as logged in (stories need it) and optionally unthrottles them."""
+    import instaloader
+    from session_pool import session_pool
+    if not throttle:
+        instaloader.RateController.query_waittime = lambda self, *args, **kwargs: 0.0
+    for session in session_pool.sessions:
+        context = session.loader.context
+        context.username = f"bench_{session.name.replace(':', '_')}"
+        context.iphone_support = False  # The fake only speaks the web API
+        context.sleep = throttle
+        session.logged_in = True
+
+
+def start_fake_instagram(args, port: int) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "benchmarks.fake_instagram", "--port", str(port),
+        "--api-latency", str(args.api_latency), "--cdn-latency", str(args.cdn_latency),
+        "--rate-limit", str(args.rate_limit), "--photo-size", str(args.photo_size),
+        "--video-size", str(args.video_size), "--carousel-items", str(args.carousel_items),
+        "--seed", str(args.seed),
+    ]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The fake Instagram server did not start.")
+
+
+# --- Workload ---
+
+def build_workload(args, rng: random.Random) -> list:
+    """[(user_id, delay_before_message, text)] for every message of every user."""
+    weights = {kind: 0.0 for kind in LINK_KINDS}
+    for part in args.mix.split(","):
+        kind, _, weight = part.partition("=")
+        weights[kind.strip()] = float(weight)
+    kinds, kind_weights = zip(*weights.items())
+
+    def link(kind: str) -> str:
+        n = rng.randrange(args.catalog)
+        if kind == "post":
+            return f"https://www.instagram.com/p/P{n:05d}/"
+        if kind == "reel":
+            return f"https://www.instagram.com/reel/V{n:05d}/"
+        if kind == "carousel":
+            return f"https://www.instagram.com/p/C{n:05d}/"
+        account = rng.randrange(args.story_accounts) + 1
+        return f"https://www.instagram.com/stories/bench_user{account}/{account * 1000 + rng.randrange(5)}/"
+
+    workload = []
+    for user_id in range(1, args.users + 1):
+        for _ in range(args.messages):
+            links = [link(k) for k in rng.choices(kinds, kind_weights, k=args.links)]
+            workload.append((user_id, rng.expovariate(1 / args.think_time) if args.think_time else 0,
+                             "Check these: " + " ".join(links)))
+    return workload
+
+
+# --- Measurement ---
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Sampler:
+    """Samples RSS and spool disk usage while the benchmark runs."""
+
+    def __init__(self, spool_dir: str, interval: float = 0.25):
+        self.spool_dir = spool_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+
+    async def run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, _rss_bytes())
+            self.peak_disk = max(self.peak_disk, await asyncio.to_thread(_dir_bytes, self.spool_dir))
+            await asyncio.sleep(self.interval)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]
+    return {
+        "p50": round(pick(0.50), 4), "p90": round(pick(0.90), 4), "p95": round(pick(0.95), 4),
+        "p99": round(pick(0.99), 4), "max": round(values[-1], 4),
+        "mean": round(sum(values) / len(values), 4),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# --- Run ---
+
+async def run_benchmark(args, base_url: str, workdir: str) -> dict:
+    from pyrogram import Client
+    from Database.db import init_db, close_db, add_user, update_user_premium, save_profile_id
+    from Database.quota import quota
+    from Database.stats import download_stats
+    from scheduler import scheduler
+    from engine import engine
+    from executors import instagram_executor, fs_executor
+    from tracing import tracer
+    from Plugins.downloader_handler import handle_insta_link
+    from benchmarks.fake_telegram import FakeTelegram
+
+    rng = random.Random(args.seed)
+    await init_db()
+    quota.start()
+    download_stats.start()
+    scheduler.start()
+    if not args.workers:
+        await engine.ready()
+        prepare_sessions(args.instaloader_throttle)
+
+    for user_id in range(1, args.users + 1):
+        await add_user(user_id)
+        if rng.random() < args.premium_ratio:
+            await update_user_premium(user_id, True)
+    for account in range(1, args.story_accounts + 1):
+        await save_profile_id(f"bench_user{account}", account)
+    nodes = await start_worker_nodes(args, base_url, workdir)
+
+    telegram = FakeTelegram(args.tg_latency, args.tg_bandwidth)
+    workload = build_workload(args, rng)
+    workers = asyncio.Semaphore(args.handler_workers or Client.WORKERS)
+    sampler = Sampler(os.environ["SPOOL_DIR"])
+    sampler_task = asyncio.create_task(sampler.run())
+    handlers = []
+    errors = []
+
+    async def handle(message):
+        async with workers:
+            try:
+                await handle_insta_link(None, message)
+            except Exception as e:
+                errors.append(repr(e))
+
+    async def user(user_id: int, messages: list):
+        for delay, text in messages:
+            await asyncio.sleep(delay)
+            handlers.append(asyncio.create_task(handle(telegram.message(user_id, text))))
+
+    by_user = {}
+    for user_id, delay, text in workload:
+        by_user.setdefault(user_id, []).append((delay, text))
+
+    started = time.monotonic()
+    await asyncio.gather(*(user(user_id, messages) for user_id, messages in by_user.items()))
+    await asyncio.gather(*handlers)
+    traces = list(tracer.finished)
+    finished = max((t.started + t.total for t in traces), default=time.monotonic())
+    duration = finished - started
+
+    sampler_task.cancel()
+    node_reports = stop_worker_nodes(nodes, workdir)
+    await scheduler.stop()
+    await engine.stop()
+    await quota.stop()
+    await download_stats.stop()
+    await close_db()
+    instagram_executor.shutdown()
+    fs_executor.shutdown()
+
+    stage_samples = {}
+    for trace in traces:
+        for stage, seconds in trace.stage_totals().items():
+            stage_samples.setdefault(stage, []).append(seconds)
+    # Downloads and uploads happened on the worker nodes
+    for report in node_reports:
+        for stage, values in report["stages"].items():
+            stage_samples.setdefault(stage, []).extend(values)
+        for name, count in report["telegram"].items():
+            telegram.counts[name] += count
+    succeeded = sum(1 for t in traces if t.outcome == "success")
+    return {
+        "links": len(traces),
+        "links_succeeded": succeeded,
+        "links_failed": len(traces) - succeeded,
+        "messages": len(workload),
+        "duration_s": round(duration, 3),
+        "links_per_s": round(succeeded / duration, 3) if duration > 0 else 0.0,
+        "link_latency_s": percentiles([t.total for t in traces]),
+        "message_latency_s": percentiles(telegram.message_latencies),
+        "stages_s": {stage: percentiles(v) for stage, v in sorted(stage_samples.items())},
+        "peak_rss_mb": round(max(sampler.peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+                             / 1024 ** 2, 1),
+        "peak_spool_mb": round(sampler.peak_disk / 1024 ** 2, 2),
+        "final_spool_mb": round(_dir_bytes(os.environ["SPOOL_DIR"]) / 1024 ** 2, 2),
+        "worker_peak_rss_mb": max((r["peak_rss_mb"] for r in node_reports), default=None),
+        "telegram": telegram.counts,
+        "handler_errors": errors[:20],
+    }
+
+
+# --- Worker Nodes ---
+# With --workers the handler runs as an ingress node and every link is
+# downloaded and sent by one of N copies of this script started with
+# --worker-node, sharing the benchmark's SQLite database as the job queue.
+
+async def start_worker_nodes(args, base_url: str, workdir: str) -> list:
+    """Starts the worker processes and waits until each is taking jobs."""
+    nodes = []
+    for n in range(args.workers):
+        name = f"worker{n + 1}"
+        command = [sys.executable, "-m", "benchmarks.e2e", *sys.argv[1:],
+                   "--worker-node", name, "--workdir", workdir, "--base-url", base_url]
+        nodes.append((name, subprocess.Popen(command)))
+    while not all(os.path.exists(os.path.join(workdir, f"{name}.ready")) for name, _ in nodes):
+        for name, process in nodes:
+            if process.poll() is not None:
+                raise RuntimeError(f"Worker node {name} exited with {process.returncode}")
+        await asyncio.sleep(0.1)
+    return nodes
+
+
+def stop_worker_nodes(nodes: list, workdir: str) -> list:
+    """Stops the workers and collects what each of them measured."""
+    for _, process in nodes:
+        process.terminate()
+    reports = []
+    for name, process in nodes:
+        process.wait()
+        with open(os.path.join(workdir, f"{name}.json")) as f:
+            reports.append(json.load(f))
+    return reports
+
+
+async def run_worker_node(args):
+    """A worker node: serves the job queue until SIGTERM, then writes its numbers to <workdir>/<name>.json."""
+    from config import JOB_WORKER_CONCURRENCY
+    from Database.db import init_db, close_db
+    from scheduler import scheduler
+    from engine import engine
+    from jobqueue import job_queue
+    from executors import instagram_executor, fs_executor
+    from tracing import tracer
+    from Plugins.downloader_handler import run_link_job
+    from benchmarks.fake_telegram import FakeTelegram, FakeClient
+
+    await init_db()
+    scheduler.start()
+    await engine.ready()
+    prepare_sessions(args.instaloader_throttle)
+    telegram = FakeTelegram(args.tg_latency, args.tg_bandwidth)
+    client = FakeClient(telegram)
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    job_queue.serve(lambda job: run_link_job(client, job), args.worker_node, JOB_WORKER_CONCURRENCY)
+    open(os.path.join(args.workdir, f"{args.worker_node}.ready"), "w").close()
+    await stopping.wait()
+
+    await job_queue.stop()
+    await scheduler.stop()
+    await engine.stop()
+    await close_db()
+    instagram_executor.shutdown()
+    fs_executor.shutdown()
+
+    stages = {}
+    for trace in tracer.finished:
+        for stage, seconds in trace.stage_totals().items():
+            stages.setdefault(stage, []).append(seconds)
+    report = {
+        "stages": stages,
+        "telegram": telegram.counts,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(os.path.join(args.workdir, f"{args.worker_node}.json"), "w") as f:
+        json.dump(report, f)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker_node:
+        configure_environment(args, args.workdir)
+        route_instagram_to(args.base_url)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        asyncio.run(run_worker_node(args))
+        return
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        configure_environment(args, workdir)
+        route_instagram_to(base_url)
+        # Run from the repository root so the bot's modules are importable
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        server = start_fake_instagram(args, port)
+        try:
+            results = asyncio.run(run_benchmark(args, base_url, workdir))
+            import requests
+            results["instagram"] = requests.get(f"{base_url}/_stats", timeout=5).json()
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "benchmark": "e2e",
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("output", "worker_node", "workdir", "base_url")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        r = results
+        print(f"{r['links_succeeded']}/{r['links']} links in {r['duration_s']}s "
+              f"({r['links_per_s']} links/s), p95 {r['link_latency_s'].get('p95')}s. "
+              f"Report written to {args.output}.", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
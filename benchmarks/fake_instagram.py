@@ -0,0 +1,189 @@
+"""
+A local stand-in for Instagram's web API and CDN, for benchmarks.
+
+Answers the GraphQL requests Instaloader makes for posts (doc_id query) and
+story trays (query_hash query), and serves media files with Range support.
+What a shortcode returns is derived from its first letter:
+
+    P... photo post, V... video (reel/tv), C... carousel
+
+Story trays are generated for any user id. Run standalone with
+`python -m benchmarks.fake_instagram --port 8765`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+from aiohttp import web
+
+POST_DOC_ID = "27128499623469141"
+STORIES_QUERY_HASH = "303a4ae99711322310f25250d988f3b7"
+
+
+class FakeInstagram:
+
+    def __init__(self, base_url: str, media_dir: str, api_latency: float = 0.05,
+                 cdn_latency: float = 0.02, rate_limit: float = 0.0,
+                 photo_size: int = 150_000, video_size: int = 2_000_000,
+                 carousel_items: int = 4, story_items: int = 5, seed: int = 0):
+        self.base_url = base_url.rstrip("/")
+        self.media_dir = media_dir
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.rate_limit = rate_limit
+        self.carousel_items = carousel_items
+        self.story_items = story_items
+        self.random = random.Random(seed)
+        self.counts = {"api": 0, "cdn": 0, "cdn_bytes": 0, "rate_limited": 0}
+        self.files = {
+            "photo": self._write_media("photo.jpg", photo_size),
+            "video": self._write_media("video.mp4", video_size),
+        }
+
+    def _write_media(self, name: str, size: int) -> str:
+        path = os.path.join(self.media_dir, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    # --- Canned JSON ---
+
+    def _cdn_url(self, media_type: str, name: str) -> str:
+        ext = "mp4" if media_type == "video" else "jpg"
+        return f"{self.base_url}/cdn/{media_type}/{name}.{ext}"
+
+    def _media_fields(self, media_type: str, name: str) -> dict:
+        fields = {
+            "media_type": 2 if media_type == "video" else 1,
+            "image_versions2": {"candidates": [{"url": self._cdn_url("photo", name)}]},
+        }
+        if media_type == "video":
+            fields["video_versions"] = [{"url": self._cdn_url("video", name)}]
+            fields["view_count"] = 1000  # Otherwise Instaloader asks for the play count
+        return fields
+
+    def post(self, shortcode: str) -> dict:
+        kind = shortcode[:1].upper()
+        media = {
+            "code": shortcode,
+            "pk": str(zlib.crc32(shortcode.encode())),
+            "taken_at": int(time.time()) - 3600,
+            "user": {"pk": "1000", "username": "bench_owner", "full_name": "Bench Owner"},
+            "caption": {"text": f"Benchmark post {shortcode}"},
+            "like_count": 1,
+            "comment_count": 0,
+        }
+        if kind == "C":
+            media["media_type"] = 8
+            media["image_versions2"] = {"candidates": [{"url": self._cdn_url("photo", shortcode)}]}
+            media["carousel_media"] = [
+                dict(self._media_fields("video" if i % 3 == 2 else "photo", f"{shortcode}_{i}"),
+                     code=f"{shortcode}_{i}")
+                for i in range(self.carousel_items)
+            ]
+        else:
+            media.update(self._media_fields("video" if kind == "V" else "photo", shortcode))
+        return {"data": {"xdt_api__v1__media__shortcode__web_info": {"items": [media]}}, "status": "ok"}
+
+    def story_tray(self, userid: int) -> dict:
+        items = []
+        for i in range(self.story_items):
+            media_type = "video" if i % 2 else "photo"
+            name = f"story_{userid}_{i}"
+            items.append({
+                "id": str(userid * 1000 + i),
+                "__typename": "GraphStoryVideo" if media_type == "video" else "GraphStoryImage",
+                "is_video": media_type == "video",
+                "taken_at_timestamp": int(time.time()) - 600,
+                "expiring_at_timestamp": int(time.time()) + 86400,
+                "display_resources": [{"src": self._cdn_url("photo", name)}],
+                "video_resources": [{"src": self._cdn_url("video", name)}] if media_type == "video" else [],
+            })
+        reel = {
+            "id": str(userid),
+            "latest_reel_media": int(time.time()),
+            "user": {"id": str(userid), "username": f"bench_user{userid}"},
+            "owner": {"id": str(userid), "username": f"bench_user{userid}"},
+            "items": items,
+        }
+        return {"data": {"reels_media": [reel]}, "status": "ok"}
+
+    # --- Handlers ---
+
+    async def _api_delay(self):
+        self.counts["api"] += 1
+        await asyncio.sleep(self.api_latency)
+        if self.rate_limit and self.random.random() < self.rate_limit:
+            self.counts["rate_limited"] += 1
+            raise web.HTTPTooManyRequests(text='{"status": "fail", "message": "Please wait a few minutes"}',
+                                          content_type="application/json")
+
+    async def home(self, request):
+        response = web.Response(text="<html></html>", content_type="text/html")
+        response.set_cookie("csrftoken", "benchmark")
+        return response
+
+    async def graphql(self, request):
+        await self._api_delay()
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        variables = json.loads(params.get("variables", "{}"))
+        if params.get("doc_id") == POST_DOC_ID:
+            return web.json_response(self.post(variables["shortcode"]))
+        if params.get("query_hash") == STORIES_QUERY_HASH:
+            return web.json_response(self.story_tray(int(variables["reel_ids"][0])))
+        return web.json_response({"status": "fail", "message": "unknown query"}, status=400)
+
+    async def cdn(self, request):
+        self.counts["cdn"] += 1
+        await asyncio.sleep(self.cdn_latency)
+        path = self.files["video" if request.match_info["media_type"] == "video" else "photo"]
+        response = web.FileResponse(path)
+        self.counts["cdn_bytes"] += os.path.getsize(path)
+        return response
+
+    async def stats(self, request):
+        return web.json_response(self.counts)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get("/ig/www.instagram.com/", self.home),
+            web.route("*", "/ig/www.instagram.com/graphql/query", self.graphql),
+            web.route("*", "/ig/www.instagram.com/graphql/query/", self.graphql),
+            web.get("/cdn/{media_type}/{name}", self.cdn),
+            web.get("/_stats", self.stats),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per API response")
+    parser.add_argument("--cdn-latency", type=float, default=0.02, help="Seconds before media is served")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of API calls answered with 429")
+    parser.add_argument("--photo-size", type=int, default=150_000, help="Bytes per photo")
+    parser.add_argument("--video-size", type=int, default=2_000_000, help="Bytes per video")
+    parser.add_argument("--carousel-items", type=int, default=4)
+    parser.add_argument("--story-items", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="fake_instagram_") as media_dir:
+        fake = FakeInstagram(
+            f"http://{args.host}:{args.port}", media_dir, args.api_latency, args.cdn_latency,
+            args.rate_limit, args.photo_size, args.video_size, args.carousel_items,
+            args.story_items, args.seed
+        )
+        web.run_app(fake.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+A stand-in for the Pyrogram objects the link handler talks to.
+
+FakeMessage implements the reply/edit calls Plugins/downloader_handler.py
+uses (FakeClient the send calls behind them on worker nodes), simulating
+Telegram's latency and upload bandwidth, and FakeTelegram records every
+send so the benchmark can count uploads and bytes.
+"""
+import asyncio
+import io
+import itertools
+import os
+import time
+from types import SimpleNamespace
+
+# Final status texts of handle_insta_link; seeing one means the message is done
+FINAL_STATUS_PREFIXES = ("Successfully downloaded", "Finished processing")
+
+
+class FakeTelegram:
+
+    def __init__(self, latency: float = 0.05, bandwidth: float = 20 * 1024 * 1024):
+        self.latency = latency
+        self.bandwidth = bandwidth  # Upload bytes per second
+        self._file_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.counts = {"uploads": 0, "upload_bytes": 0, "cached_sends": 0, "albums": 0,
+                       "texts": 0, "edits": 0}
+        self.message_latencies = []  # Seconds from receiving a message to its final status
+
+    def message(self, user_id: int, text: str) -> "FakeMessage":
+        """An incoming message from a user."""
+        return FakeMessage(self, user_id, text)
+
+    def _media_size(self, media) -> int | None:
+        """Bytes to upload, or None if `media` is a file_id of an earlier upload."""
+        if isinstance(media, io.BytesIO):
+            return len(media.read())
+        if isinstance(media, str) and os.path.exists(media):
+            return os.path.getsize(media)
+        return None
+
+    async def send_media(self, media_type: str, media):
+        size = self._media_size(media)
+        if size is None:
+            self.counts["cached_sends"] += 1
+            await asyncio.sleep(self.latency)
+            file_id = media
+        else:
+            self.counts["uploads"] += 1
+            self.counts["upload_bytes"] += size
+            await asyncio.sleep(self.latency + size / self.bandwidth)
+            file_id = f"{media_type}_{next(self._file_ids)}"
+        sent = SimpleNamespace(photo=None, video=None)
+        setattr(sent, media_type, SimpleNamespace(file_id=file_id))
+        return sent
+
+    async def send_album(self, media: list) -> list:
+        self.counts["albums"] += 1
+        types = ["video" if type(m).__name__ == "InputMediaVideo" else "photo" for m in media]
+        return list(await asyncio.gather(*(
+            self.send_media(media_type, m.media) for media_type, m in zip(types, media)
+        )))
+
+
+class FakeClient:
+    """
+    The send calls of a worker node's Pyrogram client. Worker nodes reply
+    through Message stand-ins bound to the client, so these are what they hit.
+    """
+
+    def __init__(self, telegram: FakeTelegram):
+        self.telegram = telegram
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.telegram.counts["texts"] += 1
+        await asyncio.sleep(self.telegram.latency)
+
+    async def send_photo(self, chat_id: int, photo, **kwargs):
+        return await self.telegram.send_media("photo", photo)
+
+    async def send_video(self, chat_id: int, video, **kwargs):
+        return await self.telegram.send_media("video", video)
+
+    async def send_media_group(self, chat_id: int, media: list, **kwargs):
+        return await self.telegram.send_album(media)
+
+
+class FakeMessage:
+
+    def __init__(self, telegram: FakeTelegram, user_id: int, text: str = "",
+                 parent: "FakeMessage | None" = None):
+        self.telegram = telegram
+        self.id = next(telegram._message_ids)
+        self.text = text
+        self.caption = None
+        self.entities = None
+        self.caption_entities = None
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=user_id)
+        self.parent = parent
+        self.received_at = time.monotonic()
+        self.finished = False
+
+    async def reply_text(self, text: str, **kwargs):
+        self.telegram.counts["texts"] += 1
+        await asyncio.sleep(self.telegram.latency)
+        reply = FakeMessage(self.telegram, self.from_user.id, text, parent=self)
+        if text.startswith("You have reached") or text.startswith("You are banned"):
+            self._finish()
+        return reply
+
+    async def edit_text(self, text: str, **kwargs):
+        self.telegram.counts["edits"] += 1
+        await asyncio.sleep(self.telegram.latency)
+        self.text = text
+        if self.parent is not None and text.startswith(FINAL_STATUS_PREFIXES):
+            self.parent._finish()
+
+    async def delete(self):
+        await asyncio.sleep(self.telegram.latency)
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self.telegram.message_latencies.append(time.monotonic() - self.received_at)
+
+    async def reply_photo(self, photo, caption: str = None, **kwargs):
+        return await self.telegram.send_media("photo", photo)
+
+    async def reply_video(self, video, caption: str = None, **kwargs):
+        return await self.telegram.send_media("video", video)
+
+    async def reply_media_group(self, media: list, **kwargs):
+        return await self.telegram.send_album(media)
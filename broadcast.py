@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from pyrogram import Client
+from pyrogram.errors import (
+    FloodWait, UserIsBlocked, InputUserDeactivated, UserDeactivated
+)
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE
+from Database.db import (
+    count_broadcast_users, get_broadcast_user_ids, mark_users_blocked, create_broadcast,
+    save_broadcast_progress, finish_broadcast, get_running_broadcasts
+)
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning the user can't receive messages from the bot until they
+# unblock it (the flag is cleared when they write to the bot again).
+# PeerIdInvalid only means the peer couldn't be resolved; it counts as failed.
+# UserDeactivated is about the bot's own account and aborts the broadcast.
+BLOCKED_ERRORS = (UserIsBlocked, InputUserDeactivated)
+MAX_FLOOD_RETRIES = 3
+PROGRESS_INTERVAL = 10  # Seconds between status message edits
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens, e.g. while Telegram asks us to FloodWait."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcast:
+    """One broadcast run; its progress is persisted after every page of users."""
+
+    def __init__(self, row: dict):
+        self.id = row['broadcast_id']
+        self.from_chat_id = row['from_chat_id']
+        self.message_id = row['message_id']
+        self.status_chat_id = row['status_chat_id']
+        self.status_message_id = row['status_message_id']
+        self.total = row['total']
+        self.last_user_id = row['last_user_id']
+        self.sent = row['sent']
+        self.failed = row['failed']
+        self.blocked = row['blocked']
+        self.cancelled = False
+        self.aborted = False  # The bot's account can't send any more
+        self._last_edit = 0.0
+
+    def render(self, title: str = "Broadcasting...") -> str:
+        done = self.sent + self.failed + self.blocked
+        return (
+            f"**{title}** (#{self.id})\n\n"
+            f"Progress: `{done}/{self.total}`\n"
+            f"Sent to: `{self.sent}` users\n"
+            f"Blocked/Deactivated: `{self.blocked}` users\n"
+            f"Failed for: `{self.failed}` users"
+        )
+
+    async def update_status(self, client: Client, title: str = "Broadcasting...", force: bool = False):
+        now = time.monotonic()
+        if not self.status_chat_id or (not force and now - self._last_edit < PROGRESS_INTERVAL):
+            return
+        self._last_edit = now
+        try:
+            await client.edit_message_text(self.status_chat_id, self.status_message_id, self.render(title))
+        except Exception as e:
+            logger.debug(f"Could not edit broadcast status: {e}")
+
+
+class BroadcastEngine:
+    """
+    Sends broadcasts with a pool of concurrent senders sharing one
+    token bucket sized to Telegram's global bot limits.
+    """
+
+    def __init__(self, rate: float, concurrency: int, page_size: int):
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.active = {}  # broadcast_id -> Broadcast
+
+    async def _send(self, client: Client, job: Broadcast, user_id: int) -> str:
+        """Copies the message to one user. Returns "sent", "blocked", "failed" or "aborted"."""
+        for _ in range(MAX_FLOOD_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await client.copy_message(user_id, job.from_chat_id, job.message_id)
+                return "sent"
+            except FloodWait as e:
+                logger.warning(f"FloodWait for {e.value} seconds. Pausing broadcast.")
+                self.bucket.pause(e.value)
+            except BLOCKED_ERRORS:
+                return "blocked"
+            except UserDeactivated:
+                logger.error(f"The bot's account is deactivated; aborting broadcast #{job.id}.")
+                job.aborted = True
+                return "aborted"
+            except Exception as e:
+                logger.error(f"Failed to send broadcast to {user_id}: {e}")
+                return "failed"
+        return "failed"
+
+    async def _send_page(self, client: Client, job: Broadcast, user_ids: list) -> list:
+        """Sends to one page of users; returns the ids that turned out to be blocked."""
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+        blocked = []
+
+        async def sender():
+            while not queue.empty() and not job.cancelled and not job.aborted:
+                user_id = queue.get_nowait()
+                outcome = await self._send(client, job, user_id)
+                if outcome == "aborted":
+                    break
+                if outcome == "sent":
+                    job.sent += 1
+                elif outcome == "blocked":
+                    job.blocked += 1
+                    blocked.append(user_id)
+                else:
+                    job.failed += 1
+                await job.update_status(client)
+
+        await asyncio.gather(*(sender() for _ in range(self.concurrency)))
+        return blocked
+
+    async def run(self, client: Client, job: Broadcast):
+        """Sends a broadcast from where it left off until every user has been tried."""
+        try:
+            while not job.cancelled and not job.aborted:
+                user_ids = await get_broadcast_user_ids(job.last_user_id, self.page_size)
+                if not user_ids:
+                    break
+                blocked = await self._send_page(client, job, user_ids)
+                if job.cancelled:
+                    break
+                if not job.aborted:
+                    job.last_user_id = user_ids[-1]
+                await mark_users_blocked(blocked)
+                await save_broadcast_progress(
+                    job.id, job.last_user_id, job.sent, job.failed, job.blocked
+                )
+            if job.aborted:
+                status, title = "aborted", "Broadcast Aborted (the bot's account is deactivated)"
+            elif job.cancelled:
+                status, title = "cancelled", "Broadcast Cancelled"
+            else:
+                status, title = "done", "Broadcast Complete"
+            await finish_broadcast(job.id, status)
+            await job.update_status(client, title, force=True)
+            logger.info(f"Broadcast #{job.id} {status}: {job.sent} sent, {job.blocked} blocked, {job.failed} failed.")
+        finally:
+            self.active.pop(job.id, None)
+
+    async def start(self, client: Client, from_chat_id: int, message_id: int,
+                    status_chat_id: int, status_message_id: int) -> Broadcast:
+        """Creates a broadcast and runs it in the background."""
+        total = await count_broadcast_users()
+        broadcast_id = await create_broadcast(
+            from_chat_id, message_id, status_chat_id, status_message_id, total
+        )
+        job = Broadcast({
+            'broadcast_id': broadcast_id, 'from_chat_id': from_chat_id, 'message_id': message_id,
+            'status_chat_id': status_chat_id, 'status_message_id': status_message_id,
+            'total': total, 'last_user_id': 0, 'sent': 0, 'failed': 0, 'blocked': 0,
+        })
+        self._spawn(client, job)
+        return job
+
+    async def resume_all(self, client: Client):
+        """Restarts broadcasts that were interrupted by a restart or crash."""
+        for row in await get_running_broadcasts():
+            job = Broadcast(row)
+            logger.info(f"Resuming broadcast #{job.id} after user {job.last_user_id}.")
+            self._spawn(client, job)
+
+    def _spawn(self, client: Client, job: Broadcast):
+        # Registered before the task runs so it can be cancelled right away
+        self.active[job.id] = job
+        asyncio.create_task(self.run(client, job))
+
+    def cancel(self, broadcast_id: int) -> bool:
+        job = self.active.get(broadcast_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        return True
+
+
+broadcaster = BroadcastEngine(BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_PAGE_SIZE)
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -15,6 +16,11 @@ ADMIN_ID = int(os.environ.get("ADMIN_ID", 0))
 
 # --- Database Config ---
 DB_NAME = os.environ.get("DB_NAME", "bot_database.db")
+# Number of persistent read-only connections kept open (one writer is always used)
+DB_READER_CONNECTIONS = int(os.environ.get("DB_READER_CONNECTIONS", 4))
+# In-memory cache of user rows (ban/premium flags) used on every message
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300))  # Seconds
 
 # --- Instagram Config ---
 # !! WARNING !!
@@ -22,11 +28,133 @@ DB_NAME = os.environ.get("DB_NAME", "bot_database.db")
 # and can get the account BANNED. Use a burner/test account.
 IG_USER = os.environ.get("IG_USER", "")
 IG_PASS = os.environ.get("IG_PASS", "")
+# More accounts for the session pool, as "user1:pass1,user2:pass2"
+IG_ACCOUNTS = os.environ.get("IG_ACCOUNTS", "")
+# Extra sessions without login (used for posts/reels, never for stories)
+IG_ANONYMOUS_SESSIONS = int(os.environ.get("IG_ANONYMOUS_SESSIONS", 1))
+# Max Instagram requests per session within the budget window
+IG_SESSION_BUDGET = int(os.environ.get("IG_SESSION_BUDGET", 200))
+IG_SESSION_BUDGET_WINDOW = float(os.environ.get("IG_SESSION_BUDGET_WINDOW", 3600))  # Seconds
+# How long a session is rested after Instagram answers with HTTP 429
+IG_SESSION_COOLDOWN = float(os.environ.get("IG_SESSION_COOLDOWN", 600))  # Seconds
+# How long a job waits for a free session before failing as rate-limited
+IG_LEASE_TIMEOUT = float(os.environ.get("IG_LEASE_TIMEOUT", 60))  # Seconds
+# Login cookies of each account are saved here and reused after a restart
+IG_SESSION_DIR = os.environ.get("IG_SESSION_DIR", "sessions")
+# How often saved logins are checked against Instagram (and re-done if expired)
+IG_SESSION_CHECK_INTERVAL = float(os.environ.get("IG_SESSION_CHECK_INTERVAL", 6 * 3600))  # Seconds
+# Minimum time between password logins of one account (Instagram throttles them)
+IG_LOGIN_RETRY_INTERVAL = float(os.environ.get("IG_LOGIN_RETRY_INTERVAL", 900))  # Seconds
+# How long a username -> userid lookup is trusted (kept in SQLite)
+IG_PROFILE_ID_TTL = float(os.environ.get("IG_PROFILE_ID_TTL", 7 * 24 * 3600))  # Seconds
+# How long a fetched story tray is reused for further story links of that user
+STORY_TRAY_TTL = float(os.environ.get("STORY_TRAY_TTL", 60))  # Seconds
+# Threads reserved for blocking Instaloader calls
+IG_EXECUTOR_WORKERS = int(os.environ.get("IG_EXECUTOR_WORKERS", 8))
+# A single Instaloader call (e.g. download_post) is abandoned after this long
+IG_CALL_TIMEOUT = float(os.environ.get("IG_CALL_TIMEOUT", 120))  # Seconds
+# Timeout of each HTTP request Instaloader makes, so stuck threads are freed
+IG_REQUEST_TIMEOUT = float(os.environ.get("IG_REQUEST_TIMEOUT", 30))  # Seconds
+# Threads for filesystem cleanup
+FS_EXECUTOR_WORKERS = int(os.environ.get("FS_EXECUTOR_WORKERS", 2))
+# Keep fetched media in memory instead of writing it to downloads/
+STREAM_MEDIA = os.environ.get("STREAM_MEDIA", "true").lower() in ("1", "true", "yes")
+# Streamed files larger than this are spilled to disk
+STREAM_MEMORY_LIMIT = int(os.environ.get("STREAM_MEMORY_LIMIT", 20 * 1024 * 1024))  # Bytes
+# Total time allowed for fetching one media file from the CDN
+MEDIA_FETCH_TIMEOUT = float(os.environ.get("MEDIA_FETCH_TIMEOUT", 300))  # Seconds
+# Connection limits of the shared CDN client (overall and per host)
+MEDIA_FETCH_CONNECTIONS = int(os.environ.get("MEDIA_FETCH_CONNECTIONS", 100))
+MEDIA_FETCH_PER_HOST = int(os.environ.get("MEDIA_FETCH_PER_HOST", 16))
+# Times a dropped media download is resumed with a Range request
+MEDIA_FETCH_RETRIES = int(os.environ.get("MEDIA_FETCH_RETRIES", 3))
+# --- Download Spool ---
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "downloads")
+# Max bytes of finished downloads kept around (idle ones are evicted LRU).
+# Only idle downloads are evicted; links in progress may exceed it.
+SPOOL_QUOTA_BYTES = int(os.environ.get("SPOOL_QUOTA_BYTES", 2 * 1024 ** 3))
+# Max bytes of idle streamed downloads kept in memory for reuse (links in
+# progress are bounded by STREAM_MEMORY_LIMIT per file instead)
+SPOOL_MEMORY_QUOTA_BYTES = int(os.environ.get("SPOOL_MEMORY_QUOTA_BYTES", 64 * 1024 ** 2))
+# How long a sent download is kept for reuse by other users
+SPOOL_REUSE_WINDOW = float(os.environ.get("SPOOL_REUSE_WINDOW", 120))  # Seconds
+SPOOL_SWEEP_INTERVAL = float(os.environ.get("SPOOL_SWEEP_INTERVAL", 300))  # Seconds
+# Entries still held after this long are logged as possibly leaked (files in
+# use are never removed; the next start clears what a leak left behind)
+SPOOL_ORPHAN_AGE = float(os.environ.get("SPOOL_ORPHAN_AGE", 3600))  # Seconds
+# Sessions a job is tried on after rate-limit errors
+IG_MAX_SESSION_ATTEMPTS = int(os.environ.get("IG_MAX_SESSION_ATTEMPTS", 3))
+
+# --- Nodes & Job Queue ---
+# "all" runs everything in one process. "ingress" receives updates, checks
+# bans and quotas and queues each link; "worker" downloads and sends queued
+# links (start as many as you like; on one machine each needs its own PORT
+# and SPOOL_DIR).
+NODE_ROLE = os.environ.get("NODE_ROLE", "all").lower()
+# Name a worker claims jobs under (shown in /jobs)
+NODE_NAME = os.environ.get("NODE_NAME", f"{socket.gethostname()}-{os.getpid()}")
+# Where queued jobs live; "sqlite" uses the bot's database (DB_NAME)
+JOB_BROKER = os.environ.get("JOB_BROKER", "sqlite").lower()
+# How often workers look for new jobs and the ingress for finished ones
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 0.2))  # Seconds
+# A claimed job whose worker stops renewing it for this long is handed to another worker
+JOB_LEASE_TIMEOUT = float(os.environ.get("JOB_LEASE_TIMEOUT", 120))  # Seconds
+# Workers a job may be handed to before it is given up
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+# Links a worker works on at once (downloads still go through DOWNLOAD_WORKERS)
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", 16))
+# Finished jobs are deleted after this long
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", 24 * 3600))  # Seconds
+# Links interrupted by a restart are resumed if they were sent at most this
+# long ago; older ones are reported to the user as failed instead
+JOB_RESUME_WINDOW = float(os.environ.get("JOB_RESUME_WINDOW", 3600))  # Seconds
+# On SIGTERM, links in progress get this long to finish before they are left
+# to the next start
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", 20))  # Seconds
+
+# --- Logging ---
+LOG_FILE = os.environ.get("LOG_FILE", "bot_logs.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text" or "json" (one object per line, with the link's trace id)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# The log file is rotated at this size or at midnight, whichever comes first
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+# Rotated segments kept (gzip-compressed) before the oldest is deleted; 0 keeps all
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 14))
+# Largest export /log sends in one document
+LOG_EXPORT_MAX_BYTES = int(os.environ.get("LOG_EXPORT_MAX_BYTES", 20 * 1024 * 1024))
 
 # --- Bot Settings ---
 PREMIUM_QR_CODE = "https://i.ibb.co/hFjZ6CWD/photo-2025-08-10-02-24-51-7536777335068950548.jpg"
 FREE_USER_DOWNLOAD_LIMIT = 5 # Downloads per day
+# Seconds between batched writes of download counters to the database
+QUOTA_FLUSH_INTERVAL = float(os.environ.get("QUOTA_FLUSH_INTERVAL", 5))
+# Seconds between batched writes of download statistics
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", 30))
+# How long hourly download statistics are kept (daily ones are kept forever)
+STATS_HOURLY_RETENTION = float(os.environ.get("STATS_HOURLY_RETENTION", 14 * 24 * 3600))  # Seconds
+# Finished link traces kept in memory for /perf
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 2000))
+# Default window /perf reports on
+PERF_WINDOW = float(os.environ.get("PERF_WINDOW", 3600))  # Seconds
+# Sampling interval of the profiler started with /perf profile
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))  # Seconds
 PREMIUM_PRICE = "5$" # Example price
+# Size of the global download worker pool (premium/admin jobs run first)
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+# Links of one message fetched ahead while earlier ones upload
+MAX_PARALLEL_LINKS_PER_MESSAGE = int(os.environ.get("MAX_PARALLEL_LINKS_PER_MESSAGE", 4))
+# Concurrent downloads per user across all of their messages
+MAX_PARALLEL_DOWNLOADS_PER_USER = int(os.environ.get("MAX_PARALLEL_DOWNLOADS_PER_USER", 3))
+# Telegram file_ids of already-sent posts are reused for repeat links
+MEDIA_CACHE_MAX_ENTRIES = int(os.environ.get("MEDIA_CACHE_MAX_ENTRIES", 50000))
+MEDIA_CACHE_TTL = float(os.environ.get("MEDIA_CACHE_TTL", 7 * 24 * 3600))  # Seconds
+# Broadcast messages per second across all senders (Telegram allows ~30/s for bots)
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+# Messages sent concurrently during a broadcast
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 10))
+# Users per page; progress is saved after each page so a restart resumes from there
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", 500))
 
 # --- Bot Text & Messages ---
 START_TEXT = """
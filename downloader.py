@@ -1,130 +1,276 @@
 import instaloader
+import aiohttp
 import asyncio
-import os
-import glob
-import shutil
 import logging
-from config import IG_USER, IG_PASS
+from config import (
+    IG_MAX_SESSION_ATTEMPTS, IG_PROFILE_ID_TTL, STORY_TRAY_TTL, IG_REQUEST_TIMEOUT, STREAM_MEDIA,
+    STREAM_MEMORY_LIMIT
+)
 from instaloader.exceptions import *
+from session_pool import session_pool
+from executors import instagram_executor, CallTimeout
+from media_fetcher import fetch_all
+from spool import spool
+from Database.cache import TTLCache
+from Database.db import get_profile_id, save_profile_id
+from metrics import instagram_fetch_seconds, download_errors, register_cache
+from tracing import span
+from links import InstagramLink
 
 logger = logging.getLogger(__name__)
 
 # --- Instaloader Setup ---
-L = instaloader.Instaloader(
-    download_pictures=True,
-    download_videos=True,
-    download_video_thumbnails=False,
-    download_geotags=False,
-    download_comments=False,
-    save_metadata=False,
-    compress_json=False,
-    post_metadata_txt_pattern=None, # Disable caption .txt files
-    storyitem_metadata_txt_pattern=None
-)
+# Each job leases its own Instaloader instance from the session pool, which
+# also restores, checks and renews the accounts' logins (see session_pool.py).
+
+# --- Story Lookup ---
+# username -> userid rarely changes, so it is kept in memory and in SQLite.
+# A user's story tray is cached briefly and indexed by media id, so several
+# story links of one user cost a single tray request.
+
+_profile_ids = TTLCache(10000, IG_PROFILE_ID_TTL)
+_story_trays = TTLCache(1000, STORY_TRAY_TTL)
+_profile_lookups = {}  # username -> Task resolving its userid
+_tray_fetches = {}  # userid -> Task fetching that tray
+register_cache("ig_profile_id", _profile_ids)
+register_cache("story_tray", _story_trays)
+
+
+async def _lookup_userid(L: instaloader.Instaloader, username: str) -> int:
+    userid = await get_profile_id(username, IG_PROFILE_ID_TTL)
+    if userid is None:
+        profile = await instagram_executor.run(instaloader.Profile.from_username, L.context, username)
+        userid = profile.userid
+        await save_profile_id(username, userid)
+    return userid
+
+
+async def resolve_userid(L: instaloader.Instaloader, username: str) -> int:
+    """Returns the numeric Instagram id for a username, asking Instagram at most once per TTL."""
+    username = username.lower()
+    userid = _profile_ids.get(username)
+    if userid is None:
+        task = _profile_lookups.get(username)
+        if task is None:
+            task = asyncio.create_task(_lookup_userid(L, username))
+            _profile_lookups[username] = task
+            task.add_done_callback(lambda _: _profile_lookups.pop(username, None))
+        userid = await asyncio.shield(task)
+        _profile_ids.set(username, userid)
+    return userid
+
+
+def _fetch_story_tray(L: instaloader.Instaloader, userid: int) -> dict:
+    """Fetches a user's current stories. This is a blocking function."""
+    return {
+        item.mediaid: item
+        for story in L.get_stories([userid])
+        for item in story.get_items()
+    }
+
+
+async def get_story_tray(L: instaloader.Instaloader, userid: int, refresh: bool = False) -> dict:
+    """Returns {mediaid: StoryItem} for a user, sharing one fetch between concurrent callers."""
+    if not refresh:
+        tray = _story_trays.get(userid)
+        if tray is not None:
+            return tray
+    task = _tray_fetches.get(userid)
+    if task is None:
+        task = asyncio.create_task(instagram_executor.run(_fetch_story_tray, L, userid))
+        _tray_fetches[userid] = task
+        task.add_done_callback(lambda _: _tray_fetches.pop(userid, None))
+    tray = await asyncio.shield(task)
+    _story_trays.set(userid, tray)
+    return tray
+
+
+async def find_story_item(L: instaloader.Instaloader, username: str, story_id: int):
+    """Looks up one story item, refreshing a cached tray once if the story is newer than it."""
+    userid = await resolve_userid(L, username)
+    was_cached = _story_trays.get(userid) is not None
+    tray = await get_story_tray(L, userid)
+    if story_id not in tray and was_cached:
+        tray = await get_story_tray(L, userid, refresh=True)
+    return tray.get(story_id)
+
+
+async def _resolve_with(L: instaloader.Instaloader, link: InstagramLink):
+    """
+    Looks up the post or story item behind a link using one leased Instaloader instance.
+    Returns: (post_or_storyitem, caption, error_message)
+    """
+    if link.kind in ("post", "reel", "tv"):
+        post = await instagram_executor.run(
+            instaloader.Post.from_shortcode, L.context, link.shortcode
+        )
+        return post, post.caption, None
+
+    if link.kind == "story":
+        story_item = await find_story_item(L, link.username, link.media_id)
+        if story_item:
+            return story_item, f"Story from {link.username}", None
+        return None, None, "Error: Story not found or expired."
+
+    if link.kind == "highlight":
+        # Instaloader can only list highlights through their owner's profile,
+        # which a highlight link doesn't name.
+        logger.warning("Highlight download is experimental.")
+        return None, None, "Error: Highlight downloads are complex and not fully supported in this version."
+
+    return None, None, "Error: Unknown Instagram URL format."
+
+
+def _media_urls(item) -> list:
+    """
+    Lists the CDN URLs of a post (every sidecar node) or story item.
+    Returns: [("photo"|"video", url), ...]. May query Instagram, so it is blocking.
+    """
+    if isinstance(item, instaloader.Post) and item.typename == "GraphSidecar":
+        return [
+            ("video", node.video_url) if node.is_video else ("photo", node.display_url)
+            for node in item.get_sidecar_nodes()
+        ]
+    if item.is_video:
+        return [("video", item.video_url)]
+    return [("photo", item.url)]
 
-def login_instaloader():
-    """Logs into Instaloader. This is a blocking function."""
-    if not IG_USER or not IG_PASS:
-        logger.warning("No IG_USER or IG_PASS set. Running without login.")
-        logger.warning("May face rate limits or fail to download stories/highlights.")
-        return
-    
-    try:
-        logger.info(f"Attempting Instaloader login as {IG_USER}...")
-        L.login(IG_USER, IG_PASS)
-        logger.info(f"Instaloader login successful for {IG_USER}.")
-    except Exception as e:
-        logger.error(f"Instaloader login failed for {IG_USER}: {e}")
-        logger.warning("Continuing without login.")
 
-# --- Regex for URL detection ---
-POST_REGEX = r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/(?:p|reel|tv)\/([a-zA-Z0-9_-]+)\/?"
-STORY_REGEX = r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/stories\/([a-zA-Z0-9_.-]+)\/(\d+)\/?"
-HIGHLIGHT_REGEX = r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/s\/([a-zA-Z0-9_-]+)\/?"
-# Combined regex for all types
-INSTA_REGEX = r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/(?:p|reel|tv|stories|s)\/.*"
+# Known download failures and the message shown to the user, checked in order
+DOWNLOAD_ERRORS = (
+    (ProfileNotExistsException, "Error: The profile does not exist."),
+    (PrivateProfileNotFollowedException, "Error: This is a private profile. The bot cannot access it."),
+    (LoginRequiredException, "Error: Login is required to view this. (Bot login may have failed)"),
+    (QueryReturnedBadRequestException, "Error: Bad request. The link might be invalid."),
+    (TooManyRequestsException, "Error: Bot is rate-limited by Instagram. Please try again later."),
+    (asyncio.TimeoutError, "Error: Instagram took too long to respond. Please try again later."),
+    (aiohttp.ClientError, "Error: Could not fetch the media from Instagram's servers."),
+)
 
 
-async def download_media(url: str, user_id: int):
+async def _fetch_media(link: InstagramLink, target_dir: str):
     """
-    Downloads media from a given Instagram URL.
-    Returns: (list_of_media_paths, caption, target_directory, error_message)
+    Downloads the media behind an Instagram link as MediaBuffers. With
+    STREAM_MEDIA they stay in memory (up to STREAM_MEMORY_LIMIT each),
+    otherwise they are written into target_dir.
+    Returns: (list_of_media, caption, target_directory, error_message)
     """
-    target_dir = f"downloads/{user_id}_{instaloader.utils.md5(url)}"
-    
     try:
-        if "/p/" in url or "/reel/" in url or "/tv/" in url:
-            # It's a Post, Reel, or IGTV
-            shortcode = url.split("/")[-2]
-            post = await asyncio.to_thread(
-                instaloader.Post.from_shortcode, L.context, shortcode
-            )
-            await asyncio.to_thread(L.download_post, post, target=target_dir)
-            caption = post.caption
-            
-        elif "/stories/" in url:
-            # It's a Story
-            parts = url.split('/')
-            username = parts[-3]
-            story_id = int(parts[-2])
-            
-            profile = await asyncio.to_thread(instaloader.Profile.from_username, L.context, username)
-            story_item = None
-            for item in await asyncio.to_thread(L.get_stories, [profile.userid]):
-                if item.mediaid == story_id:
-                    story_item = item
+        for attempt in range(IG_MAX_SESSION_ATTEMPTS):
+            async with session_pool.lease(link.requires_login) as session:
+                L = session.loader
+                try:
+                    with instagram_fetch_seconds.labels("resolve").time(), span("resolve"):
+                        item, caption, error = await _resolve_with(L, link)
+                        if error:
+                            return None, None, None, error
+                        media_urls = await instagram_executor.run(_media_urls, item)
                     break
-            
-            if story_item:
-                await asyncio.to_thread(L.download_storyitem, story_item, target=target_dir)
-                caption = f"Story from {username}"
-            else:
-                return None, None, None, "Error: Story not found or expired."
-
-        elif "/s/" in url:
-            # It's a Highlight
-            highlight_url = url.split('?')[0]
-            
-            # This is a bit of a hack as Instaloader doesn't have a direct
-            # `from_url` for highlights. We try to get the owner.
-            logger.warning("Highlight download is experimental.")
-            # We can't easily get highlight items from just the URL.
-            # This part is complex and often requires a logged-in session.
-            # For this example, we'll state it's difficult.
-            # A more robust solution would be needed.
-            return None, None, None, "Error: Highlight downloads are complex and not fully supported in this version."
+                except CallTimeout:
+                    # The abandoned thread still uses this loader until its
+                    # requests time out; keep other jobs off it until then
+                    session.rest(IG_REQUEST_TIMEOUT * 3)
+                    raise
+                except LoginRequiredException:
+                    # Instagram no longer accepts this session's cookies
+                    session_pool.report_expired(session)
+                    raise
+                except TooManyRequestsException:
+                    # The session is now cooling down; retry on another one
+                    if attempt + 1 >= IG_MAX_SESSION_ATTEMPTS:
+                        raise
+                    logger.info(f"Retrying {link.url} on another Instagram session.")
 
-        else:
-            return None, None, None, "Error: Unknown Instagram URL format."
-
-        # Find all downloaded media files
-        files = glob.glob(os.path.join(target_dir, "*.*"))
-        # Filter out metadata files
-        media_files = [f for f in files if not f.endswith(('.json', '.txt', '.xz'))]
+        # CDN downloads don't need the Instagram session any more.
+        # Carousel items are fetched in parallel.
+        memory_limit = STREAM_MEMORY_LIMIT if STREAM_MEDIA else 0
+        with instagram_fetch_seconds.labels("media").time(), span("download"):
+            media_files = await fetch_all(media_urls, target_dir, memory_limit)
 
         if not media_files:
             return None, None, target_dir, "Error: Downloaded, but no media files found."
 
         return media_files, (caption or ""), target_dir, None
 
-    except ProfileNotExistsException:
-        return None, None, target_dir, "Error: The profile does not exist."
-    except PrivateProfileNotFollowedException:
-        return None, None, target_dir, "Error: This is a private profile. The bot cannot access it."
-    except LoginRequiredException:
-        return None, None, target_dir, "Error: Login is required to view this. (Bot login may have failed)"
-    except BadRequestsException:
-        return None, None, target_dir, "Error: Bad request. The link might be invalid."
-    except TooManyRequestsException:
-        return None, None, target_dir, "Error: Bot is rate-limited by Instagram. Please try again later."
     except Exception as e:
-        logger.error(f"Unexpected download error for {url}: {e}")
-        return None, None, target_dir, f"An unexpected error occurred: {e}"
-    
+        download_errors.labels(type(e).__name__).inc()
+        for exc_type, error_message in DOWNLOAD_ERRORS:
+            if isinstance(e, exc_type):
+                break
+        else:
+            logger.error(f"Unexpected download error for {link.url}: {e}")
+            return None, None, target_dir, f"An unexpected error occurred: {e}"
+        if isinstance(e, aiohttp.ClientError):
+            logger.error(f"Media fetch failed for {link.url}: {e}")
+        return None, None, target_dir, error_message
+
+
+# --- In-flight Request Coalescing ---
+# Concurrent requests for the same post/story share one fetch and one spool
+# directory, and a download finished moments ago is reused from the spool.
+# Every consumer holds a reference on the directory; cleanup_directory()
+# releases it and the spool decides when the files are removed.
+
+class _Flight:
+    __slots__ = ("task", "target_dir")
+
+    def __init__(self, task: asyncio.Task, target_dir: str):
+        self.task = task
+        self.target_dir = target_dir
+
+_inflight = {}  # media_key -> _Flight
+
+
+def is_inflight(link: InstagramLink) -> bool:
+    """True if the media behind this link is already being fetched."""
+    return link.key in _inflight
+
+
+async def _fetch_into_spool(link: InstagramLink, target_dir: str):
+    result = await _fetch_media(link, target_dir)
+    if result[3] is None:
+        spool.complete(target_dir, result)
+    return result
+
+
+async def download_media(link: InstagramLink, user_id: int):
+    """
+    Downloads the media behind an Instagram link, reusing a recent download or
+    joining an identical fetch that is already in progress. Call
+    cleanup_directory() on the returned directory once the files have been sent.
+    Returns: (list_of_media, caption, target_directory, error_message)
+    """
+    key = link.key
+    result = spool.reuse(key)
+    if result is not None:
+        logger.info(f"Reusing spooled download of {key}.")
+        return result
+
+    flight = _inflight.get(key)
+    if flight is None:
+        target_dir = spool.allocate(key)
+        task = asyncio.create_task(_fetch_into_spool(link, target_dir))
+        flight = _inflight[key] = _Flight(task, target_dir)
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        logger.info(f"Joining in-flight download of {key}.")
+        target_dir = flight.target_dir
+        spool.retain(target_dir)
+
+    try:
+        # Shielded so one cancelled consumer doesn't cancel the shared fetch
+        result = await asyncio.shield(flight.task)
+    except BaseException:
+        await spool.release(target_dir)
+        raise
+
+    if result[2] is None:
+        # Nothing for the caller to clean up; drop our reference here
+        await spool.release(target_dir)
+    return result
+
+
 async def cleanup_directory(directory: str):
-    """Asynchronously removes a directory and its contents."""
-    if directory and os.path.exists(directory):
-        try:
-            await asyncio.to_thread(shutil.rmtree, directory)
-        except Exception as e:
-            logger.error(f"Failed to clean up directory {directory}: {e}")
+    """Releases a download directory; the spool removes or keeps it for reuse."""
+    if directory:
+        await spool.release(directory)
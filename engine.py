@@ -0,0 +1,73 @@
+import asyncio
+import importlib
+import logging
+from spool import spool
+from media_fetcher import close_session
+from startup import startup
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadEngine:
+    """
+    The Instagram side of the bot: Instaloader, the session pool and the
+    download spool. Importing Instaloader and its requests stack is slow, so
+    it is loaded in the background once the bot is serving, or on first use.
+    Handlers call ready() and then use the modules through this object.
+    """
+
+    def __init__(self):
+        self.downloader = None
+        self.session_pool = None
+        self._task = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.downloader is not None
+
+    def start(self):
+        """Starts loading the engine in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._load())
+
+    async def ready(self):
+        """Waits until the engine is loaded, starting the load if nobody has yet."""
+        self.start()
+        task = self._task
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            # Let the next caller try again
+            if self._task is task:
+                self._task = None
+            raise
+
+    async def _load(self):
+        with startup.phase("engine", background=True):
+            # Imported on a thread so the loop keeps serving in the meantime
+            downloader = await asyncio.to_thread(importlib.import_module, "downloader")
+            session_pool = downloader.session_pool
+            await spool.start()
+            # Saved Instagram logins are usable right away; the check runs in the background
+            restored = session_pool.restore_all()
+            logger.info(f"Restored {restored}/{len(session_pool.accounts)} saved Instagram sessions.")
+            session_pool.start()
+        self.downloader, self.session_pool = downloader, session_pool
+        logger.info("Download engine loaded.")
+
+    async def stop(self):
+        """Stops the engine's background work; does nothing if it was never loaded."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if not self.loaded:
+            return
+        await self.session_pool.stop()  # Save the current Instagram cookies
+        await spool.stop()
+        await close_session()  # Close keep-alive connections to the CDN
+
+
+engine = DownloadEngine()
@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import IG_EXECUTOR_WORKERS, IG_CALL_TIMEOUT, FS_EXECUTOR_WORKERS
+from metrics import GaugeFunc, CounterFunc
+
+logger = logging.getLogger(__name__)
+
+
+class CallTimeout(asyncio.TimeoutError):
+    """A call ran longer than its timeout; its thread is still busy with it."""
+
+
+class InstrumentedExecutor:
+    """
+    A named thread pool for one kind of blocking work, with a per-call
+    timeout and queue/worker/duration counters.
+    """
+
+    def __init__(self, name: str, max_workers: int, timeout: float | None = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._durations = deque(maxlen=1000)  # Recent call durations in seconds
+
+    def _call(self, func, args, kwargs, on_start):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        on_start()
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self._durations.append(time.monotonic() - started)
+
+    def _dequeue_cancelled(self, future):
+        """Done-callback: a call cancelled before a thread picked it up never ran _call()."""
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func, *args, timeout: float | None = ..., **kwargs):
+        """
+        Runs func(*args, **kwargs) on this pool, like asyncio.to_thread().
+        Raises CallTimeout if it runs longer than the timeout, counted from
+        when a thread starts it (the default is the executor's; pass None
+        to wait forever).
+        """
+        if timeout is ...:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        started = asyncio.Event()
+        with self._lock:
+            self.queued += 1
+        call = functools.partial(
+            ctx.run, self._call, func, args, kwargs, lambda: loop.call_soon_threadsafe(started.set)
+        )
+        concurrent_future = self._pool.submit(call)
+        concurrent_future.add_done_callback(self._dequeue_cancelled)
+        future = asyncio.wrap_future(concurrent_future)
+        if timeout is None:
+            return await future
+
+        # Wait for a thread without a deadline; cancelling us still cancels the call
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait((waiter, future), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            waiter.cancel()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # The thread can't be interrupted; it is freed when the call returns
+            self.timeouts += 1
+            logger.warning(f"{self.name}: {getattr(func, '__name__', func)} timed out after {timeout}s.")
+            raise CallTimeout(f"{getattr(func, '__name__', func)} ran longer than {timeout}s") from None
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        durations = sorted(self._durations)
+        return {
+            "name": self.name,
+            "workers": self.max_workers,
+            "active": self.active,
+            "queued": self.queued,
+            "completed": self.completed,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg_duration": (sum(durations) / len(durations)) if durations else 0.0,
+            "p95_duration": durations[int(len(durations) * 0.95)] if durations else 0.0,
+        }
+
+
+# Blocking Instaloader calls (network I/O to Instagram)
+instagram_executor = InstrumentedExecutor("instagram", IG_EXECUTOR_WORKERS, IG_CALL_TIMEOUT)
+# Filesystem work such as removing download directories
+fs_executor = InstrumentedExecutor("filesystem", FS_EXECUTOR_WORKERS)
+
+# --- Metrics ---
+_executors = (instagram_executor, fs_executor)
+GaugeFunc(
+    "bot_executor_active", "Threads running a call, by pool.",
+    lambda: {(e.name,): e.active for e in _executors}, ("pool",)
+)
+GaugeFunc(
+    "bot_executor_queued", "Calls waiting for a thread, by pool.",
+    lambda: {(e.name,): e.queued for e in _executors}, ("pool",)
+)
+CounterFunc(
+    "bot_executor_timeouts", "Calls that exceeded their timeout, by pool.",
+    lambda: {(e.name,): e.timeouts for e in _executors}, ("pool",)
+)
@@ -0,0 +1,379 @@
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from config import (
+    JOB_BROKER, JOB_POLL_INTERVAL, JOB_LEASE_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_RETENTION
+)
+from Database import db
+from metrics import GaugeFunc, Counter
+
+logger = logging.getLogger(__name__)
+
+# Every accepted link is a job, which also makes the table a journal that
+# survives restarts: queued -> downloading -> uploading -> done or failed.
+# A failed job is "notified" once the user has been told why; jobs no worker
+# finished within JOB_MAX_ATTEMPTS leases fail unnotified (see expire()).
+SWEEP_INTERVAL = 30  # Seconds between checks for expired leases and old jobs
+
+
+# --- Brokers ---
+# Where jobs are stored and how they are handed out. The SQLite broker uses
+# the bot's database, so an ingress and workers on one machine (or sharing
+# the database file) need nothing else; a networked broker for workers on
+# other machines only has to implement the same methods.
+
+class Broker(ABC):
+    """Interface of a job store. Every method is a coroutine."""
+
+    @abstractmethod
+    async def put(self, payload: dict, priority: int, state: str = "queued") -> int:
+        """Records a job (queued, or already being worked on here); returns its id."""
+        ...
+
+    @abstractmethod
+    async def claim(self, worker: str, limit: int, lease_until: float) -> list:
+        """Hands up to `limit` queued jobs to `worker`: [{"job_id", "payload", "attempts"}]."""
+        ...
+
+    @abstractmethod
+    async def renew(self, worker: str, job_ids: list, lease_until: float):
+        ...
+
+    @abstractmethod
+    async def mark(self, job_id: int, state: str):
+        ...
+
+    @abstractmethod
+    async def finish(self, job_id: int, state: str, error: str | None = None, notified: bool = True):
+        ...
+
+    @abstractmethod
+    async def mark_notified(self, job_ids: list):
+        ...
+
+    @abstractmethod
+    async def release(self, worker: str) -> int:
+        """Requeues the jobs a stopping worker still holds."""
+        ...
+
+    @abstractmethod
+    async def requeue_unleased(self) -> int:
+        """Queues the jobs an all-in-one node left unfinished."""
+        ...
+
+    @abstractmethod
+    async def expire(self, max_attempts: int) -> tuple:
+        """Requeues or fails jobs with an expired lease. Returns (requeued, failed)."""
+        ...
+
+    @abstractmethod
+    async def outcomes(self, job_ids: list) -> dict:
+        """{job_id: {"state", "error", "notified"}} for the finished ones among job_ids."""
+        ...
+
+    @abstractmethod
+    async def unfinished(self) -> list:
+        ...
+
+    @abstractmethod
+    async def unreported(self) -> list:
+        """Failed jobs whose user was never told."""
+        ...
+
+    @abstractmethod
+    async def counts(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def prune(self, before: float) -> int:
+        ...
+
+
+class SQLiteBroker(Broker):
+    """Jobs in the `jobs` table of the bot's database (queries in Database/db.py)."""
+
+    async def put(self, payload: dict, priority: int, state: str = "queued") -> int:
+        return await db.enqueue_job(payload, priority, state)
+
+    async def claim(self, worker: str, limit: int, lease_until: float) -> list:
+        return await db.claim_jobs(worker, limit, lease_until)
+
+    async def renew(self, worker: str, job_ids: list, lease_until: float):
+        await db.renew_jobs(worker, job_ids, lease_until)
+
+    async def mark(self, job_id: int, state: str):
+        await db.set_job_state(job_id, state)
+
+    async def finish(self, job_id: int, state: str, error: str | None = None, notified: bool = True):
+        await db.finish_job(job_id, state, error, notified)
+
+    async def mark_notified(self, job_ids: list):
+        await db.mark_jobs_notified(job_ids)
+
+    async def release(self, worker: str) -> int:
+        return await db.release_jobs(worker)
+
+    async def requeue_unleased(self) -> int:
+        return await db.requeue_unleased_jobs()
+
+    async def expire(self, max_attempts: int) -> tuple:
+        return await db.expire_jobs(max_attempts)
+
+    async def outcomes(self, job_ids: list) -> dict:
+        return await db.get_job_outcomes(job_ids)
+
+    async def unfinished(self) -> list:
+        return await db.get_unfinished_jobs()
+
+    async def unreported(self) -> list:
+        return await db.get_unnotified_failures()
+
+    async def counts(self) -> dict:
+        return await db.count_jobs()
+
+    async def prune(self, before: float) -> int:
+        return await db.prune_jobs(before)
+
+
+BROKERS = {"sqlite": SQLiteBroker}
+
+
+def create_broker(name: str) -> Broker:
+    try:
+        return BROKERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown JOB_BROKER {name!r}, expected one of: {', '.join(BROKERS)}")
+
+
+# --- Job Queue ---
+
+class JobQueue:
+    """
+    Hands links from an ingress node to worker nodes, and journals the links
+    an all-in-one node works on itself.
+
+    The ingress queues links with record() and wait()s for the outcome; one
+    poller checks all waiting jobs at once. A worker calls serve() with a handler coroutine and
+    keeps up to `concurrency` jobs running, renewing their leases while they
+    run. If a worker dies its jobs are requeued once their lease expires.
+    An all-in-one node uses record(), mark() and finish() around its own work.
+    """
+
+    def __init__(self, broker: Broker, poll_interval: float, lease_timeout: float,
+                 max_attempts: int, retention: float):
+        self.broker = broker
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._waiting = {}  # job_id -> Future of its outcome (ingress)
+        self._poller = None
+        self._sweeper = None
+        self._worker = None
+        self.worker_name = None
+        self._running = {}  # job_id -> Task (worker)
+        self._slot_freed = asyncio.Event()
+
+    # --- Ingress ---
+
+    async def wait(self, job_id: int) -> dict:
+        """
+        Waits until a worker finished a job queued with record().
+        Returns {"job_id", "state", "error", "notified"}.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[job_id] = future
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_loop())
+        try:
+            return await future
+        finally:
+            self._waiting.pop(job_id, None)
+
+    async def _poll_loop(self):
+        while self._waiting:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                outcomes = await self.broker.outcomes(list(self._waiting))
+            except Exception as e:
+                logger.error(f"Polling job outcomes failed: {e}")
+                continue
+            for job_id, outcome in outcomes.items():
+                future = self._waiting.get(job_id)
+                if future is not None and not future.done():
+                    future.set_result({"job_id": job_id, **outcome})
+
+    # --- Worker ---
+
+    def serve(self, handler, worker: str, concurrency: int):
+        """
+        Starts taking jobs as `worker`. `await handler(job)` returns True if
+        the job succeeded; exceptions mark it failed.
+        """
+        if self._worker is None:
+            self.worker_name = worker
+            self._worker = asyncio.create_task(self._serve_loop(handler, concurrency))
+            logger.info(f"Worker {worker} is taking jobs ({concurrency} at a time).")
+
+    async def _serve_loop(self, handler, concurrency: int):
+        next_renewal = time.monotonic() + self.lease_timeout / 3
+        while True:
+            claimed = []
+            free = concurrency - len(self._running)
+            if free > 0:
+                try:
+                    claimed = await self.broker.claim(
+                        self.worker_name, free, time.time() + self.lease_timeout
+                    )
+                except Exception as e:
+                    logger.error(f"Claiming jobs failed: {e}")
+            for job in claimed:
+                task = asyncio.create_task(self._run_job(handler, job))
+                self._running[job["job_id"]] = task
+                task.add_done_callback(lambda _, job_id=job["job_id"]: self._job_done(job_id))
+
+            if time.monotonic() >= next_renewal:
+                next_renewal = time.monotonic() + self.lease_timeout / 3
+                try:
+                    await self.broker.renew(
+                        self.worker_name, list(self._running), time.time() + self.lease_timeout
+                    )
+                except Exception as e:
+                    logger.error(f"Renewing job leases failed: {e}")
+            # Claim again right away while there is a backlog
+            if len(claimed) < free or free <= 0:
+                self._slot_freed.clear()
+                try:
+                    await asyncio.wait_for(self._slot_freed.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _job_done(self, job_id: int):
+        self._running.pop(job_id, None)
+        self._slot_freed.set()
+
+    async def _run_job(self, handler, job: dict):
+        job_id = job["job_id"]
+        try:
+            ok = await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The handler did not get to tell the user
+            logger.error(f"Job {job_id} failed: {e}")
+            state, error, notified = "failed", str(e), False
+        else:
+            state, error, notified = ("done" if ok else "failed"), None, True
+        jobs_finished.labels(state).inc()
+        try:
+            await self.broker.finish(job_id, state, error, notified)
+        except Exception as e:
+            # The lease runs out and another worker repeats the job
+            logger.error(f"Could not record the outcome of job {job_id}: {e}")
+
+    # --- Journal ---
+    # Best effort: a link is still downloaded if its journal entry can't be written.
+
+    async def record(self, payload: dict, priority: int, state: str = "queued") -> int | None:
+        """Journals a link; returns its job id, or None if the database refused."""
+        try:
+            return await self.broker.put(payload, priority, state)
+        except Exception as e:
+            logger.error(f"Could not journal {payload.get('url')}: {e}")
+            return None
+
+    async def mark(self, job_id: int | None, state: str):
+        if job_id is None:
+            return
+        try:
+            await self.broker.mark(job_id, state)
+        except Exception as e:
+            logger.error(f"Could not move job {job_id} to {state}: {e}")
+
+    async def finish(self, job_id: int | None, state: str, error: str | None = None, notified: bool = True):
+        if job_id is None:
+            return
+        try:
+            await self.broker.finish(job_id, state, error, notified)
+        except Exception as e:
+            logger.error(f"Could not record the outcome of job {job_id}: {e}")
+
+    async def mark_notified(self, job_ids: list):
+        try:
+            await self.broker.mark_notified(job_ids)
+        except Exception as e:
+            logger.error(f"Could not flag jobs {job_ids} as notified: {e}")
+
+    # --- Replay ---
+
+    async def unfinished(self) -> list:
+        """Jobs not done or failed yet, oldest first."""
+        return await self.broker.unfinished()
+
+    async def unreported(self) -> list:
+        """Failed jobs whose user was never told."""
+        return await self.broker.unreported()
+
+    async def requeue_unleased(self) -> int:
+        """Hands the links an all-in-one node left unfinished to the workers."""
+        return await self.broker.requeue_unleased()
+
+    # --- Maintenance ---
+
+    def start(self):
+        """
+        Starts requeueing jobs of dead workers and pruning old ones (any node
+        may do it; an all-in-one node's own jobs have no lease and are left alone).
+        """
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                requeued, failed = await self.broker.expire(self.max_attempts)
+                if requeued or failed:
+                    logger.warning(f"Jobs with an expired lease: {requeued} requeued, {failed} failed.")
+                await self.broker.prune(time.time() - self.retention)
+            except Exception as e:
+                logger.error(f"Job queue sweep failed: {e}")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def stop(self, timeout: float = 0):
+        """
+        Stops taking jobs and gives the ones running on this worker up to
+        `timeout` seconds to finish; the rest go back to the queue.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        if self._running and timeout > 0:
+            logger.info(f"Waiting up to {timeout:.0f}s for {len(self._running)} running jobs.")
+            await asyncio.wait(list(self._running.values()), timeout=timeout)
+        tasks = [t for t in (self._sweeper, self._poller) if t is not None]
+        tasks += list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sweeper = self._poller = self._worker = None
+        if self.worker_name is not None:
+            released = await self.broker.release(self.worker_name)
+            if released:
+                logger.info(f"Returned {released} unfinished jobs to the queue.")
+
+    async def stats(self) -> dict:
+        counts = await self.broker.counts()
+        counts["waiting_here"] = len(self._waiting)
+        counts["running_here"] = len(self._running)
+        return counts
+
+
+job_queue = JobQueue(
+    create_broker(JOB_BROKER), JOB_POLL_INTERVAL, JOB_LEASE_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_RETENTION
+)
+
+# --- Metrics ---
+jobs_finished = Counter("bot_jobs_finished_total", "Queued link jobs finished on this worker, by state.", ("state",))
+GaugeFunc("bot_jobs_waiting", "Links this ingress node is waiting on a worker for.", lambda: len(job_queue._waiting))
+GaugeFunc("bot_jobs_running", "Queued links this worker node is working on.", lambda: len(job_queue._running))
@@ -0,0 +1,124 @@
+import re
+import base64
+import binascii
+
+# --- Link Parsing ---
+# One precompiled pattern recognises every supported Instagram link. Variants
+# of the same media (instagr.am, m./www. hosts, /reels/, /<user>/p/..., share
+# params such as ?igsh=) all parse to the same InstagramLink, so a message
+# that pastes a post twice fetches it once and cache keys are canonical.
+
+_LINK_RE = re.compile(r"""
+    (?<![\w.-])
+    (?:https?://)?
+    (?:(?:www|m)\.)?(?:instagram\.com|instagr\.am)/
+    (?:
+        stories/highlights/(?P<highlight>\d+)
+      | stories/(?P<username>[A-Za-z0-9_.]{1,30})/(?P<story_id>\d+)
+      | (?:[A-Za-z0-9_.]{1,30}/)?(?P<kind>p|reels?|tv)/(?P<shortcode>[A-Za-z0-9_-]+)
+      | s/(?P<share>[A-Za-z0-9_-]+)
+    )
+""", re.VERBOSE | re.IGNORECASE)
+
+# Path segment of each post-like kind
+_POST_KINDS = {"p": "post", "reel": "reel", "reels": "reel", "tv": "tv"}
+_KIND_PATHS = {"post": "p", "reel": "reel", "tv": "tv"}
+
+
+class InstagramLink:
+    """
+    One piece of Instagram media referenced by a link.
+
+    kind is post, reel, tv, story or highlight. Posts, reels and IGTV have a
+    shortcode, stories a username and media_id, highlights a highlight_id.
+    """
+
+    __slots__ = ("kind", "shortcode", "username", "media_id", "highlight_id")
+
+    def __init__(self, kind: str, shortcode: str = None, username: str = None,
+                 media_id: int = None, highlight_id: int = None):
+        self.kind = kind
+        self.shortcode = shortcode
+        self.username = username
+        self.media_id = media_id
+        self.highlight_id = highlight_id
+
+    @property
+    def key(self) -> str:
+        """Stable cache key, e.g. "post:Cxyz123" (also for reels and IGTV) or "story:3141592653"."""
+        if self.kind == "story":
+            return f"story:{self.media_id}"
+        if self.kind == "highlight":
+            return f"highlight:{self.highlight_id}"
+        return f"post:{self.shortcode}"
+
+    @property
+    def url(self) -> str:
+        """Canonical URL of the media, without share parameters."""
+        if self.kind == "story":
+            return f"https://www.instagram.com/stories/{self.username}/{self.media_id}/"
+        if self.kind == "highlight":
+            return f"https://www.instagram.com/stories/highlights/{self.highlight_id}/"
+        return f"https://www.instagram.com/{_KIND_PATHS[self.kind]}/{self.shortcode}/"
+
+    @property
+    def requires_login(self) -> bool:
+        """Stories are only visible to logged-in sessions."""
+        return self.kind == "story"
+
+    def __eq__(self, other):
+        return isinstance(other, InstagramLink) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"InstagramLink({self.url!r})"
+
+
+def _decode_share(token: str) -> int | None:
+    """/s/ links carry base64 of "highlight:<id>"; returns the id."""
+    try:
+        decoded = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    kind, _, value = decoded.partition(":")
+    return int(value) if kind == "highlight" and value.isdigit() else None
+
+
+def _from_match(match: re.Match) -> InstagramLink | None:
+    if match["shortcode"]:
+        return InstagramLink(_POST_KINDS[match["kind"].lower()], shortcode=match["shortcode"])
+    if match["story_id"]:
+        return InstagramLink("story", username=match["username"].lower(), media_id=int(match["story_id"]))
+    highlight_id = int(match["highlight"]) if match["highlight"] else _decode_share(match["share"])
+    if highlight_id is None:
+        return None
+    return InstagramLink("highlight", highlight_id=highlight_id)
+
+
+def parse_link(url: str) -> InstagramLink | None:
+    """Parses a single URL; None if it isn't a supported Instagram link."""
+    match = _LINK_RE.search(url)
+    return _from_match(match) if match else None
+
+
+def find_links(text: str | None, extra_urls=()) -> list:
+    """
+    Finds every Instagram link in `text` and in `extra_urls` (e.g. hidden
+    text links), in order of appearance and without duplicates.
+    """
+    links = {}
+    for source in (text or "", *extra_urls):
+        for match in _LINK_RE.finditer(source):
+            link = _from_match(match)
+            if link is not None and link.key not in links:
+                links[link.key] = link
+    return list(links.values())
+
+
+def message_links(message) -> list:
+    """Instagram links in a Telegram message's text or caption and its text-link entities."""
+    entities = message.entities or message.caption_entities or []
+    return find_links(message.text or message.caption,
+                      [entity.url for entity in entities if getattr(entity, "url", None)])
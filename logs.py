@@ -0,0 +1,215 @@
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import queue
+import shutil
+import atexit
+import logging
+import logging.handlers
+from collections import deque
+from datetime import datetime, timedelta
+from config import LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUP_COUNT
+from tracing import current_trace
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Every line, text or JSON, starts with the record's local time in this form
+LINE_TIME_RE = re.compile(r'^(?:\{"time": ")?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)')
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+# --- Formatting ---
+
+class TraceIdFilter(logging.Filter):
+    """
+    Stamps records with the current link's trace id. Runs in the thread that
+    logs, since the context is gone once the record is on the queue.
+    """
+
+    def filter(self, record):
+        trace = current_trace()
+        record.trace_id = trace.trace_id if trace is not None else None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and trace_id."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# --- Rotation ---
+
+class CompressingRotatingHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Rotates the log file when it reaches max_bytes or at local midnight,
+    gzips the old segment as <file>.<YYYYmmdd-HHMMSS>.gz (the time it was
+    closed) and keeps the newest backup_count segments (all of them if it is
+    0, as in the stdlib handlers). Runs on the listener thread, so
+    compression never blocks the event loop.
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int):
+        super().__init__(filename, "a", encoding="utf-8", delay=False)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.next_rollover = self._next_midnight()
+
+    @staticmethod
+    def _next_midnight() -> float:
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+    def shouldRollover(self, record) -> bool:
+        if time.time() >= self.next_rollover:
+            return True
+        # Checked before the write, so a segment can exceed max_bytes by one record
+        return self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        stamp = time.strftime(SEGMENT_TIME_FORMAT)
+        target = f"{self.baseFilename}.{stamp}.gz"
+        n = 1
+        while os.path.exists(target):
+            target = f"{self.baseFilename}.{stamp}-{n}.gz"
+            n += 1
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            with open(self.baseFilename, "rb") as src, gzip.open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.baseFilename)
+        if self.backup_count > 0:
+            for old in log_segments(self.baseFilename)[:-self.backup_count]:
+                os.remove(old)
+        self.next_rollover = self._next_midnight()
+        self.stream = self._open()
+
+
+def log_segments(path: str = LOG_FILE) -> list:
+    """Rotated segments of a log file, oldest first (not including the live file)."""
+    return sorted(glob.glob(f"{glob.escape(os.path.abspath(path))}.*.gz"))
+
+
+# --- Setup ---
+# Handlers only put records on a queue; a listener thread formats them and
+# does the file and console writes, so logging never blocks the event loop
+# or the Instaloader worker threads.
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def setup_logging():
+    """Routes every log record through a queue to the file and console handlers."""
+    global _listener
+    if _listener is not None:
+        return
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    file_handler = CompressingRotatingHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+
+    _listener = logging.handlers.QueueListener(records, file_handler, console_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Writes out queued records and stops the listener thread."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+# --- Reading ---
+# Used by /log. Both read line by line, so the size of the log doesn't matter.
+
+def _line_time(line: str) -> datetime | None:
+    match = LINE_TIME_RE.match(line)
+    return datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S") if match else None
+
+
+def _open_segment(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def _segment_end(path: str) -> datetime | None:
+    """When a rotated segment was closed, from its name; None for the live file."""
+    stamp = os.path.basename(path).rsplit(".", 2)[-2].split("-")
+    try:
+        return datetime.strptime("-".join(stamp[:2]), SEGMENT_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def tail(count: int, path: str = LOG_FILE) -> list:
+    """The last `count` lines, reaching into rotated segments if the live file is shorter."""
+    lines = deque(maxlen=count)
+    if os.path.exists(path):
+        with _open_segment(path) as f:
+            lines.extend(f)
+    for segment in reversed(log_segments(path)):
+        if len(lines) >= count:
+            break
+        older = deque(maxlen=count - len(lines))
+        with _open_segment(segment) as f:
+            older.extend(f)
+        lines.extendleft(reversed(older))
+    return list(lines)
+
+
+def export_range(start: datetime, end: datetime, output: str, max_bytes: int,
+                 path: str = LOG_FILE) -> tuple:
+    """
+    Copies the lines logged between start and end into `output`, stopping at
+    max_bytes. Continuation lines (tracebacks) follow their record.
+    Returns: (lines_written, truncated)
+    """
+    sources = [s for s in log_segments(path) if (_segment_end(s) or end) >= start]
+    if os.path.exists(path):
+        sources.append(path)
+    written, size, keep = 0, 0, False
+    with open(output, "w", encoding="utf-8") as out:
+        for source in sources:
+            with _open_segment(source) as f:
+                for line in f:
+                    line_time = _line_time(line)
+                    if line_time is not None:
+                        if line_time > end:
+                            return written, False
+                        keep = line_time >= start
+                    if not keep:
+                        continue
+                    size += len(line.encode("utf-8"))
+                    if size > max_bytes:
+                        return written, True
+                    out.write(line)
+                    written += 1
+    return written, False
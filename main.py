@@ -1,42 +1,77 @@
+from startup import startup  # First, so the import phase is timed
 import asyncio
 import logging
 import os
-from pyrogram import Client, idle
+import time
 from aiohttp import web
-from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID
-from Database.db import init_db
-from downloader import L, login_instaloader, L
+from config import (
+    API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, NODE_ROLE, NODE_NAME, JOB_WORKER_CONCURRENCY,
+    SHUTDOWN_DRAIN_TIMEOUT
+)
+from Database.db import init_db, close_db
+from Database.quota import quota
+from Database.stats import download_stats
+from scheduler import scheduler
+from executors import instagram_executor, fs_executor
+from engine import engine
+from jobqueue import job_queue
+import metrics
+from logs import setup_logging
 
 # --- File & Console Logging Setup ---
-LOG_FILE = "bot_logs.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# Records go through a queue to a listener thread that writes the rotating
+# log file (LOG_FILE) and the console
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# --- Bot Client Definition ---
-app = Client(
-    "InstaDownloaderBot",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    bot_token=BOT_TOKEN,
-    plugins=dict(root="Plugins")
-)
+# --- Staged Startup ---
+# Only what the health check needs is imported above. Pyrogram (and with it
+# the plugins) is imported once the health server is up, and the download
+# engine (Instaloader) is loaded in the background after the client started.
+
+def create_client():
+    """Imports Pyrogram and defines the bot client; its plugins load on start()."""
+    from pyrogram import Client
+    if NODE_ROLE == "worker":
+        # Workers only send; updates go to the ingress node. In memory, so
+        # several workers on one machine don't share a session file.
+        return Client(
+            "InstaDownloaderWorker",
+            api_id=API_ID,
+            api_hash=API_HASH,
+            bot_token=BOT_TOKEN,
+            in_memory=True,
+            no_updates=True
+        )
+    return Client(
+        "InstaDownloaderBot",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        bot_token=BOT_TOKEN,
+        plugins=dict(root="Plugins")
+    )
+
+async def load_engine_in_background():
+    """Loads the download engine and logs the startup report once it is ready."""
+    try:
+        await engine.ready()
+    except Exception as e:
+        logger.error(f"Loading the download engine failed, will retry on first use: {e}")
+    logger.info(startup.report())
 
 # --- Web Server for Health Checks ---
 async def health_check(request):
     """A simple health check endpoint."""
     return web.Response(text="Bot is alive and running!", status=200)
 
+async def metrics_handler(request):
+    """Prometheus scrape endpoint."""
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
 async def start_web_server():
     """Initializes and starts the lightweight web server."""
     web_app = web.Application()
-    web_app.add_routes([web.get('/', health_check)])
+    web_app.add_routes([web.get('/', health_check), web.get('/metrics', metrics_handler)])
     port = int(os.environ.get("PORT", 8080))
     
     runner = web.AppRunner(web_app)
@@ -51,39 +86,54 @@ async def start_web_server():
         raise
     return runner, site
 
-# --- NEW: Background Task for Instaloader ---
-async def background_instaloader_login():
-    """
-    Attempts to log into Instaloader in the background
-    so it doesn't block bot startup.
-    """
-    logger.info("Starting background Instaloader login...")
-    await asyncio.sleep(5) # Give the bot 5 seconds to start up
-    try:
-        # Run the blocking login function in a separate thread
-        await asyncio.to_thread(login_instaloader)
-        logger.info("Background Instaloader login attempt complete.")
-    except Exception as e:
-        logger.error(f"Background Instaloader login task failed: {e}")
-
 # --- Main Bot & Server Function ---
 async def main():
     """Main function to start the bot and web server."""
-    await init_db()
-    logger.info("Database initialized.")
+    if NODE_ROLE not in ("all", "ingress", "worker"):
+        raise ValueError(f"Unknown NODE_ROLE {NODE_ROLE!r}, expected all, ingress or worker")
+    startup.record("imports", startup.elapsed())
 
-    # --- START WEB AND BOT FIRST ---
-    # This ensures the bot is responsive immediately
-    web_runner, web_site = await start_web_server()
+    # --- START THE HEALTH SERVER FIRST ---
+    # The platform's health check on / has a deadline
+    with startup.phase("health_server"):
+        web_runner, web_site = await start_web_server()
 
-    logger.info("Starting Bot...")
-    await app.start()
+    with startup.phase("database"):
+        await init_db()
+        logger.info("Database initialized.")
+        quota.start()
+        download_stats.start()
+        metrics.loop_lag_monitor.start()
+        scheduler.start()
+
+    logger.info(f"Starting Bot as {NODE_ROLE} node...")
+    with startup.phase("client"):
+        app = create_client()
+        from pyrogram import idle
+        from broadcast import broadcaster
+        await app.start()
+    startup.serving()
     
     logger.info("Bot is starting up...")
 
-    # --- NOW, try the Instaloader login in the background ---
-    # This is no longer blocking startup.
-    asyncio.create_task(background_instaloader_login())
+    if NODE_ROLE == "ingress":
+        # Links go to the worker nodes; the engine only loads if /sessions needs it
+        logger.info(startup.report())
+    else:
+        # Instaloader, the session pool and the spool; handlers wait for it if needed
+        asyncio.create_task(load_engine_in_background())
+    job_queue.start()  # Requeues jobs of workers that died, prunes finished ones
+    if NODE_ROLE == "worker":
+        from Plugins.downloader_handler import run_link_job
+        job_queue.serve(lambda job: run_link_job(app, job), NODE_NAME, JOB_WORKER_CONCURRENCY)
+        await idle()
+        await shutdown(web_runner)
+        return
+
+    # Pick up broadcasts and links interrupted by the last shutdown or crash
+    await broadcaster.resume_all(app)
+    from Plugins.downloader_handler import replay_journal
+    await replay_journal(app)
 
     try:
         me = await app.get_me()
@@ -103,12 +153,32 @@ async def main():
 
     # Keep the script running
     await idle()
-    
-    # --- Shutdown sequence ---
-    # This code runs after /stop or Ctrl+C
+    await shutdown(web_runner)
+
+# --- Shutdown sequence ---
+# This code runs after SIGTERM, /stop or Ctrl+C
+async def shutdown(web_runner):
+    """
+    Lets links in progress finish within SHUTDOWN_DRAIN_TIMEOUT, then stops
+    the web server and background services and closes the database.
+    """
     logger.info("Shutting down...")
-    await web_runner.cleanup()  # Cleanly stop the web server
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    if NODE_ROLE != "worker":
+        from Plugins.downloader_handler import drain
+        await drain(SHUTDOWN_DRAIN_TIMEOUT)
+    # A worker's unfinished jobs go back to the queue
+    await job_queue.stop(max(0.0, deadline - time.monotonic()))
+    await web_runner.cleanup()  # Health checks pass until the links are drained
     logger.info("Web server stopped.")
+    await scheduler.stop()
+    await engine.stop()  # Saves Instagram cookies, closes CDN connections
+    await metrics.loop_lag_monitor.stop()
+    await quota.stop()  # Write pending download counters
+    await download_stats.stop()
+    await close_db()  # Flush the WAL and close pooled connections
+    instagram_executor.shutdown()
+    fs_executor.shutdown()
     # We skip app.stop() as it can cause loop errors on Render
     # The OS will terminate the process.
 
@@ -0,0 +1,194 @@
+import io
+import os
+import asyncio
+import logging
+import aiohttp
+from config import (
+    STREAM_MEMORY_LIMIT, MEDIA_FETCH_TIMEOUT, MEDIA_FETCH_CONNECTIONS,
+    MEDIA_FETCH_PER_HOST, MEDIA_FETCH_RETRIES
+)
+from executors import fs_executor
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Spilled data is written to disk in pieces of this size
+SPILL_WRITE_SIZE = 1024 * 1024
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
+# Errors after which the download is resumed with a Range request
+RESUMABLE_ERRORS = (
+    aiohttp.ClientPayloadError,
+    aiohttp.ServerDisconnectedError,
+    aiohttp.ClientConnectionError,
+    asyncio.TimeoutError,
+)
+
+
+class MediaBuffer:
+    """
+    One downloaded media file kept in memory. Once it grows past
+    `memory_limit` bytes it is spilled to a file in the job's directory
+    (a limit of 0 writes straight to disk). File work runs on fs_executor
+    so the event loop never blocks on the disk.
+    """
+
+    def __init__(self, name: str, media_type: str, spill_dir: str,
+                 memory_limit: int = STREAM_MEMORY_LIMIT):
+        self.name = name
+        self.media_type = media_type  # "photo" or "video"
+        self.spill_dir = spill_dir
+        self.memory_limit = memory_limit
+        self.size = 0
+        self.path = None
+        self._data = bytearray()
+        self._file = None
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self._data.extend(chunk)
+        if self._file is None:
+            if self.size <= self.memory_limit:
+                return
+            self.path = os.path.join(self.spill_dir, self.name)
+            self._file = await fs_executor.run(_open_spill, self.path)
+        # Once spilled, _data only holds what hasn't been written yet
+        if len(self._data) >= SPILL_WRITE_SIZE:
+            data, self._data = self._data, bytearray()
+            await fs_executor.run(self._file.write, data)
+
+    async def reset(self):
+        """Drops everything written so far (the server ignored a Range request)."""
+        self.size = 0
+        self._data = bytearray()
+        if self._file is not None:
+            await fs_executor.run(_truncate, self._file)
+
+    async def finish(self):
+        if self._file is not None:
+            file, data = self._file, self._data
+            self._file, self._data = None, bytearray()
+            await fs_executor.run(_write_and_close, file, data)
+        # bytes lets every BytesIO reader share the buffer without copying
+        self._data = bytes(self._data)
+
+    def open(self):
+        """
+        Returns something Pyrogram can upload: the spill file's path, or a fresh
+        in-memory reader (each consumer gets its own read position).
+        """
+        if self.path:
+            return self.path
+        reader = io.BytesIO(self._data)
+        reader.name = self.name
+        return reader
+
+
+def _open_spill(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "wb")
+
+
+def _truncate(file):
+    file.seek(0)
+    file.truncate()
+
+
+def _write_and_close(file, data: bytes):
+    try:
+        file.write(data)
+    finally:
+        file.close()
+
+
+# --- HTTP Client ---
+# One client session, so connections to the Instagram CDN are kept alive
+# and reused across downloads. Created lazily inside the running loop.
+# The connector caps connections overall and per CDN host.
+
+_session: aiohttp.ClientSession | None = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=MEDIA_FETCH_CONNECTIONS,
+                limit_per_host=MEDIA_FETCH_PER_HOST,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=MEDIA_FETCH_TIMEOUT, sock_connect=10, sock_read=30
+            ),
+            headers={"User-Agent": USER_AGENT},
+        )
+    return _session
+
+
+async def close_session():
+    """Closes the shared HTTP client. Called once on shutdown."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _read_into(buffer: MediaBuffer, url: str):
+    """One GET, continuing from buffer.size with a Range header if it isn't empty."""
+    headers = {"Range": f"bytes={buffer.size}-"} if buffer.size else {}
+    async with get_session().get(url, headers=headers) as response:
+        if response.status == 416:
+            return  # We already have every byte
+        response.raise_for_status()
+        if buffer.size and response.status != 206:
+            # No range support; start over
+            await buffer.reset()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            await buffer.write(chunk)
+
+
+async def fetch_media(url: str, name: str, media_type: str, spill_dir: str,
+                      memory_limit: int = STREAM_MEMORY_LIMIT) -> MediaBuffer:
+    """
+    Downloads one media URL into a MediaBuffer, resuming with HTTP Range
+    requests if the connection drops part way.
+    """
+    buffer = MediaBuffer(name, media_type, spill_dir, memory_limit)
+    try:
+        for attempt in range(MEDIA_FETCH_RETRIES + 1):
+            try:
+                await _read_into(buffer, url)
+                break
+            except RESUMABLE_ERRORS as e:
+                if attempt >= MEDIA_FETCH_RETRIES:
+                    raise
+                logger.info(f"Fetch of {name} dropped at {buffer.size} bytes ({e!r}), resuming.")
+                await asyncio.sleep(0.5 * (attempt + 1))
+    finally:
+        await buffer.finish()
+    return buffer
+
+
+async def fetch_all(urls: list, spill_dir: str, memory_limit: int = STREAM_MEMORY_LIMIT) -> list:
+    """
+    Fetches [(media_type, url), ...] in parallel (e.g. every item of a carousel)
+    and returns the MediaBuffers in the original order.
+    """
+    tasks = [
+        asyncio.create_task(fetch_media(
+            url, f"{i + 1}{'.mp4' if media_type == 'video' else '.jpg'}",
+            media_type, spill_dir, memory_limit
+        ))
+        for i, (media_type, url) in enumerate(urls)
+    ]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        # If one item failed, don't leave the others downloading; wait for
+        # them so their spill files are closed before the caller cleans up
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
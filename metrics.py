@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Served by the health-check web server on /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base for the metric types below: a name, help text and labelled children."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()  # Some metrics are updated from worker threads
+        _registry.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yields (suffix, label_values, extra_label, value)."""
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            labels = _format_labels(self.labelnames, values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    """A monotonically increasing count."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield "_total", values, "", child.value
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield "", values, "", child.value
+
+
+class GaugeFunc(_Metric):
+    """
+    A gauge read from a callback at scrape time. The callback returns a
+    number, or {label_values_tuple: number} when the gauge has labels.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, func, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def _samples(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            logger.debug(f"Metric {self.name} callback failed: {e}")
+            return
+        if isinstance(result, dict):
+            for values, value in result.items():
+                yield "", tuple(values), "", value
+        else:
+            yield "", (), "", result
+
+
+class CounterFunc(GaugeFunc):
+    """A counter read from a callback at scrape time (e.g. hits kept by a cache)."""
+
+    kind = "counter"
+
+    def _samples(self):
+        for _, values, extra, value in super()._samples():
+            yield "_total", values, extra, value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """Latency distribution with cumulative buckets (in seconds)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", values, "", child.sum
+            yield "_count", values, "", child.count
+
+
+def render() -> str:
+    """Returns every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Pipeline Metrics ---
+
+messages_received = Counter(
+    "bot_messages_received", "Messages containing Instagram links."
+)
+links_received = Counter(
+    "bot_links", "Instagram links received, by type.", ("type",)
+)
+link_outcomes = Counter(
+    "bot_link_results", "Links processed, by type and outcome.", ("type", "outcome")
+)
+instagram_fetch_seconds = Histogram(
+    "bot_instagram_fetch_seconds",
+    "Time spent on Instagram: resolving a link (resolve) and downloading its media (media).",
+    ("stage",)
+)
+telegram_upload_seconds = Histogram(
+    "bot_telegram_upload_seconds",
+    "Time to send media to Telegram, by source (upload or cached file_id).",
+    ("source",)
+)
+db_query_seconds = Histogram(
+    "bot_db_query_seconds",
+    "Time a pooled SQLite connection was held, by connection kind.",
+    ("kind",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+download_errors = Counter(
+    "bot_download_errors", "Failed downloads, by exception class.", ("exception",)
+)
+
+# Caches register themselves here with the names of their hit/miss attributes
+_caches = {}  # name -> (cache, hits_attribute, misses_attribute)
+
+def register_cache(name: str, cache, hits: str = "hits", misses: str = "misses"):
+    _caches[name] = (cache, hits, misses)
+
+cache_hits = CounterFunc(
+    "bot_cache_hits", "Cache hits, by cache.",
+    lambda: {(name,): getattr(c, h) for name, (c, h, _) in _caches.items()}, ("cache",)
+)
+cache_misses = CounterFunc(
+    "bot_cache_misses", "Cache misses, by cache.",
+    lambda: {(name,): getattr(c, m) for name, (c, _, m) in _caches.items()}, ("cache",)
+)
+event_loop_lag_seconds = Histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the event loop woke up a periodic timer.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+event_loop_lag_last = Gauge(
+    "bot_event_loop_lag_last_seconds", "Most recent event-loop lag measurement."
+)
+
+
+# --- Event-loop Lag ---
+
+class LoopLagMonitor:
+    """Sleeps for a fixed interval and records how much later than asked it woke up."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            event_loop_lag_seconds.observe(lag)
+            event_loop_lag_last.set(lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,91 @@
+import os
+import sys
+import threading
+import time
+import logging
+from collections import Counter
+from config import PROFILER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+MAX_DEPTH = 64
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop's) from a background
+    thread every `interval` seconds. Cheap enough to switch on in production
+    for a few minutes; the result is a flame-graph compatible collapsed-stack
+    dump plus a per-function summary.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+        self.stacks = Counter()  # "outer;...;inner" -> samples
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, thread_id: int | None = None):
+        """Starts sampling `thread_id` (default: the calling thread). Clears earlier samples."""
+        if self.running:
+            return
+        self._target = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler started (every {self.interval * 1000:.0f} ms).")
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped_at = time.time()
+        logger.info(f"Sampling profiler stopped after {self.samples} samples.")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_DEPTH:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def top(self, count: int = 15) -> list:
+        """[(function, self_samples, total_samples)] sorted by self time."""
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            names = stack.split(";")
+            own[names[-1]] += n
+            for name in set(names):
+                total[name] += n
+        return [(name, n, total[name]) for name, n in own.most_common(count)]
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from config import DOWNLOAD_WORKERS
+from metrics import Histogram, GaugeFunc
+
+logger = logging.getLogger(__name__)
+
+# --- Priority Classes ---
+# Lower value runs first. Within a class users are served round-robin.
+PRIORITY_ADMIN = 0
+PRIORITY_PREMIUM = 1
+PRIORITY_FREE = 2
+PRIORITY_NAMES = {PRIORITY_ADMIN: "admin", PRIORITY_PREMIUM: "premium", PRIORITY_FREE: "free"}
+
+
+def priority_for(user: dict) -> int:
+    """Picks the priority class for a user row."""
+    if user.get('is_admin'):
+        return PRIORITY_ADMIN
+    if user.get('is_premium'):
+        return PRIORITY_PREMIUM
+    return PRIORITY_FREE
+
+
+class Job:
+    """A queued call to a coroutine function."""
+
+    __slots__ = ("user_id", "priority", "func", "args", "future", "enqueued_at", "started_at")
+
+    def __init__(self, user_id: int, priority: int, func, args: tuple):
+        self.user_id = user_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+    @property
+    def started(self) -> bool:
+        return self.started_at is not None
+
+
+class DownloadScheduler:
+    """
+    Runs download jobs on a fixed pool of worker tasks.
+
+    Jobs are taken strictly by priority class, and round-robin across users
+    inside a class, so one user pasting many links can't starve the others.
+    """
+
+    def __init__(self, workers: int):
+        self.worker_count = max(1, workers)
+        # priority -> OrderedDict(user_id -> deque of jobs); order is the rotation
+        self._queues = {p: OrderedDict() for p in PRIORITY_NAMES}
+        self._wakeup = asyncio.Event()
+        self._workers = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._waits = deque(maxlen=1000)  # Recent queue wait times in seconds
+
+    # --- Queue Operations ---
+
+    def _push(self, job: Job):
+        users = self._queues[job.priority]
+        users.setdefault(job.user_id, deque()).append(job)
+        self._wakeup.set()
+
+    def _pop(self) -> Job | None:
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            while users:
+                user_id, jobs = next(iter(users.items()))
+                job = jobs.popleft()
+                # Rotate the user to the back, or drop them if they have no more jobs
+                del users[user_id]
+                if jobs:
+                    users[user_id] = jobs
+                if not job.future.done():  # Skip jobs cancelled while queued
+                    return job
+        return None
+
+    def _discard(self, job: Job):
+        jobs = self._queues[job.priority].get(job.user_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._queues[job.priority][job.user_id]
+
+    def position(self, job: Job) -> int:
+        """Approximate number of jobs that will start before this one (0 = next)."""
+        if job.started or job.future.done():
+            return 0
+        ahead = 0
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if priority < job.priority:
+                ahead += sum(len(jobs) for jobs in users.values())
+                continue
+            if priority > job.priority:
+                break
+            own = users.get(job.user_id)
+            if not own or job not in own:
+                return ahead
+            rounds = own.index(job)
+            before_user = True
+            for user_id, jobs in users.items():
+                if user_id == job.user_id:
+                    before_user = False
+                    ahead += rounds
+                    continue
+                # Users ahead in the rotation get one extra turn
+                ahead += min(len(jobs), rounds + (1 if before_user else 0))
+        return ahead
+
+    @property
+    def depth(self) -> int:
+        return sum(len(jobs) for users in self._queues.values() for jobs in users.values())
+
+    # --- Public API ---
+
+    def submit(self, user_id: int, priority: int, func, *args) -> Job:
+        """Queues `await func(*args)` and returns the job; await job.future for the result."""
+        self.start()
+        job = Job(user_id, priority, func, args)
+        job.future.add_done_callback(lambda fut: fut.cancelled() and self._discard(job))
+        self._push(job)
+        return job
+
+    async def run(self, user_id: int, priority: int, func, *args):
+        """Queues a job and waits for its result."""
+        job = self.submit(user_id, priority, func, *args)
+        return await job.future
+
+    def start(self):
+        """Starts the worker tasks (idempotent)."""
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(i)) for i in range(self.worker_count)
+            ]
+            logger.info(f"Download scheduler started with {self.worker_count} workers.")
+
+    async def stop(self):
+        """Cancels the workers and every job still waiting in the queue."""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while (job := self._pop()) is not None:
+            job.future.cancel()
+
+    async def _worker(self, index: int):
+        while True:
+            job = self._pop()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            job.started_at = time.monotonic()
+            self._waits.append(job.started_at - job.enqueued_at)
+            queue_wait_seconds.labels(PRIORITY_NAMES[job.priority]).observe(job.started_at - job.enqueued_at)
+            self.running += 1
+            try:
+                result = await job.func(*job.args)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.completed += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        """Queue depth per class, worker usage and recent wait times."""
+        waits = sorted(self._waits)
+        return {
+            "workers": self.worker_count,
+            "running": self.running,
+            "depth": self.depth,
+            "depth_by_class": {
+                PRIORITY_NAMES[p]: sum(len(jobs) for jobs in users.values())
+                for p, users in self._queues.items()
+            },
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait": (sum(waits) / len(waits)) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max_wait": waits[-1] if waits else 0.0,
+        }
+
+
+scheduler = DownloadScheduler(DOWNLOAD_WORKERS)
+
+# --- Metrics ---
+queue_wait_seconds = Histogram(
+    "bot_queue_wait_seconds", "Time download jobs waited for a worker, by priority class.", ("class",)
+)
+GaugeFunc(
+    "bot_queue_depth", "Download jobs waiting for a worker, by priority class.",
+    lambda: {(name,): n for name, n in scheduler.stats()["depth_by_class"].items()}, ("class",)
+)
+GaugeFunc("bot_download_workers_busy", "Download workers running a job.", lambda: scheduler.running)
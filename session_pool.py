@@ -0,0 +1,378 @@
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+import instaloader
+from instaloader.exceptions import LoginRequiredException, TooManyRequestsException
+from config import (
+    IG_USER, IG_PASS, IG_ACCOUNTS, IG_ANONYMOUS_SESSIONS, IG_SESSION_BUDGET,
+    IG_SESSION_BUDGET_WINDOW, IG_SESSION_COOLDOWN, IG_LEASE_TIMEOUT, IG_REQUEST_TIMEOUT,
+    IG_SESSION_DIR, IG_SESSION_CHECK_INTERVAL, IG_LOGIN_RETRY_INTERVAL
+)
+from executors import instagram_executor
+from metrics import GaugeFunc, CounterFunc
+
+logger = logging.getLogger(__name__)
+
+# Waits longer than this inside Instaloader fail the job instead of
+# blocking the worker thread, so it can be retried on another session.
+MAX_INLINE_SLEEP = 10
+
+
+class _SessionRateController(instaloader.RateController):
+    """Counts requests per session and turns long rate-limit waits into errors."""
+
+    def __init__(self, context, session: "InstagramSession"):
+        super().__init__(context)
+        self._session = session
+
+    def sleep(self, secs: float):
+        if secs > MAX_INLINE_SLEEP:
+            # Keep the session out of rotation for the wait Instaloader asked for
+            self._session.rest(secs)
+            raise TooManyRequestsException(f"Session {self._session.name} needs to wait {secs:.0f}s.")
+        super().sleep(secs)
+
+    def wait_before_query(self, query_type: str):
+        super().wait_before_query(query_type)
+        self._session.record_request()
+
+    def handle_429(self, query_type: str):
+        self._session.mark_rate_limited()
+        raise TooManyRequestsException(f"Session {self._session.name} got HTTP 429.")
+
+
+class InstagramSession:
+    """One Instaloader instance, optionally logged in, with its own request budget."""
+
+    def __init__(self, name: str, username: str = "", password: str = ""):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.logged_in = False
+        # anonymous, logged_out, restored (cookies loaded, not yet checked),
+        # valid, expired or failed
+        self.state = "logged_out" if username else "anonymous"
+        self.last_checked = None  # Wall-clock time of the last successful check or login
+        self.last_login_attempt = None  # monotonic
+        self.last_error = ""
+        self.in_use = False
+        self.cooldown_until = 0.0
+        self.rate_limited_count = 0
+        self.jobs = 0
+        self._requests = deque()  # monotonic timestamps inside the budget window
+        self.loader = instaloader.Instaloader(
+            download_pictures=True,
+            download_videos=True,
+            download_video_thumbnails=False,
+            download_geotags=False,
+            download_comments=False,
+            save_metadata=False,
+            compress_json=False,
+            post_metadata_txt_pattern=None, # Disable caption .txt files
+            storyitem_metadata_txt_pattern=None,
+            request_timeout=IG_REQUEST_TIMEOUT,
+            rate_controller=lambda ctx: _SessionRateController(ctx, self),
+        )
+
+    # Called from worker threads; deque appends/pops are thread-safe
+    def record_request(self):
+        self._requests.append(time.monotonic())
+
+    def mark_rate_limited(self):
+        self.rate_limited_count += 1
+        self.cooldown_until = time.monotonic() + IG_SESSION_COOLDOWN
+        logger.warning(f"Instagram session {self.name} rate-limited, cooling down for {IG_SESSION_COOLDOWN}s.")
+
+    def rest(self, seconds: float):
+        """Keeps the session out of rotation, e.g. while an abandoned call finishes."""
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def budget_left(self) -> int:
+        cutoff = time.monotonic() - IG_SESSION_BUDGET_WINDOW
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+        return IG_SESSION_BUDGET - len(self._requests)
+
+    def available(self, require_login: bool) -> bool:
+        return (
+            not self.in_use
+            and (self.logged_in or not require_login)
+            and self.cooldown_until <= time.monotonic()
+            and self.budget_left() > 0
+        )
+
+    # --- Login & Saved Cookies ---
+
+    @property
+    def session_file(self) -> str:
+        return os.path.join(IG_SESSION_DIR, f"session-{self.username}")
+
+    def restore(self) -> bool:
+        """Loads saved cookies, if any. Only reads a small file, so it can run on the loop."""
+        if not self.username or not os.path.exists(self.session_file):
+            return False
+        try:
+            self.loader.load_session_from_file(self.username, self.session_file)
+        except Exception as e:
+            logger.warning(f"Could not load the saved Instagram session of {self.username}: {e}")
+            return False
+        self.logged_in = True
+        self.state = "restored"
+        logger.info(f"Restored the saved Instagram session of {self.username}.")
+        return True
+
+    def save(self):
+        """Writes the session cookies to IG_SESSION_DIR, readable by the owner only."""
+        try:
+            os.makedirs(IG_SESSION_DIR, exist_ok=True)
+            self.loader.save_session_to_file(self.session_file)
+            os.chmod(self.session_file, 0o600)
+        except Exception as e:
+            logger.error(f"Could not save the Instagram session of {self.username}: {e}")
+
+    def login(self):
+        """Logs this session in with the password and saves the cookies. This is a blocking function."""
+        if not self.username or not self.password:
+            return
+        self.last_login_attempt = time.monotonic()
+        try:
+            logger.info(f"Attempting Instaloader login as {self.username}...")
+            self.loader.login(self.username, self.password)
+        except Exception as e:
+            self.logged_in = False
+            self.state = "failed"
+            self.last_error = str(e)
+            logger.error(f"Instaloader login failed for {self.username}: {e}")
+            return
+        self.logged_in = True
+        self.state = "valid"
+        self.last_checked = time.time()
+        self.last_error = ""
+        self.save()
+        logger.info(f"Instaloader login successful for {self.username}.")
+
+    def check(self):
+        """
+        Confirms the cookies are still accepted, logging in again if they
+        aren't (at most once per IG_LOGIN_RETRY_INTERVAL). This is a blocking function.
+        """
+        if not self.username:
+            return
+        if self.logged_in:
+            try:
+                valid = self.loader.test_login() == self.username
+            except Exception as e:
+                # Couldn't tell (e.g. rate-limited); keep the session as it is
+                logger.warning(f"Could not check the Instagram session of {self.username}: {e}")
+                return
+            if valid:
+                self.state = "valid"
+                self.last_checked = time.time()
+                self.save()  # Instagram may have renewed some cookies
+                return
+            logger.warning(f"The Instagram session of {self.username} has expired.")
+            self.expire()
+        if (self.last_login_attempt is None
+                or time.monotonic() - self.last_login_attempt >= IG_LOGIN_RETRY_INTERVAL):
+            self.login()
+
+    def expire(self):
+        """Takes the session out of login-only work until it is logged in again."""
+        self.logged_in = False
+        self.state = "expired"
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "logged_in": self.logged_in,
+            "state": self.state,
+            "last_checked": self.last_checked,
+            "last_error": self.last_error,
+            "in_use": self.in_use,
+            "budget_left": self.budget_left(),
+            "cooldown": max(0.0, self.cooldown_until - time.monotonic()),
+            "rate_limited": self.rate_limited_count,
+            "jobs": self.jobs,
+        }
+
+
+class SessionPool:
+    """
+    Hands out one Instagram session per job.
+
+    A session is leased exclusively (Instaloader contexts are not thread-safe),
+    and is skipped while it is cooling down after a 429 or has spent its
+    request budget for the current window.
+    """
+
+    def __init__(self, accounts: list, anonymous: int):
+        self.sessions = [
+            InstagramSession(f"account:{username}", username, password)
+            for username, password in accounts
+        ]
+        self.sessions += [InstagramSession(f"anonymous:{i}") for i in range(anonymous)]
+        if not self.sessions:
+            self.sessions.append(InstagramSession("anonymous:0"))
+        self._changed = asyncio.Condition()
+        self._check_now = asyncio.Event()
+        self._checker = None
+
+    @property
+    def accounts(self) -> list:
+        return [s for s in self.sessions if s.username]
+
+    # --- Session Upkeep ---
+    # Saved cookies are loaded at startup so logged-in work can start at once.
+    # A background task then checks them, logs in where there are none or
+    # they have expired, and repeats every IG_SESSION_CHECK_INTERVAL.
+
+    def restore_all(self) -> int:
+        """Loads the saved cookies of every account. Returns how many were restored."""
+        if not self.accounts:
+            logger.warning("No Instagram accounts configured. Running without login.")
+            logger.warning("May face rate limits or fail to download stories/highlights.")
+            return 0
+        return sum(session.restore() for session in self.accounts)
+
+    @asynccontextmanager
+    async def _hold(self, session: InstagramSession):
+        """Leases one specific session, so a check never shares its loader with a job."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: not session.in_use)
+            session.in_use = True
+        try:
+            yield session
+        finally:
+            async with self._changed:
+                session.in_use = False
+                self._changed.notify_all()
+
+    async def check_all(self):
+        """Checks every account session and logs in again where needed."""
+        for session in self.accounts:
+            async with self._hold(session):
+                await instagram_executor.run(session.check, timeout=None)
+        if self.accounts and not any(s.logged_in for s in self.accounts):
+            logger.warning("No Instagram account is logged in. Continuing without login.")
+
+    def report_expired(self, session: InstagramSession):
+        """Called when Instagram rejected a session's login; it is checked right away."""
+        if session.logged_in:
+            session.expire()
+            logger.warning(f"Instagram rejected the login of {session.name}, re-checking it.")
+            self._check_now.set()
+
+    async def _check_loop(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Instagram session check failed: {e}")
+            self._check_now.clear()
+            interval = IG_SESSION_CHECK_INTERVAL
+            if not all(s.logged_in for s in self.accounts):
+                # Try failed logins again sooner than the routine check
+                interval = min(interval, IG_LOGIN_RETRY_INTERVAL)
+            try:
+                await asyncio.wait_for(self._check_now.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Starts checking (and logging in) account sessions in the background."""
+        if self._checker is None and self.accounts:
+            self._checker = asyncio.create_task(self._check_loop())
+
+    async def stop(self):
+        """Stops the background checks and saves the cookies of logged-in accounts."""
+        if self._checker is not None:
+            self._checker.cancel()
+            try:
+                await self._checker
+            except asyncio.CancelledError:
+                pass
+            self._checker = None
+        for session in self.accounts:
+            if session.logged_in:
+                session.save()
+
+    def _pick(self, require_login: bool) -> InstagramSession | None:
+        candidates = [s for s in self.sessions if s.available(require_login)]
+        if not candidates:
+            return None
+        # Spread load: prefer the session with the most budget left
+        return max(candidates, key=lambda s: s.budget_left())
+
+    def _next_change_in(self) -> float:
+        """Seconds until a cooldown or budget window frees a session."""
+        now = time.monotonic()
+        waits = [s.cooldown_until - now for s in self.sessions if s.cooldown_until > now]
+        waits += [
+            s._requests[0] + IG_SESSION_BUDGET_WINDOW - now
+            for s in self.sessions if s._requests and s.budget_left() <= 0
+        ]
+        return max(0.1, min(waits)) if waits else IG_LEASE_TIMEOUT
+
+    @asynccontextmanager
+    async def lease(self, require_login: bool = False):
+        """Waits for a usable session and holds it for the duration of the block."""
+        if require_login and not any(s.logged_in for s in self.sessions):
+            raise LoginRequiredException("No logged-in Instagram session is available.")
+
+        deadline = time.monotonic() + IG_LEASE_TIMEOUT
+        async with self._changed:
+            while (session := self._pick(require_login)) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TooManyRequestsException("All Instagram sessions are busy or rate-limited.")
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), timeout=min(remaining, self._next_change_in())
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            session.in_use = True
+            session.jobs += 1
+        try:
+            yield session
+        finally:
+            async with self._changed:
+                session.in_use = False
+                # Waiters need different kinds of session; let each re-check
+                self._changed.notify_all()
+
+    def stats(self) -> list:
+        return [s.stats() for s in self.sessions]
+
+
+def _parse_accounts(raw: str) -> list:
+    """Parses "user1:pass1,user2:pass2" and adds the legacy IG_USER/IG_PASS pair."""
+    accounts = []
+    for entry in raw.split(","):
+        username, _, password = entry.strip().partition(":")
+        if username and password:
+            accounts.append((username, password))
+    if IG_USER and IG_PASS and IG_USER not in [u for u, _ in accounts]:
+        accounts.insert(0, (IG_USER, IG_PASS))
+    return accounts
+
+
+session_pool = SessionPool(_parse_accounts(IG_ACCOUNTS), IG_ANONYMOUS_SESSIONS)
+
+# --- Metrics ---
+GaugeFunc(
+    "bot_ig_session_budget_left", "Instagram requests left in the budget window, by session.",
+    lambda: {(s.name,): s.budget_left() for s in session_pool.sessions}, ("session",)
+)
+GaugeFunc(
+    "bot_ig_session_cooling_down", "1 while a session is cooling down after a rate limit.",
+    lambda: {(s.name,): int(s.cooldown_until > time.monotonic()) for s in session_pool.sessions},
+    ("session",)
+)
+CounterFunc(
+    "bot_ig_session_rate_limited", "Rate limits hit, by session.",
+    lambda: {(s.name,): s.rate_limited_count for s in session_pool.sessions}, ("session",)
+)
@@ -0,0 +1,284 @@
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+import time
+from config import (
+    SPOOL_DIR, SPOOL_QUOTA_BYTES, SPOOL_MEMORY_QUOTA_BYTES, SPOOL_REUSE_WINDOW,
+    SPOOL_SWEEP_INTERVAL, SPOOL_ORPHAN_AGE
+)
+from executors import fs_executor
+from metrics import GaugeFunc, register_cache
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolEntry:
+    """One job directory under the spool and the download result stored in it."""
+
+    __slots__ = ("path", "key", "refs", "size", "memory", "result", "created", "last_used", "flagged")
+
+    def __init__(self, path: str, key: str | None):
+        self.path = path
+        self.key = key
+        self.refs = 1
+        self.size = 0    # Bytes on disk
+        self.memory = 0  # Bytes of streamed media held in memory
+        self.result = None
+        self.created = self.last_used = time.monotonic()
+        self.flagged = False  # Already logged as held too long
+
+
+def _remove_orphans(root: str, tracked: set, min_age: float) -> int:
+    """
+    Removes everything under root that is not in `tracked` and older than
+    min_age seconds (0: everything), so just-created paths survive a sweep.
+    Runs in fs_executor. Returns the number of paths removed.
+    """
+    if not os.path.isdir(root):
+        return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if path in tracked:
+            continue
+        try:
+            if min_age and now - os.path.getmtime(path) <= min_age:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Failed to remove orphaned spool path {path}: {e}")
+            continue
+        removed += 1
+    return removed
+
+
+class SpoolManager:
+    """
+    Owns the downloads/ directory.
+
+    Every job directory is allocated here and reference counted. When the
+    last consumer releases a successful download it is kept idle for
+    SPOOL_REUSE_WINDOW seconds so the same media can be sent again without
+    fetching it. Idle entries are evicted least recently used first whenever
+    the spool is over its disk quota or its (much smaller) memory quota for
+    streamed media, and a periodic sweep removes expired entries and
+    directories no job owns any more. The quotas only bound what is kept
+    for reuse: entries in use are never evicted and allocation never waits,
+    so links in progress can take the spool over quota.
+    """
+
+    def __init__(self, root: str, quota_bytes: int, memory_quota_bytes: int, reuse_window: float,
+                 sweep_interval: float, orphan_age: float):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.memory_quota_bytes = memory_quota_bytes
+        self.reuse_window = reuse_window
+        self.sweep_interval = sweep_interval
+        self.orphan_age = orphan_age
+        self._entries = {}  # path -> SpoolEntry
+        self._by_key = {}   # media key -> path of its reusable entry
+        self._ids = itertools.count(1)
+        self._sweep_task = None
+        self.reuse_hits = 0
+        self.reuse_misses = 0
+        self.evictions = 0
+        self.orphans_removed = 0
+
+    # --- Allocation & References ---
+
+    def allocate(self, key: str | None = None) -> str:
+        """Creates a new entry (holding one reference) and returns its directory path."""
+        name = key.replace(':', '_') if key else "job"
+        path = os.path.join(self.root, f"{name}_{next(self._ids)}")
+        self._entries[path] = SpoolEntry(path, key)
+        return path
+
+    def retain(self, path: str):
+        entry = self._entries.get(path)
+        if entry:
+            entry.refs += 1
+            entry.last_used = time.monotonic()
+
+    def complete(self, path: str, result: tuple):
+        """Records a successful download so it can be reused and accounted for."""
+        entry = self._entries.get(path)
+        if entry is None:
+            return
+        entry.result = result
+        for media in result[0]:
+            # Streamed media without a spill file lives in memory
+            if getattr(media, "path", True) is None:
+                entry.memory += media.size
+            else:
+                entry.size += getattr(media, "size", 0)
+        if entry.key:
+            self._by_key[entry.key] = path
+
+    def reuse(self, key: str):
+        """Returns a recent download of this media (taking a reference), or None."""
+        path = self._by_key.get(key)
+        entry = self._entries.get(path) if path else None
+        if entry is None or entry.result is None:
+            self.reuse_misses += 1
+            return None
+        if entry.refs <= 0 and time.monotonic() - entry.last_used > self.reuse_window:
+            self.reuse_misses += 1
+            return None
+        entry.refs += 1
+        entry.last_used = time.monotonic()
+        self.reuse_hits += 1
+        return entry.result
+
+    async def release(self, path: str):
+        """Drops one reference. Unused entries are kept for reuse or removed."""
+        entry = self._entries.get(path)
+        if entry is None:
+            # Not ours (or already evicted); fall back to plain removal
+            await self._rmtree(path)
+            return
+        entry.refs -= 1
+        if entry.refs > 0:
+            return
+        entry.last_used = time.monotonic()
+        if entry.result is None or not entry.key or self.reuse_window <= 0:
+            await self._remove(entry)
+        else:
+            await self.enforce_quota()
+
+    # --- Eviction ---
+
+    @property
+    def usage(self) -> int:
+        """Bytes on disk."""
+        return sum(entry.size for entry in self._entries.values())
+
+    @property
+    def memory_usage(self) -> int:
+        return sum(entry.memory for entry in self._entries.values())
+
+    async def _remove(self, entry: SpoolEntry):
+        self._entries.pop(entry.path, None)
+        if entry.key and self._by_key.get(entry.key) == entry.path:
+            del self._by_key[entry.key]
+        await self._rmtree(entry.path)
+
+    async def _rmtree(self, path: str):
+        if path and os.path.exists(path):
+            try:
+                await fs_executor.run(shutil.rmtree, path)
+            except Exception as e:
+                logger.error(f"Failed to clean up directory {path}: {e}")
+
+    async def enforce_quota(self):
+        """
+        Evicts idle entries, least recently used first, until disk and memory
+        fit their quotas (or only entries in use are left).
+        """
+        usage, memory = self.usage, self.memory_usage
+        if usage <= self.quota_bytes and memory <= self.memory_quota_bytes:
+            return
+        idle = sorted(
+            (e for e in self._entries.values() if e.refs <= 0),
+            key=lambda e: e.last_used
+        )
+        for entry in idle:
+            if usage <= self.quota_bytes and memory <= self.memory_quota_bytes:
+                break
+            usage -= entry.size
+            memory -= entry.memory
+            self.evictions += 1
+            await self._remove(entry)
+        if usage > self.quota_bytes or memory > self.memory_quota_bytes:
+            logger.warning(f"Spool is over quota with only active jobs ({usage} bytes on disk, {memory} in memory).")
+
+    async def sweep(self, startup: bool = False) -> int:
+        """
+        Removes idle entries past the reuse window and untracked directories.
+        Entries still held are never removed, since an upload may be reading
+        them; those held longer than SPOOL_ORPHAN_AGE are logged once.
+        On startup every directory is an orphan of the previous process.
+        Returns the number of directories removed.
+        """
+        now = time.monotonic()
+        removed = 0
+        for entry in list(self._entries.values()):
+            if entry.refs <= 0 and now - entry.last_used > self.reuse_window:
+                await self._remove(entry)
+                removed += 1
+            elif entry.refs > 0 and not entry.flagged and now - entry.created > self.orphan_age:
+                logger.warning(
+                    f"Spool entry {entry.path} has been held for over {self.orphan_age}s "
+                    f"({entry.refs} references); it may have leaked."
+                )
+                entry.flagged = True
+
+        # Directories no entry owns; listing and removing them is blocking I/O
+        min_age = 0 if startup else self.sweep_interval
+        orphans = await fs_executor.run(_remove_orphans, self.root, set(self._entries), min_age)
+        self.orphans_removed += orphans
+        return removed + orphans
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+                await self.enforce_quota()
+            except Exception as e:
+                logger.error(f"Spool sweep failed: {e}")
+
+    async def start(self):
+        """Clears what a previous run left behind and starts the periodic sweep."""
+        os.makedirs(self.root, exist_ok=True)
+        removed = await self.sweep(startup=True)
+        if removed:
+            logger.info(f"Removed {removed} orphaned download directories.")
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            try:
+                await self._sweep_task
+            except asyncio.CancelledError:
+                pass
+            self._sweep_task = None
+
+    async def clear_idle(self) -> int:
+        """Removes every entry nobody is using. Returns how many were removed."""
+        idle = [e for e in self._entries.values() if e.refs <= 0]
+        for entry in idle:
+            await self._remove(entry)
+        return len(idle)
+
+    def stats(self) -> dict:
+        entries = list(self._entries.values())
+        return {
+            "usage": sum(e.size for e in entries),
+            "quota": self.quota_bytes,
+            "memory": sum(e.memory for e in entries),
+            "memory_quota": self.memory_quota_bytes,
+            "active": sum(1 for e in entries if e.refs > 0),
+            "idle": sum(1 for e in entries if e.refs <= 0),
+            "reuse_hits": self.reuse_hits,
+            "evictions": self.evictions,
+            "orphans_removed": self.orphans_removed,
+        }
+
+
+spool = SpoolManager(
+    SPOOL_DIR, SPOOL_QUOTA_BYTES, SPOOL_MEMORY_QUOTA_BYTES, SPOOL_REUSE_WINDOW,
+    SPOOL_SWEEP_INTERVAL, SPOOL_ORPHAN_AGE
+)
+
+# --- Metrics ---
+GaugeFunc("bot_spool_bytes", "Bytes of downloads held in the spool on disk.", lambda: spool.usage)
+GaugeFunc("bot_spool_memory_bytes", "Bytes of streamed downloads held in memory.", lambda: spool.memory_usage)
+register_cache("spool", spool, hits="reuse_hits", misses="reuse_misses")
@@ -0,0 +1,56 @@
+import time
+import logging
+from contextlib import contextmanager
+from metrics import GaugeFunc
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Durations of the startup phases, measured from when this module was
+    imported (the first thing main.py does) and logged as one report.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}  # name -> seconds, in the order they finished
+        self.background = set()  # Phases that ran after the bot was serving
+        self.serving_after = None
+
+    def record(self, name: str, seconds: float, background: bool = False):
+        self.phases[name] = seconds
+        if background:
+            self.background.add(name)
+
+    @contextmanager
+    def phase(self, name: str, background: bool = False):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, background)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def serving(self):
+        """Marks the moment the health server and the Telegram client are up."""
+        self.serving_after = self.elapsed()
+        logger.info(f"Serving after {self.serving_after:.2f}s.")
+
+    def report(self) -> str:
+        phases = ", ".join(
+            f"{name} {seconds:.2f}s" + (" (background)" if name in self.background else "")
+            for name, seconds in self.phases.items()
+        )
+        serving = f"{self.serving_after:.2f}s" if self.serving_after is not None else "n/a"
+        return f"Startup: {phases}. Serving after {serving}, fully ready after {self.elapsed():.2f}s."
+
+
+startup = StartupTimer()
+
+GaugeFunc(
+    "bot_startup_phase_seconds", "Duration of each startup phase of this process.",
+    lambda: {(name,): seconds for name, seconds in startup.phases.items()}, ("phase",)
+)
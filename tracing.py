@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import TRACE_BUFFER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# The trace of the link being processed by the current task, if any
+_current: ContextVar["Trace | None"] = ContextVar("trace", default=None)
+
+
+class Trace:
+    """Timed stages of one link, from the moment it is picked up until it is sent."""
+
+    __slots__ = ("trace_id", "url", "user_id", "started", "started_at", "spans", "total", "outcome")
+
+    def __init__(self, url: str, user_id: int, trace_id: str | None = None):
+        self.trace_id = trace_id or os.urandom(4).hex()
+        self.url = url
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.spans = []  # [(stage, seconds)] in the order they finished
+        self.total = None
+        self.outcome = None
+
+    def add(self, stage: str, seconds: float):
+        self.spans.append((stage, seconds))
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def stage_totals(self) -> dict:
+        """Seconds per stage; repeated stages (e.g. several uploads) are summed."""
+        totals = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+class Tracer:
+    """Keeps the most recent finished traces in a ring buffer."""
+
+    def __init__(self, size: int):
+        self.finished = deque(maxlen=size)
+
+    def start(self, url: str, user_id: int, trace_id: str | None = None) -> Trace:
+        """Starts a trace; pass trace_id to continue one started on another node."""
+        return Trace(url, user_id, trace_id)
+
+    def finish(self, trace: Trace, outcome: str):
+        trace.total = time.monotonic() - trace.started
+        trace.outcome = outcome
+        self.finished.append(trace)
+        logger.debug(f"[{trace.trace_id}] {trace.url} {outcome} in {trace.total:.2f}s")
+
+    def recent(self, window: float) -> list:
+        cutoff = time.time() - window
+        return [t for t in list(self.finished) if t.started_at >= cutoff]
+
+    def stage_percentiles(self, window: float) -> dict:
+        """{stage: (p50, p95, p99, samples)} over traces started in the last `window` seconds."""
+        samples = {}
+        for trace in self.recent(window):
+            for stage, seconds in trace.stage_totals().items():
+                samples.setdefault(stage, []).append(seconds)
+            samples.setdefault("total", []).append(trace.total)
+        return {
+            stage: (_percentile(values, 0.50), _percentile(values, 0.95),
+                    _percentile(values, 0.99), len(values))
+            for stage, values in samples.items()
+        }
+
+    def slowest(self, window: float, count: int = 5) -> list:
+        return sorted(self.recent(window), key=lambda t: t.total, reverse=True)[:count]
+
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# --- Current Trace ---
+# Code deep in the pipeline (e.g. the downloader) records spans on whatever
+# trace the calling task activated, without it being passed around.
+
+@contextmanager
+def activate(trace: Trace | None):
+    """Makes `trace` the current trace for the duration of the block."""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def current_trace() -> Trace | None:
+    return _current.get()
+
+
+@contextmanager
+def span(stage: str):
+    """Times a stage on the current trace; does nothing outside a trace."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+tracer = Tracer(TRACE_BUFFER_SIZE)